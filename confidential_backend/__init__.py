@@ -1 +1,3 @@
-PROXY_HEADERS = ('Accept', 'Authorization', 'Cache-Control', 'Content-Type')
+PROXY_HEADERS = (
+    'Accept', 'Authorization', 'Cache-Control', 'Content-Type', 'If-Modified-Since',
+    'If-None-Match')
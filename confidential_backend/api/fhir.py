@@ -1,34 +1,156 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import json
 
-from flask import Blueprint, current_app, g, request
+from flask import (
+    Blueprint,
+    Response,
+    copy_current_request_context,
+    current_app,
+    g,
+    jsonify,
+    request,
+    url_for,
+)
 from flask_cors import cross_origin
-from fhir.smart.scopes import scopes
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+import requests
 
 from confidential_backend import PROXY_HEADERS
-from confidential_backend.extensions import secondary_sources
-from confidential_backend.fhirresourcelogger import getLogger
+from confidential_backend.bulkhead import LAUNCH_SOURCE, BulkheadFull, admit
+from confidential_backend.bundlescan import empty_body
+from confidential_backend.compression import compress_response
+from confidential_backend.cachelaunchresponse import LAUNCH_CACHE_SOURCE
+from confidential_backend.extensions import launch_cache, strategy_registry
+from confidential_backend.fhirresourcelogger import capture_response, getLogger, start_capture
+from confidential_backend.httpclient import http_session
 from confidential_backend.jsonify_abort import jsonify_abort
-from confidential_backend.scope import request_allowed, request_scope
+from confidential_backend.paging import (
+    cached_page,
+    follow_pages,
+    next_link,
+    rewrite_links,
+    start_prefetch,
+)
+from confidential_backend.prewarm import discard_prewarmed
+from confidential_backend.proxycache import (
+    CONDITIONAL_HEADERS,
+    cached_response,
+    conditional_request,
+    request_key,
+    response_validators,
+    serve_stale,
+    staleness_headers,
+)
+from confidential_backend.scope import configured_scopes, request_allowed, request_scope
+from confidential_backend.singleflight import coalesce
+from confidential_backend.tokenrefresh import fresh_token_response, upstream_authorization
 from confidential_backend.wrapped_session import get_session_value
 
 blueprint = Blueprint('fhir', __name__)
+blueprint.after_request(compress_response)
+# registered after compression, so runs first
+blueprint.before_request(start_capture)
+blueprint.after_request(capture_response)
 r4prefix = '/v/r4/fhir'
 
 # including OPTIONS conflicts with flask-cors
 SUPPORTED_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
 
-def collate_results(*result_sets):
-    """Compile given result sets into a single bundle"""
-    results = {'resourceType': 'Bundle', 'entry': []}
 
+@blueprint.errorhandler(BulkheadFull)
+def bulkhead_full(error):
+    """Reject requests to a source without available slots, see `bulkhead.admit`"""
+    current_app.logger.warning(str(error))
+    response = jsonify(message=str(error))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def skip_full_sources():
+    """True if secondary sources without available slots are skipped, rather than rejected"""
+    return current_app.config['BULKHEAD_ON_FULL'] == 'skip'
+
+
+def entry_keys(entry):
+    """Keys identifying a Bundle entry, for deduplication across sources
+
+    :returns: set including the entry `fullUrl` and each resource
+        `identifier` (scoped by resourceType) found
+    """
+    keys = set()
+    if entry.get('fullUrl'):
+        keys.add(entry['fullUrl'])
+
+    resource = entry.get('resource') or {}
+    identifiers = resource.get('identifier') or []
+    if isinstance(identifiers, dict):
+        identifiers = [identifiers]
+    for identifier in identifiers:
+        if identifier.get('value'):
+            keys.add('|'.join((
+                resource.get('resourceType', ''),
+                identifier.get('system', ''),
+                identifier['value'])))
+    return keys
+
+
+def collate_results(*result_sets, next_urls=()):
+    """Compile given result sets into a single bundle
+
+    Entries are deduplicated by `fullUrl` and resource `identifier`, the
+    first occurrence wins.  A hash index of seen keys keeps this linear in
+    the number of entries.
+
+    :param next_urls: urls of source pages not included; when given, the
+        Bundle carries them as `next` links, omits `total` and includes an
+        `incomplete` OperationOutcome entry
+    """
+    results = {'resourceType': 'Bundle', 'type': 'searchset', 'entry': []}
+
+    seen = set()
     for rs in result_sets:
-        if 'entry' in rs:
-            results['entry'].extend(rs['entry'])
+        for entry in rs.get('entry', []):
+            keys = entry_keys(entry)
+            if not seen.isdisjoint(keys):
+                continue
+            seen.update(keys)
+            results['entry'].append(entry)
+
+    if not next_urls:
+        results['total'] = len(results['entry'])
+        return results
 
-    results['total'] = len(results['entry'])
+    # the merged total isn't known until every page is
+    results['link'] = [{'relation': 'next', 'url': url} for url in next_urls]
+    results['entry'].append({
+        'resource': {'resourceType': 'OperationOutcome', 'issue': [{
+            'severity': 'warning',
+            'code': 'incomplete',
+            'diagnostics': "results exceed MERGED_SEARCH_MAX_PAGES; see `next` links"}]},
+        'search': {'mode': 'outcome'}})
     return results
 
 
+def stream_bundle(bundle):
+    """Generate JSON serialization of given bundle, an entry at a time
+
+    Spares building the complete serialized document in memory for large
+    Bundles; the Bundle itself is already complete, nothing is sent
+    before every source has responded.
+    """
+    head = {k: v for k, v in bundle.items() if k != 'entry'}
+    # open the head object, leaving room for the entry array
+    yield json.dumps(head)[:-1]
+    yield ', "entry": ['
+    for i, entry in enumerate(bundle.get('entry', [])):
+        if i:
+            yield ', '
+        yield json.dumps(entry)
+    yield ']}'
+
+
 def empty_response(response):
     """Check for valid / empty response from FHIR server
 
@@ -46,31 +168,302 @@ def empty_response(response):
         # the launch FHIR returns a 410 as it doesn't recognize
         # the next page reference
         return True
-    results = response.json()
-    if results.get('resourceType') == 'Bundle':
-        return results.get('total', -1) == 0
-    # handle servers that don't set total
-    if results.get('resourceType') == 'Bundle' and not results.get('entry'):
-        return True
-    return False
+    return empty_body(response.content)
+
+
+def not_modified(response):
+    """Pass upstream `304 Not Modified` through to the client"""
+    return Response(status=304, headers=response_validators(response))
+
+
+def upstream_request(url, method, headers, params=None, json=None, coalesce_key=None, read_timeout=None):
+    """Fire request at upstream FHIR server
+
+    :param coalesce_key: if given, identical concurrent GET requests sharing
+        the key are coalesced into a single upstream request, revalidating
+        any prior response stored under the key
+    :param read_timeout: seconds, in place of the shared client's default
+
+    Coalesced requests may be served from the last good response, see
+    `proxycache.serve_stale`
+
+    :returns: executed request - caller responsible for handling errors
+    """
+    timeout = None
+    if read_timeout is not None:
+        timeout = (current_app.config['HTTP_CONNECT_TIMEOUT'], read_timeout)
+
+    def send(request_headers):
+        return http_session().request(
+            url=url, method=method, headers=request_headers, params=params, json=json,
+            timeout=timeout)
+
+    if method != 'GET' or coalesce_key is None:
+        return send(headers)
+    return serve_stale(coalesce_key, lambda: coalesce(
+        coalesce_key, lambda: conditional_request(coalesce_key, headers, send)))
+
+
+def merge_requested(method, request_path):
+    """Determine if request should be merged across all sources
+
+    Only type level searches are merged; reads and page requests are
+    handled by the launch then first non-empty secondary source.
+    """
+    return (
+        current_app.config['SECONDARY_SOURCE_MODE'] == 'merge' and
+        method == 'GET' and
+        request_path and
+        '/' not in request_path.strip('/'))
+
+
+def merged_search(
+        iss, launch, secondary_sources, req_scope, relative_path, patient_id, headers):
+    """Query launch and all secondary sources in parallel, merging results
+
+    :param iss: FHIR base url of the launch server
+    :param launch: callable firing request at the launch server, None if not
+        allowed on the launch server
+    :param secondary_sources: strategies for the launch server, see `strategy_registry`
+    :param req_scope: scope of request, see `scope.request_scope`
+    :param relative_path: FHIR request path
+    :param patient_id: launch patient id
+    :param headers: headers to include in upstream requests
+
+    `next` links of each source are followed, up to `MERGED_SEARCH_MAX_PAGES`
+    per source, see `collate_results` for Bundles with pages remaining
+
+    :returns: response of a searchset Bundle with entries from every source
+        having results, serialized an entry at a time (see `stream_bundle`)
+    """
+    fhir_logger = getLogger()
+    session_id = g.session_id
+    original_request = request._get_current_object()
+
+    def in_request_context(fn):
+        @copy_current_request_context
+        def wrapped():
+            g.session_id = session_id
+            return fn()
+        return wrapped
+
+    def admitted(source_name, fn):
+        def wrapped():
+            with admit(source_name, session_id):
+                return fn()
+        return wrapped
+
+    calls = []
+    if launch:
+        calls.append((None, in_request_context(admitted(LAUNCH_SOURCE, launch))))
+    for source in secondary_sources:
+        if not source.translated_patient_id():
+            continue
+        if not source.allowed_request(req_scope):
+            continue
+        calls.append((source, in_request_context(admitted(
+            source.name,
+            lambda source=source: source.server_request(
+                request_path=relative_path,
+                launch_patient_id=patient_id,
+                headers=headers,
+                original_request=original_request)))))
+
+    result_sets, served_by = [], []
+    if calls:
+        with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+            futures = [(source, executor.submit(fn)) for source, fn in calls]
+
+        for source, future in futures:
+            try:
+                response = future.result()
+            except BulkheadFull:
+                if source is None or not skip_full_sources():
+                    raise
+                current_app.logger.warning(f"skipping full source {source.name}")
+                continue
+            if source is None:
+                if empty_response(response):
+                    continue
+                response.raise_for_status()
+                launch_cache.persist(response.json())
+                fhir_name = "LAUNCH FHIR"
+            else:
+                response.raise_for_status()
+                if source.empty_response(response):
+                    continue
+                fhir_name = source.name
+            served_by.append(LAUNCH_SOURCE if source is None else source.name)
+
+            fhir_logger.info({
+                "message": "response",
+                "fhir_server": fhir_name,
+                "fhir": response.json()})
+            result_sets.append((source, [response.json()]))
+
+    # follow each source's remaining pages, sources in parallel
+    max_pages = current_app.config['MERGED_SEARCH_MAX_PAGES']
+    paged = [(source, pages) for source, pages in result_sets if next_link(pages[0])]
+    next_urls = []
+    if paged:
+        with ThreadPoolExecutor(max_workers=len(paged)) as executor:
+            futures = [executor.submit(in_request_context(
+                lambda source=source, bundle=pages[0]: follow_pages(
+                    bundle,
+                    iss if source is None else source.server_url(),
+                    headers,
+                    max_pages)))
+                for source, pages in paged]
+
+        # pages of a source stay together, preserving the source precedence of dedupe
+        for (source, pages), future in zip(paged, futures):
+            bundles, next_url = future.result()
+            if source is None:
+                for bundle in bundles:
+                    launch_cache.persist(bundle)
+            pages.extend(bundles)
+            if next_url:
+                next_urls.append(next_url)
+
+    bundle = collate_results(
+        *(page for _, pages in result_sets for page in pages), next_urls=next_urls)
+    return Response(
+        stream_bundle(bundle), mimetype='application/json',
+        headers={'X-Served-By': ', '.join(served_by)} if served_by else None)
+
+
+def batch_requested(relative_path):
+    """True if request is a FHIR batch Bundle POSTed to the router base"""
+    if request.method != 'POST' or relative_path.strip('/'):
+        return False
+    body = request.get_json(silent=True)
+    return isinstance(body, dict) and body.get('resourceType') == 'Bundle'
+
+
+def operation_outcome(message):
+    """FHIR OperationOutcome describing a failed batch entry"""
+    return {
+        'resourceType': 'OperationOutcome',
+        'issue': [{'severity': 'error', 'code': 'processing', 'diagnostics': message}]}
+
+
+def batch_entry_response(entry, session_id, app, headers, base_url):
+    """Execute a single batch entry via `route_fhir`, in a request context of its own
+
+    :param entry: batch Bundle entry
+    :param session_id: session of the batch request
+    :param app: flask app
+    :param headers: headers of the batch request, applied to every entry
+    :param base_url: scheme and host of the batch request
+
+    :returns: batch-response entry, with the entry `resource` and `response`
+    """
+    entry_request = entry.get('request') or {}
+    method = entry_request.get('method', '').upper()
+    url = entry_request.get('url', '')
+    path, _, query_string = url.lstrip('/').partition('?')
+    if method not in SUPPORTED_METHODS or not path or '://' in url:
+        return {'response': {'status': '400 Bad Request', 'outcome': operation_outcome(
+            "batch entries require a supported `request.method` and relative `request.url`")}}
+
+    entry_headers = dict(headers)
+    if entry_request.get('ifNoneMatch'):
+        entry_headers['If-None-Match'] = entry_request['ifNoneMatch']
+    if entry_request.get('ifModifiedSince'):
+        entry_headers['If-Modified-Since'] = entry_request['ifModifiedSince']
+
+    builder = EnvironBuilder(
+        path=f"/fhir-router/{session_id}/{path}",
+        base_url=base_url,
+        method=method,
+        headers=entry_headers,
+        query_string=query_string,
+        json=entry.get('resource') if method in ('POST', 'PUT') else None)
+    with app.request_context(builder.get_environ()):
+        try:
+            response = route_fhir(relative_path=path, session_id=session_id)
+        except BulkheadFull as ex:
+            response = bulkhead_full(ex)
+        except HTTPException as ex:
+            response = ex.get_response()
+        except requests.exceptions.HTTPError as ex:
+            response = Response(
+                status=ex.response.status_code, response=ex.response.content,
+                mimetype='application/json')
+        except Exception as ex:
+            current_app.logger.exception(ex)
+            response = jsonify(operation_outcome(str(ex)))
+            response.status_code = 500
+
+    result = {'response': {'status': response.status}}
+    for header, field in (('ETag', 'etag'), ('Last-Modified', 'lastModified')):
+        if header in response.headers:
+            result['response'][field] = response.headers[header]
+    body = response.get_json(silent=True) if response.status_code != 304 else None
+    if body is not None:
+        if response.status_code < 400:
+            result['resource'] = body
+        else:
+            result['response']['outcome'] = body
+    return result
+
+
+def batch_response(session_id, bundle):
+    """Execute entries of a FHIR `batch` Bundle, returning the `batch-response` Bundle
+
+    Each entry is routed as an individual request to the router would be,
+    with the same scope checks and launch / secondary source handling.
+    Entries are independent; up to `FHIR_BATCH_CONCURRENCY` execute at once.
+    """
+    if bundle.get('type') != 'batch':
+        return jsonify_abort(status_code=400, message="only `batch` Bundles are supported")
+    entries = bundle.get('entry') or []
+    if len(entries) > current_app.config['FHIR_BATCH_MAX_ENTRIES']:
+        return jsonify_abort(
+            status_code=413,
+            message=f"batch exceeds {current_app.config['FHIR_BATCH_MAX_ENTRIES']} entries")
+
+    app = current_app._get_current_object()
+    headers = {
+        header_name: request.headers[header_name] for header_name in PROXY_HEADERS
+        if header_name in request.headers and header_name != 'Content-Type'}
+
+    base_url = request.host_url
+
+    def execute(entry):
+        return batch_entry_response(entry, session_id, app, headers, base_url)
+
+    results = []
+    if entries:
+        workers = min(len(entries), current_app.config['FHIR_BATCH_CONCURRENCY'])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(execute, entries))
+    return {'resourceType': 'Bundle', 'type': 'batch-response', 'entry': results}
 
 
 @blueprint.route('/fhir-router/', defaults={'relative_path': '', 'session_id': None}, methods=SUPPORTED_METHODS)
 @blueprint.route('/fhir-router/<string:session_id>/<path:relative_path>', methods=SUPPORTED_METHODS)
 @blueprint.route('/fhir-router/<string:session_id>/', defaults={'relative_path': ''}, methods=SUPPORTED_METHODS)
-@cross_origin(allow_headers=PROXY_HEADERS)
+@cross_origin(allow_headers=PROXY_HEADERS, expose_headers=('X-Served-By',))
 def route_fhir(relative_path, session_id):
-    from confidential_backend.cachelaunchresponse import persist_response
     g.session_id = session_id
     current_app.logger.debug('received session_id as path parameter: %s', session_id)
 
+    if batch_requested(relative_path):
+        return batch_response(session_id, request.get_json())
+
+    if request.method != 'GET' and current_app.config['PREFETCH_PROFILE']:
+        # writes may leave prewarmed responses stale
+        discard_prewarmed(session_id)
+
     if relative_path == '':
         # when the relative path beyond the flask route and session_id is only
         # query string parameters, the route parsing fails to pick them up.  rebuild
         relative_path = '?' + request.query_string.decode() if request.query_string else ''
 
     # prefer patient ID baked into access token JWT by EHR; fallback to initial transparent launch token for fEMR
-    patient_id = get_session_value('token_response', {}).get('patient') or get_session_value('launch_token_patient')
+    token_response = fresh_token_response(session_id, get_session_value('token_response', {}))
+    patient_id = (token_response or {}).get('patient') or get_session_value('launch_token_patient')
     if not patient_id:
         return jsonify_abort(status_code=400, message="no patient ID found in session; can't continue")
 
@@ -78,6 +471,8 @@ def route_fhir(relative_path, session_id):
     if not iss:
         return jsonify_abort(status_code=400, message="no iss found in session; can't continue")
 
+    secondary_sources = strategy_registry.for_issuer(iss)
+
     # use EHR FHIR server from launch
     # use session lookup across sessions if necessary
     upstream_fhir_base_url = iss
@@ -86,6 +481,9 @@ def route_fhir(relative_path, session_id):
     for header_name in PROXY_HEADERS:
         if header_name in request.headers:
             upstream_headers[header_name] = request.headers[header_name]
+    if 'Authorization' in upstream_headers:
+        upstream_headers['Authorization'] = upstream_authorization(
+            upstream_headers['Authorization'], token_response)
 
     if current_app.config['DEBUG_FHIR_REQUESTS']:
         current_app.logger.debug(
@@ -96,7 +494,7 @@ def route_fhir(relative_path, session_id):
 
     fhir_logger = getLogger()
     try:
-        allowed_scopes = scopes(current_app.config['LAUNCH_FHIR_SCOPES'])
+        allowed_scopes = configured_scopes(current_app.config['LAUNCH_FHIR_SCOPES'])
     except ValueError as ve:
         current_app.logger.error(
             f"invalid LAUNCH_FHIR_SCOPES: {current_app.config['LAUNCH_FHIR_SCOPES']} "
@@ -106,14 +504,77 @@ def route_fhir(relative_path, session_id):
         context="patient", request_path=relative_path, http_method=request.method)
     allowed_launch_request = request_allowed(req_scope, allowed_scopes)
 
-    if allowed_launch_request:
-        upstream_response = requests.request(
+    # relative_path only includes the query string when rebuilt above
+    request_path = relative_path.split('?')[0]
+    query_string = request.query_string.decode()
+
+    launch_key = request_key(
+        base_url=iss,
+        relative_path=request_path,
+        query_string=query_string,
+        patient_id=patient_id,
+        authorization=upstream_headers.get('Authorization'),
+        accept=upstream_headers.get('Accept'))
+
+    merge = merge_requested(request.method, request_path)
+    if merge:
+        # merged Bundles aren't the representation of any one upstream server
+        for header in CONDITIONAL_HEADERS:
+            upstream_headers.pop(header, None)
+
+    # requests bearing the client's own validators pass straight through,
+    # as the (possibly 304) response is specific to the client
+    client_conditional = any(header in upstream_headers for header in CONDITIONAL_HEADERS)
+
+    def launch_request(read_timeout=None):
+        return upstream_request(
             url=upstream_fhir_url,
             method=request.method,
             headers=upstream_headers,
             params=request.args,
-            json=request.json if request.method in ('POST', 'PUT') else None
+            json=request.json if request.method in ('POST', 'PUT') else None,
+            coalesce_key=None if client_conditional else launch_key,
+            read_timeout=read_timeout,
         )
+
+    if merge:
+        return merged_search(
+            iss=iss,
+            launch=launch_request if allowed_launch_request else None,
+            secondary_sources=secondary_sources,
+            req_scope=req_scope,
+            relative_path=relative_path,
+            patient_id=patient_id,
+            headers=upstream_headers)
+
+    page_prefetch = current_app.config['PAGE_PREFETCH_ENABLED'] and request.method == 'GET'
+    prefetched = prewarmed = None
+    served_by = LAUNCH_SOURCE
+    if allowed_launch_request and request.method == 'GET':
+        if current_app.config['PREFETCH_PROFILE']:
+            # responses prewarmed after authorization are already persisted
+            prewarmed = cached_response(launch_key)
+        if prewarmed is None and page_prefetch:
+            prefetched = cached_page(session_id, request_path, query_string)
+
+    if prewarmed is not None:
+        upstream_response = prewarmed
+    elif prefetched is not None:
+        upstream_response = prefetched
+    elif allowed_launch_request and request.method == 'GET':
+        def admitted_launch_request(read_timeout):
+            with admit(LAUNCH_SOURCE, session_id):
+                return launch_request(read_timeout)
+
+        upstream_response, served_by = launch_cache.read_through(
+            request_path, query_string, admitted_launch_request)
+        if upstream_response.status_code == 304:
+            return not_modified(upstream_response)
+    elif allowed_launch_request:
+        with admit(LAUNCH_SOURCE, session_id):
+            upstream_response = launch_request()
+        if upstream_response.status_code == 304:
+            return not_modified(upstream_response)
     if not allowed_launch_request or empty_response(upstream_response) and secondary_sources:
         # If no results found from upstream (aka LAUNCH) FHIR server, try secondary
         secondary_response = None
@@ -125,13 +586,22 @@ def route_fhir(relative_path, session_id):
             if not source.allowed_request(req_scope):
                 continue
 
-            secondary_response = source.server_request(
-                request_path=relative_path,
-                launch_patient_id=patient_id,
-                headers=upstream_headers,
-                original_request=request
-            )
+            try:
+                with admit(source.name, session_id):
+                    secondary_response = source.server_request(
+                        request_path=relative_path,
+                        launch_patient_id=patient_id,
+                        headers=upstream_headers,
+                        original_request=request
+                    )
+            except BulkheadFull:
+                if not skip_full_sources():
+                    raise
+                current_app.logger.warning(f"skipping full source {source.name}")
+                continue
             secondary_response.raise_for_status()
+            if secondary_response.status_code == 304:
+                return not_modified(secondary_response)
             fhir_logger.info({
                 "message": "response",
                 "fhir_server": source.name,
@@ -141,7 +611,10 @@ def route_fhir(relative_path, session_id):
                 break
 
         if secondary_response:
-            return secondary_response.json()
+            return secondary_response.json(), {
+                **response_validators(secondary_response),
+                **staleness_headers(secondary_response),
+                'X-Served-By': source.name}
 
     upstream_response.raise_for_status()
     if relative_path.startswith('Patient'):
@@ -150,10 +623,29 @@ def route_fhir(relative_path, session_id):
         for source in secondary_sources:
             source.lookup_identified_patient(upstream_response.json())
 
-    persist_response.delay(upstream_response.json())
+    results = upstream_response.json()
+    if served_by == LAUNCH_CACHE_SOURCE:
+        # paging links name the cache server, which isn't reachable through the proxy
+        results.pop('link', None)
+        fhir_logger.info({
+            "message": "response",
+            "fhir_server": "LAUNCH CACHE",
+            "fhir": results})
+        return results, {'X-Served-By': served_by}
+
+    if prewarmed is None:
+        launch_cache.persist(upstream_response.json())
     fhir_logger.info({
         "message": "response",
         "fhir_server": "LAUNCH FHIR",
         "fhir": upstream_response.json()})
 
-    return upstream_response.json()
+    if page_prefetch and results.get('resourceType') == 'Bundle':
+        if prefetched is None and prewarmed is None:
+            start_prefetch(results, iss, upstream_headers, patient_id, session_id)
+        rewrite_links(results, iss, url_for(
+            'fhir.route_fhir', session_id=session_id, relative_path='', _external=True))
+    return results, {
+        **response_validators(upstream_response),
+        **staleness_headers(upstream_response),
+        'X-Served-By': served_by}
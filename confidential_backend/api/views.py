@@ -1,19 +1,78 @@
 from flask import Blueprint, current_app, jsonify, request
+import hmac
 import json
 import logging
 import os
 import uuid
 
-from confidential_backend.audit import audit_entry
+from confidential_backend import warmup
+from confidential_backend.audit import RESERVED_KEYS, audit_entries, audit_entry
+from confidential_backend.capturestore import capture_record, capture_store
+from confidential_backend.httpclient import host_metrics
+from confidential_backend.profiling import profile_files, profile_report
 
 base_blueprint = Blueprint('base', __name__)
 
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+
 
 @base_blueprint.route('/')
 def root():
     return {'ok': True}
 
 
+@base_blueprint.route('/metrics/upstream')
+def upstream_metrics():
+    """Request counts and latency per upstream host, for this worker process"""
+    if not admin_authorized():
+        return jsonify(message="Unauthorized"), 401
+    return host_metrics.snapshot()
+
+
+@base_blueprint.route('/ready')
+def ready():
+    """Readiness check; 503 until worker warm up completes"""
+    if not warmup.ready.is_set():
+        return {'ready': False}, 503
+    return {'ready': True}
+
+
+def admin_authorized():
+    """True if request bears the configured `ADMIN_TOKEN`"""
+    token = current_app.config['ADMIN_TOKEN']
+    scheme, _, presented = request.headers.get('Authorization', '').partition(' ')
+    return bool(token) and scheme.lower() == 'bearer' and hmac.compare_digest(
+        presented.encode('utf-8'), token.encode('utf-8'))
+
+
+@base_blueprint.route('/admin/profiles')
+def profiles():
+    """List profiles and allocation reports written by sampled requests, newest first"""
+    if not admin_authorized():
+        return jsonify(message="Unauthorized"), 401
+    return jsonify(profiles=profile_files())
+
+
+@base_blueprint.route('/admin/profiles/<string:name>')
+def profile(name):
+    """Return text report of the named profile
+
+    `sort` and `limit` query parameters control the functions included
+    """
+    if not admin_authorized():
+        return jsonify(message="Unauthorized"), 401
+    try:
+        report = profile_report(
+            name,
+            sort=request.args.get('sort', 'cumulative'),
+            limit=request.args.get('limit', 50, type=int))
+    except FileNotFoundError:
+        return jsonify(message=f"no profile named {name}"), 404
+    except KeyError:
+        return jsonify(message=f"invalid sort: {request.args['sort']}"), 400
+    return current_app.response_class(report, mimetype='text/plain')
+
+
 @base_blueprint.route('/auditlog', methods=('POST',))
 def auditlog_addevent():
     """Add event to audit log
@@ -22,6 +81,11 @@ def auditlog_addevent():
     will land in the same audit log as any auditable internal event, including
     recording the authenticated user making the call.
 
+    Bursts of events may be posted together, as a JSON array or NDJSON
+    (`Content-Type: application/x-ndjson`) body, each event validated in
+    turn.  Valid events are logged as a single batch; the response includes
+    the count accepted and the `index` and `message` of any rejected.
+
     Returns a json friendly message, i.e. {"message": "ok"} or details on error
     ---
     operationId: auditlog_addevent
@@ -66,20 +130,63 @@ def auditlog_addevent():
       - ServiceToken: []
 
     """
-    body = request.get_json()
+    if request.mimetype in NDJSON_MIMETYPES:
+        try:
+            body = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            return jsonify(message="Invalid NDJSON data"), 400
+    else:
+        body = request.get_json()
     if not body:
         return jsonify(message="Missing JSON data"), 400
 
-    message = body.pop('message', None)
-    level = body.pop('level', 'info')
-    if not hasattr(logging, level.upper()):
-        return jsonify(message="Unknown logging `level`: {level}"), 400
-    if not message:
-        return jsonify(message="missing required 'message' in post"), 400
+    if isinstance(body, dict):
+        entry = validate_event(body)
+        if isinstance(entry, str):
+            return jsonify(message=entry), 400
+        audit_entry(*entry)
+        return jsonify(message='ok')
+    if not isinstance(body, list):
+        return jsonify(message="expected JSON object or array of events"), 400
 
-    extra = {k: v for k, v in body.items()}
-    audit_entry(message, level, extra)
-    return jsonify(message='ok')
+    if len(body) > current_app.config['AUDITLOG_MAX_BATCH']:
+        return jsonify(
+            message=f"batch exceeds {current_app.config['AUDITLOG_MAX_BATCH']} events"), 413
+
+    entries, errors = [], []
+    for index, event in enumerate(body):
+        entry = validate_event(event)
+        if isinstance(entry, str):
+            errors.append({'index': index, 'message': entry})
+        else:
+            entries.append(entry)
+    if not entries:
+        return jsonify(message="no valid events", errors=errors), 400
+
+    audit_entries(entries)
+    return jsonify(message='ok', accepted=len(entries), errors=errors)
+
+
+def validate_event(event):
+    """Validate a single audit event as posted to `/auditlog`
+
+    :returns: (message, level, extra) tuple suitable for `audit_entry`, or
+        a string describing the problem
+    """
+    if not isinstance(event, dict):
+        return "event must be a JSON object"
+    extra = dict(event)
+    message = extra.pop('message', None)
+    level = extra.pop('level', 'info')
+    if not isinstance(level, str) or not isinstance(
+            logging.getLevelName(level.upper()), int):
+        return f"Unknown logging `level`: {level}"
+    if not message:
+        return "missing required 'message' in post"
+    reserved = sorted(RESERVED_KEYS.intersection(extra))
+    if reserved:
+        return f"reserved key(s) not allowed: {', '.join(reserved)}"
+    return message, level, extra
 
 
 @base_blueprint.route('/save_data', methods=('POST',))
@@ -90,6 +197,9 @@ def save_data():
     Intended use: front-end can capture data at any point and write
     to disk for testing & verification.
 
+    With `SAVE_DATA_MODE` "ndjson", captures are appended to the capture
+    store rather than written to individual files; see `/save_data/<filename>`
+
     Returns a json friendly message, i.e. {"message": "ok"} or details on error
     ---
     operationId: save_data
@@ -152,6 +262,12 @@ def save_data():
         return jsonify(
             message="no path info allowed in `filename` parameter"), 400
 
+    if current_app.config['SAVE_DATA_MODE'] == 'ndjson':
+        # appended to the capture store by its background writer
+        if not capture_store().append(capture_record(body, filename)):
+            return jsonify(message="capture queue full, try again"), 503
+        return jsonify(message='ok', captured=filename)
+
     if os.path.exists(full_path):
         pass  # overwrite by design on subsequent request
 
@@ -159,3 +275,22 @@ def save_data():
         json.dump(body, fp, indent=4)
 
     return jsonify(message='ok', saved_file=full_path)
+
+
+@base_blueprint.route('/save_data/<string:filename>')
+def saved_data(filename):
+    """Return latest capture of given filename from the capture store
+
+    Only available with `SAVE_DATA_MODE` "ndjson"; `context` query parameter
+    optionally restricts the match
+    """
+    if current_app.config["ENV"] != "development":
+        return jsonify(message="Disabled on non-dev deploys"), 401
+    if current_app.config['SAVE_DATA_MODE'] != 'ndjson':
+        return jsonify(message="capture store not enabled"), 404
+
+    store = capture_store()
+    entries = store.lookup(filename=filename, context=request.args.get('context'))
+    if not entries:
+        return jsonify(message=f"no capture found for {filename}"), 404
+    return jsonify(store.read(entries[-1]))
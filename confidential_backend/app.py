@@ -1,14 +1,19 @@
 from flask import Flask
 from flask_cors import CORS
+from flask_session.defaults import Defaults
 import logging
 from logging import config as logging_config
 import os
+import redis
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from confidential_backend import auth, api
-from confidential_backend.audit import audit_entry, audit_log_init
-from confidential_backend.dynamic_factory import load_strategies
-from confidential_backend.extensions import oauth, secondary_sources, sess
+from confidential_backend import auth, api, httpclient
+from confidential_backend.audit import EVENT_LOG_NAME, audit_entry, audit_log_init
+from confidential_backend.cachelaunchresponse import replay_dead_letters_command
+from confidential_backend.extensions import launch_cache, oauth, sess, strategy_registry
+from confidential_backend.profiling import init_profiling
+from confidential_backend.warmup import start_warm_up
+from confidential_backend.wrapped_session import SplitRedisSessionInterface
 
 
 def create_app(testing=False, cli=False):
@@ -19,15 +24,24 @@ def create_app(testing=False, cli=False):
     app.config['TESTING'] = testing
     CORS(app)
 
+    configure_http_client(app)
     configure_logging(app)
     configure_extensions(app, cli)
     register_blueprints(app)
     configure_proxy(app)
     configure_secondary_sources(app)
+    configure_warmup(app, cli)
+    configure_profiling(app)
+    register_commands(app)
 
     return app
 
 
+def configure_http_client(app):
+    """Apply timeouts, pool and DNS cache settings to the shared HTTP client"""
+    httpclient.configure(app)
+
+
 def configure_logging(app):
     app.logger  # must call to initialize prior to config or it'll replace
 
@@ -43,6 +57,8 @@ def configure_logging(app):
         extra={'tags': ['testing', 'logging', 'app']})
 
     if not app.config['LOGSERVER_URL']:
+        # no event sink; keep audit records from the root (console) handlers
+        logging.getLogger(EVENT_LOG_NAME).propagate = False
         return
 
     audit_log_init(app)
@@ -56,7 +72,23 @@ def configure_extensions(app, cli):
     """configure flask extensions
     """
     oauth.init_app(app)
+    if not app.config.get('SESSION_REDIS'):
+        # no connection is opened until first use
+        app.config['SESSION_REDIS'] = redis.from_url(app.config['SESSION_REDIS_URL'])
     sess.init_app(app)
+    launch_cache.init_app(app)
+    if app.config['SESSION_TYPE'] == 'redis':
+        # keep hot session fields addressable without loading the entire session
+        app.session_interface = SplitRedisSessionInterface(
+            app=app,
+            client=app.config['SESSION_REDIS'],
+            key_prefix=app.config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX),
+            use_signer=app.config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER),
+            permanent=app.config.get('SESSION_PERMANENT', Defaults.SESSION_PERMANENT),
+            sid_length=app.config.get('SESSION_ID_LENGTH', Defaults.SESSION_ID_LENGTH),
+            serialization_format=app.config.get(
+                'SESSION_SERIALIZATION_FORMAT', Defaults.SESSION_SERIALIZATION_FORMAT),
+        )
 
 
 def register_blueprints(app):
@@ -67,6 +99,11 @@ def register_blueprints(app):
     app.register_blueprint(api.fhir.blueprint)
 
 
+def register_commands(app):
+    """register flask cli commands"""
+    app.cli.add_command(replay_dead_letters_command)
+
+
 def configure_proxy(app):
     """Add werkzeug fixer to detect headers applied by upstream reverse proxy"""
     if app.config.get('PREFERRED_URL_SCHEME', '').lower() == 'https':
@@ -83,4 +120,16 @@ def configure_proxy(app):
 
 def configure_secondary_sources(app):
     """Add any configured additional sources, beyond the required launch FHIR server"""
-    secondary_sources.extend(load_strategies(app))
+    strategy_registry.init_app(app)
+
+
+def configure_profiling(app):
+    """Sample requests with the profiler, if enabled"""
+    init_profiling(app)
+
+
+def configure_warmup(app, cli):
+    """Warm up worker connections and caches, see `/ready`"""
+    if cli:
+        return
+    start_warm_up(app)
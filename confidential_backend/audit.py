@@ -2,7 +2,6 @@
 
 functions to simplify adding context and extra data to log messages destined for audit logs
 """
-from copy import deepcopy
 from flask import current_app, has_app_context
 import logging
 
@@ -10,43 +9,81 @@ from confidential_backend.logserverhandler import LogServerHandler
 from confidential_backend.wrapped_session import get_session_value
 
 EVENT_LOG_NAME = "confidential_backend_event_logger"
+PHI_KEYS = ('user', 'subject', 'patient')
+# `extra` keys `Logger.makeRecord` refuses to overwrite
+RESERVED_KEYS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class AuditContextFilter(logging.Filter):
+    """Add session info, such as active user, to audit records
+
+    Attached to audit handlers, so the (potentially costly) session lookups
+    only occur for records a handler actually emits.
+    """
+    def filter(self, record):
+        if not has_app_context():
+            return True
+        for x in ('user', 'subject'):
+            value = get_session_value(x)
+            if value:
+                setattr(record, x, value)
+        if not hasattr(record, 'version'):
+            record.version = current_app.config['VERSION_STRING']
+        return True
 
 
 def audit_log_init(app):
     log_server_handler = LogServerHandler(
         jwt=app.config['LOGSERVER_TOKEN'],
         url=app.config['LOGSERVER_URL'])
+    log_server_handler.addFilter(AuditContextFilter())
     event_logger = logging.getLogger(EVENT_LOG_NAME)
     event_logger.setLevel(logging.INFO)
     event_logger.addHandler(log_server_handler)
 
 
+def echo_error(message, extra):
+    """Echo ERRORs to current_app.logger for alerts, less obvious PHI"""
+    # values aren't modified, a shallow copy suffices
+    scrubbed_extra = dict(extra or {})
+    for x in PHI_KEYS:
+        if x in scrubbed_extra:
+            scrubbed_extra[x] = 'REDACTED - see audit logs'
+    current_app.logger.error(message, extra=scrubbed_extra)
+
+
+def level_number(level):
+    levelno = logging.getLevelName(level.upper())
+    if not isinstance(levelno, int):
+        raise ValueError(f"audit_entry given bogus level: {level}")
+    return levelno
+
+
 def audit_entry(message, level='info', extra=None):
     """Log entry, adding in session info such as active user"""
-    try:
-        logger = logging.getLogger(EVENT_LOG_NAME)
-        log_at_level = getattr(logger, level.lower())
-    except AttributeError:
-        raise ValueError(f"audit_entry given bogus level: {level}")
+    levelno = level_number(level)
+    if levelno == logging.ERROR and has_app_context():
+        echo_error(message, extra)
 
-    if extra is None:
-        extra = {}
+    logger = logging.getLogger(EVENT_LOG_NAME)
+    if logger.isEnabledFor(levelno) and logger.hasHandlers():
+        logger.log(levelno, message, extra=extra)
 
-    if has_app_context():
-        for x in ('user', 'subject'):
-            value = get_session_value(x)
-            if value:
-                extra[x] = value
-        if 'version' not in extra:
-            extra['version'] = current_app.config['VERSION_STRING']
-
-        # echo ERRORs to current_app.logger for alerts
-        if level.lower() == 'error':
-            # remove obvious PHI
-            scrubbed_extra = deepcopy(extra)
-            for x in ('user', 'subject', 'patient'):
-                if x in scrubbed_extra:
-                    scrubbed_extra[x] = 'REDACTED - see audit logs'
-            current_app.logger.error(message, extra=scrubbed_extra)
-
-    log_at_level(message, extra=extra)
+
+def audit_entries(entries):
+    """Log several entries at once, see `audit_entry`
+
+    Records emitted to a `LogServerHandler` are posted in a single request.
+
+    :param entries: list of (message, level, extra) tuples
+    """
+    logger = logging.getLogger(EVENT_LOG_NAME)
+    sink = logger.hasHandlers()
+    with LogServerHandler.batching():
+        for message, level, extra in entries:
+            levelno = level_number(level)
+            if levelno == logging.ERROR and has_app_context():
+                echo_error(message, extra)
+            if sink and logger.isEnabledFor(levelno):
+                logger.handle(logger.makeRecord(
+                    logger.name, levelno, __name__, 0, message, None, None, extra=extra))
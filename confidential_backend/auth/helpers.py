@@ -1,6 +1,22 @@
+from authlib.integrations.flask_client import FlaskOAuth2App
+from authlib.integrations.requests_client import OAuth2Session
 from jose import jwt
 from jose.exceptions import JWTError
 
+from confidential_backend.httpclient import share_pool
+
+
+class PooledOAuth2Session(OAuth2Session):
+    """OAuth2 session sharing the process' pooled connections, see `httpclient`"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        share_pool(self)
+
+
+class PooledOAuth2App(FlaskOAuth2App):
+    """OAuth2 client app whose token exchange and metadata requests use pooled connections"""
+    client_cls = PooledOAuth2Session
+
 
 def format_as_jwt(encoded_payload):
     """To extract payload from ill formed JWT, package as per protocol"""
@@ -1,12 +1,16 @@
 from flask import Blueprint, current_app, g, redirect, request, url_for, session
 from flask_cors import cross_origin
+import copy
 import json
 import requests
+import time
 
 from confidential_backend import PROXY_HEADERS
 from confidential_backend.audit import audit_entry
-from confidential_backend.auth.helpers import extract_payload, format_as_jwt
+from confidential_backend.auth.helpers import PooledOAuth2App, extract_payload, format_as_jwt
 from confidential_backend.extensions import oauth
+from confidential_backend.httpclient import http_session
+from confidential_backend.prewarm import start_prewarm
 
 
 # SMIT launch token encoding scheme
@@ -56,10 +60,32 @@ def get_extension_value(url, extensions):
     raise ValueError('extension url not present in any extension', url)
 
 
+# discovered client params by FHIR base url, as (expires_at, params)
+_discovery_cache = {}
+
+
 def discover_sof_client_params(fhir_base_url):
+    """Returns SoF client params for given FHIR server, cached `DISCOVERY_CACHE_TTL` seconds
+
+    Spares each launch the round trips to the FHIR server's discovery endpoints
+    """
+    ttl = current_app.config['DISCOVERY_CACHE_TTL']
+    cached = _discovery_cache.get(fhir_base_url)
+    if cached and cached[0] > time.monotonic():
+        return copy.deepcopy(cached[1])
+
+    params = _discover_sof_client_params(fhir_base_url)
+    if ttl:
+        _discovery_cache[fhir_base_url] = (time.monotonic() + ttl, params)
+    return copy.deepcopy(params)
+
+
+def _discover_sof_client_params(fhir_base_url):
     default_client_config = {
         'name': 'sof',
-        'client_kwargs': {'scope': current_app.config['SOF_CLIENT_SCOPES']},
+        'client_kwargs': {
+            'scope': current_app.config['SOF_CLIENT_SCOPES'],
+        },
     }
 
     # explicit configuration - endpoints individually configured
@@ -84,7 +110,7 @@ def discover_sof_client_params(fhir_base_url):
     for discovery_uri in ('/.well-known/smart-configuration', '/.well-known/openid-configuration'):
         well_known_url = f"{fhir_base_url}{discovery_uri}"
         try:
-            well_known = requests.get(
+            well_known = http_session().get(
                 url=well_known_url,
                 headers={'Accept': 'application/json'},
             )
@@ -98,7 +124,7 @@ def discover_sof_client_params(fhir_base_url):
             pass
 
     # fallback to conformance statement
-    metadata = requests.get(
+    metadata = http_session().get(
         url=f"{fhir_base_url}/metadata",
         headers={'Accept': 'application/json'},
     )
@@ -115,6 +141,23 @@ def discover_sof_client_params(fhir_base_url):
     }
 
 
+def register_sof_client(sof_client_params):
+    """Register the SoF client with authlib, given client params as stored in the session
+
+    The client class and timeouts aren't session data, and are added here
+    """
+    oauth.register(**{
+        **sof_client_params,
+        'client_cls': PooledOAuth2App,
+        'client_kwargs': {
+            **sof_client_params.get('client_kwargs', {}),
+            'default_timeout': (
+                current_app.config['HTTP_CONNECT_TIMEOUT'],
+                current_app.config['HTTP_READ_TIMEOUT']),
+        },
+    })
+
+
 def bytes_to_json(byte_string):
     """generate JSON from given byte_string
 
@@ -177,7 +220,7 @@ def launch():
         session['launch_token_patient'] = launch_token_patient
 
     sof_client_params = discover_sof_client_params(fhir_base_url=iss)
-    oauth.register(**sof_client_params)
+    register_sof_client(sof_client_params)
     session['sof_client_params'] = sof_client_params
 
     # redirect URL to pass (as QS param) to EHR Authz server
@@ -223,7 +266,7 @@ def authorize():
     sof_client_params = session['sof_client_params']
     if not oauth._registry.get(sof_client_params['name']):
         oauth.init_app(current_app)
-        oauth.register(**sof_client_params)
+        register_sof_client(sof_client_params)
 
     # authlib persists OAuth client details via secure cookie
     # if not '_sof_authlib_state_' in session:
@@ -252,7 +295,19 @@ def authorize():
     frontend_url = current_app.config['LAUNCH_DEST']
 
     current_app.logger.debug('redirecting to frontend app: %s', frontend_url)
-    return redirect(frontend_url)
+    response = redirect(frontend_url)
+
+    # prewarm once the response (and session) is complete
+    session_id = g.get('session_id') or request.cookies.get(current_app.config['SESSION_COOKIE_NAME'])
+    patient_id = token_response.get('patient') or session.get('launch_token_patient')
+    app = current_app._get_current_object()
+
+    def prewarm_on_close():
+        with app.app_context():
+            start_prewarm(session_id, iss, patient_id, token_response.get('access_token'))
+
+    response.call_on_close(prewarm_on_close)
+    return response
 
 
 @blueprint.route('/auth-info')
@@ -0,0 +1,111 @@
+"""Bulkhead admission control per upstream FHIR source
+
+Each source (the launch server, and each secondary strategy by name) gets
+a limited number of concurrent requests, so a slow source can't occupy
+every worker and starve traffic to healthy ones.  A per session limit
+within each source keeps a single runaway frontend from taking all of a
+source's slots.
+
+Slots are counted per process, or across all workers when `BULKHEAD_REDIS`
+is set, by way of redis sorted sets of slot tokens.  Tokens expire after
+`BULKHEAD_SLOT_TTL` seconds, reclaiming slots of crashed workers.
+"""
+from contextlib import contextmanager
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from confidential_backend.proxycache import cache_store
+
+LAUNCH_SOURCE = 'launch'
+BULKHEAD_PREFIX = 'bulkhead:'
+
+
+class BulkheadFull(Exception):
+    """No slot available for a request to the named source"""
+    def __init__(self, source, retry_after):
+        super().__init__(f"too many concurrent requests to {source}")
+        self.source = source
+        self.retry_after = retry_after
+
+
+class LocalSlots(object):
+    """Per process slot counts"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def acquire(self, key, limit):
+        with self._lock:
+            if self._counts.get(key, 0) >= limit:
+                return None
+            self._counts[key] = self._counts.get(key, 0) + 1
+            return key
+
+    def release(self, key, token):
+        with self._lock:
+            self._counts[key] -= 1
+
+
+class RedisSlots(object):
+    """Slots shared by all workers; a sorted set of tokens, scored by acquisition time"""
+    def acquire(self, key, limit):
+        ttl = current_app.config['BULKHEAD_SLOT_TTL']
+        token = uuid.uuid4().hex
+        now = time.time()
+        store = cache_store()
+        _, _, count, _ = (
+            store.pipeline(transaction=True)
+            .zremrangebyscore(key, 0, now - ttl)
+            .zadd(key, {token: now})
+            .zcard(key)
+            .expire(key, ttl)
+            .execute())
+        if count > limit:
+            store.zrem(key, token)
+            return None
+        return token
+
+    def release(self, key, token):
+        cache_store().zrem(key, token)
+
+
+local_slots = LocalSlots()
+redis_slots = RedisSlots()
+
+
+def source_limit(source):
+    """Returns the concurrency limit for the named source"""
+    return current_app.config['BULKHEAD_LIMITS'].get(
+        source, current_app.config['BULKHEAD_DEFAULT_LIMIT'])
+
+
+@contextmanager
+def admit(source, session_id=None):
+    """Hold a slot for the named source (and session) for the duration of the block
+
+    :raises BulkheadFull: if no slot is available; never blocks waiting
+    """
+    if not current_app.config['BULKHEAD_ENABLED']:
+        yield
+        return
+
+    slots = redis_slots if current_app.config['BULKHEAD_REDIS'] else local_slots
+    limits = [(f"{BULKHEAD_PREFIX}{source}", source_limit(source))]
+    session_limit = current_app.config['BULKHEAD_SESSION_LIMIT']
+    if session_id and session_limit:
+        limits.append((f"{BULKHEAD_PREFIX}{source}:{session_id}", session_limit))
+
+    held = []
+    try:
+        for key, limit in limits:
+            token = slots.acquire(key, limit)
+            if token is None:
+                raise BulkheadFull(source, current_app.config['BULKHEAD_RETRY_AFTER'])
+            held.append((key, token))
+        yield
+    finally:
+        for key, token in held:
+            slots.release(key, token)
@@ -0,0 +1,98 @@
+"""Classify FHIR response bodies as empty without parsing the entire document
+
+Deciding whether to try secondary sources only requires the top level
+`resourceType`, `total` and whether `entry` holds anything.  FHIR servers
+serialize elements in the order defined by the specification, placing
+these ahead of the (potentially large) entry contents, so a scan of the
+document head typically suffices.  Documents not decided within the head
+fall back to a full parse.
+"""
+import json
+import re
+
+# bytes of the body scanned prior to falling back to a full parse
+HEAD_SIZE = 8192
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def skip_whitespace(text, idx):
+    return _whitespace.match(text, idx).end()
+
+
+def scan_head(text):
+    """Decide emptiness from the top level members found in given (head of) JSON text
+
+    Top level members are decoded one at a time; only the opening of the
+    `entry` array is inspected.
+
+    :returns: True if empty, False if not, None if undecided (as when the
+        deciding members lie beyond the given text)
+    """
+    try:
+        idx = skip_whitespace(text, 0)
+        if text[idx] != '{':
+            return None
+        idx += 1
+        members = {}
+        while True:
+            idx = skip_whitespace(text, idx)
+            if text[idx] == '}':
+                break
+            if text[idx] == ',':
+                idx = skip_whitespace(text, idx + 1)
+
+            key, idx = _decoder.raw_decode(text, idx)
+            idx = skip_whitespace(text, idx)
+            if text[idx] != ':':
+                return None
+            idx = skip_whitespace(text, idx + 1)
+
+            if key == 'entry':
+                if text[idx] != '[':
+                    return None
+                after = skip_whitespace(text, idx + 1)
+                if text[after] != ']':
+                    # entries present; non-empty unless contradicted by `total`
+                    # (total of 0 with entries isn't expected; entries win)
+                    return False
+                idx = after + 1
+                continue
+
+            value, idx = _decoder.raw_decode(text, idx)
+            members[key] = value
+            if key == 'resourceType' and value != 'Bundle':
+                return False
+            if key == 'total' and members.get('resourceType') == 'Bundle':
+                return value == 0
+    except (IndexError, ValueError):
+        # head truncated mid value
+        return None
+
+    # complete document within head
+    return empty_results(members)
+
+
+def empty_results(results):
+    """Decide emptiness given parsed results"""
+    if results.get('resourceType') != 'Bundle':
+        return False
+    if 'total' in results:
+        return results['total'] == 0
+    # handle servers that don't set total
+    return not results.get('entry')
+
+
+def empty_body(content, head_size=HEAD_SIZE):
+    """Determine if FHIR response body is an empty Bundle
+
+    :param content: response body, as bytes
+    :param head_size: bytes to scan prior to falling back to a full parse
+    :returns: True if given an empty Bundle, False otherwise
+    """
+    # a multi-byte character split at head_size is dropped, not an error
+    decided = scan_head(content[:head_size].decode('utf-8', errors='ignore'))
+    if decided is not None:
+        return decided
+    return empty_results(json.loads(content))
@@ -1,13 +1,39 @@
-"""Persist all resources received from the launch URL FHIR server"""
+"""Persist all resources received from the launch URL FHIR server
+
+With `LAUNCH_CACHE_READ_MODE` set, GETs are also served back from the
+cache server, see `read_through`
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import threading
+import time
+
+import click
 import requests
 from celery.utils.log import get_task_logger
+from celery.utils.time import get_exponential_backoff_interval
 from flask import current_app
+from flask.cli import with_appcontext
 
+from confidential_backend.bulkhead import LAUNCH_SOURCE, BulkheadFull
 from confidential_backend.celery_factory import create_celery
+from confidential_backend.dynamic_factory import load_class
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import cache_store, store_error
 
 logger = get_task_logger(__name__)
 celery = create_celery()
 
+PERSISTED_PREFIX = 'persisted:'
+IDEMPOTENCY_SYSTEM = 'urn:confidential-backend:persist-key'
+# time resources were last persisted (or found current) at the cache server, see `fresh`
+PERSISTED_AT_PREFIX = 'persisted-at:'
+# responses worth retrying; others are dead lettered immediately
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# names the cache server in `X-Served-By` response headers
+LAUNCH_CACHE_SOURCE = 'launch-cache'
+
 @celery.task
 def persist_response(response):
     if not "resourceType" in response:
@@ -16,45 +42,394 @@ def persist_response(response):
     persist_bundle(response)
 
 
-def persist_resource(resource):
-    """Given any single resource, persist to the cache URL"""
+class DestinationLimit(object):
+    """Bound concurrent requests and request rate to a single cache server
+
+    Shared by all tasks and threads within a worker process; use as a
+    context manager around each request.
+    """
+    def __init__(self, concurrency, rate_limit):
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._rate = rate_limit
+        self._tokens = max(1.0, rate_limit)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take_token(self):
+        """Block until the token bucket permits another request"""
+        if not self._rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    max(1.0, self._rate),
+                    self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        self._take_token()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._semaphore.release()
+
+
+_destination_limits = {}
+_destination_limits_lock = threading.Lock()
+
+
+def destination_limit(base):
+    """Returns the process wide `DestinationLimit` for given cache server"""
+    with _destination_limits_lock:
+        if base not in _destination_limits:
+            _destination_limits[base] = DestinationLimit(
+                concurrency=current_app.config["LAUNCH_CACHE_CONCURRENCY"],
+                rate_limit=current_app.config["LAUNCH_CACHE_RATE_LIMIT"])
+        return _destination_limits[base]
+
+
+class PersistError(Exception):
+    """Failure to persist to the cache server; `retryable` if likely transient"""
+    def __init__(self, message, retryable):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def idempotency_key(resource, base):
+    """Returns key identifying the given content at the given cache server"""
+    canonical = json.dumps(resource, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f"{base}\n{canonical}".encode('utf-8')).hexdigest()
+
+
+def persist_resource(resource, base=None):
+    """Given any single resource, persist to the cache URL
+
+    Content already persisted (within `LAUNCH_CACHE_IDEMPOTENCY_TTL`) is
+    skipped, making repeat persists and retries safe.  Either way, the time
+    is recorded for resources other than Bundles, see `record_persisted`.
+
+    :param resource: FHIR resource to persist; a Bundle is persisted as is
+    :param base: cache server base url, `LAUNCH_CACHE_URL` by default
+    :raises PersistError: on failure
+    """
+    base = base or current_app.config["LAUNCH_CACHE_URL"]
+    key = idempotency_key(resource, base)
+    store = cache_store()
+    if store.get(f"{PERSISTED_PREFIX}{key}"):
+        # the cache server holds this very content
+        record_persisted(resource, base)
+        return
+
     resource_type = resource["resourceType"]
+    if resource_type == "Bundle":
+        # POST isn't idempotent; conditionally create on an identifier derived from the key
+        resource = dict(resource, identifier={'system': IDEMPOTENCY_SYSTEM, 'value': key})
+        request_args = {
+            'method': 'POST',
+            'url': f"{base}/Bundle",
+            'headers': {'If-None-Exist': f"identifier={IDEMPOTENCY_SYSTEM}|{key}"},
+        }
+    else:
+        # Always PUT with given ID, in order to prevent duplicates
+        request_args = {
+            'method': 'PUT',
+            'url': f"{base}/{resource_type}/{resource['id']}",
+        }
 
-    # Always PUT with given ID, in order to prevent duplicates
-    base = current_app.config["LAUNCH_CACHE_URL"]
-    id = resource["id"]
-    put_url = f"{base}/{resource_type}/{id}"
-    try:
-        response = requests.put(put_url, json=resource)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        logger.error(
-            f"HTTP error on persist: {response.status_code} {response.reason}")
-        logger.error(f"{response.text[:500]}")
+    try:
+        with destination_limit(base):
+            response = http_session().request(json=resource, **request_args)
     except requests.exceptions.RequestException as err:
-        logger.error(f"Request failed: {err}")
+        raise PersistError(f"Request failed: {err}", retryable=True)
+    if not response.ok:
+        raise PersistError(
+            f"HTTP error on persist: {response.status_code} {response.reason} "
+            f"{response.text[:500]}",
+            retryable=response.status_code in RETRYABLE_STATUS)
+
+    store.set(
+        f"{PERSISTED_PREFIX}{key}", 1,
+        ex=current_app.config["LAUNCH_CACHE_IDEMPOTENCY_TTL"])
+    record_persisted(resource, base)
+
+
+def persisted_at_key(resource, base):
+    return f"{PERSISTED_AT_PREFIX}{base}/{resource.get('resourceType')}/{resource.get('id')}"
+
+
+def record_persisted(resource, base):
+    """Record given resource as current at the cache server, for `LAUNCH_CACHE_FRESHNESS` seconds
+
+    Kept beside rather than within the resource, as `meta.lastUpdated`
+    isn't bumped by PUTs of unchanged content, and idempotent persists
+    skip the PUT altogether.
+    """
+    ttl = current_app.config['LAUNCH_CACHE_FRESHNESS']
+    if resource['resourceType'] == 'Bundle' or ttl <= 0:
+        return
+    cache_store().set(persisted_at_key(resource, base), time.time(), ex=ttl)
+
+
+def retry_countdown(retries):
+    """Seconds to wait prior to given retry; exponential backoff with full jitter"""
+    return get_exponential_backoff_interval(
+        factor=current_app.config["LAUNCH_CACHE_RETRY_BACKOFF"],
+        retries=retries,
+        maximum=current_app.config["LAUNCH_CACHE_RETRY_BACKOFF_MAX"],
+        full_jitter=True)
+
+
+@celery.task(bind=True)
+def persist_retry(self, resource, base):
+    """Retry persisting a single resource, dead lettered once retries are exhausted"""
+    try:
+        persist_resource(resource, base=base)
+    except PersistError as err:
+        max_retries = current_app.config["LAUNCH_CACHE_MAX_RETRIES"]
+        if not err.retryable or self.request.retries >= max_retries:
+            dead_letter(resource, base, str(err))
+            return
+        logger.warning(f"retry {self.request.retries + 1} of persist: {err}")
+        raise self.retry(
+            exc=err,
+            countdown=retry_countdown(self.request.retries + 1),
+            max_retries=max_retries)
+
+
+def persist_or_defer(resource, base):
+    """Persist given resource, scheduling a retry or dead lettering on failure"""
+    try:
+        persist_resource(resource, base=base)
+    except PersistError as err:
+        logger.warning(f"failed to persist {resource['resourceType']}: {err}")
+        if not err.retryable:
+            dead_letter(resource, base, str(err))
+            return
+        persist_retry.apply_async((resource, base), countdown=retry_countdown(0))
+
+
+def dead_letter(resource, base, reason):
+    """Push resource that couldn't be persisted onto the dead letter queue"""
+    logger.error(f"dead lettering {resource['resourceType']}: {reason}")
+    cache_store().rpush(
+        current_app.config["LAUNCH_CACHE_DEAD_LETTER_KEY"],
+        json.dumps({
+            'resource': resource,
+            'base': base,
+            'reason': reason,
+            'failed_at': time.time(),
+        }))
+
+
+def replay_dead_letters(limit=None):
+    """Pop dead lettered resources, scheduling each for another round of retries
+
+    :param limit: maximum number to replay, all when None
+    :returns: number replayed
+    """
+    store = cache_store()
+    key = current_app.config["LAUNCH_CACHE_DEAD_LETTER_KEY"]
+    replayed = 0
+    while limit is None or replayed < limit:
+        item = store.lpop(key)
+        if item is None:
+            break
+        letter = json.loads(item)
+        persist_retry.delay(letter['resource'], letter['base'])
+        replayed += 1
+    return replayed
+
+
+@click.command('replay-dead-letters')
+@click.option('--limit', type=int, default=None, help="maximum number to replay")
+@with_appcontext
+def replay_dead_letters_command(limit):
+    """Retry persisting resources from the launch cache dead letter queue"""
+    replayed = replay_dead_letters(limit)
+    click.echo(f"replayed {replayed} dead lettered resource(s)")
 
 
 def persist_bundle(bundle):
     """Unpack and persist containted resources, then the bundle itself"""
-
+    base = current_app.config["LAUNCH_CACHE_URL"]
     if bundle["resourceType"] != "Bundle":
-        persist_resource(bundle)
+        persist_or_defer(bundle, base)
         return
 
-    # break apart the bundle, persisting every contained entry
-    for e in bundle.get("entry", []):
-        persist_resource(e["resource"])
+    # break apart the bundle, persisting every contained entry; concurrent
+    # requests to the cache server are bounded by its `destination_limit`
+    resources = [e["resource"] for e in bundle.get("entry", [])]
+    if len(resources) > 1:
+        app = current_app._get_current_object()
+
+        def persist(resource):
+            with app.app_context():
+                persist_or_defer(resource, base)
+
+        with ThreadPoolExecutor(
+                max_workers=current_app.config["LAUNCH_CACHE_CONCURRENCY"]) as executor:
+            # consume results, so any unexpected exception is raised here
+            list(executor.map(persist, resources))
+    else:
+        for resource in resources:
+            persist_or_defer(resource, base)
 
     # persist the bundle itself
-    base = current_app.config["LAUNCH_CACHE_URL"]
     bundle['type'] = 'collection'  # can't persist a searchset
+    persist_or_defer(bundle, base)
+
+
+def cache_get(request_path, query_string):
+    """GET the given launch server request path from the cache server
+
+    :returns: the cache server's response if OK and non-empty, otherwise None
+    """
+    url = f"{current_app.config['LAUNCH_CACHE_URL']}/{request_path}"
+    if query_string:
+        url = '?'.join((url, query_string))
     try:
-        response = requests.post(f"{base}/Bundle", json=bundle)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        logger.error(
-            f"HTTP error on persist: {response.status_code} {response.reason}")
-        logger.error(f"{response.text[:500]}")
+        response = http_session().get(url, headers={'Accept': 'application/fhir+json'})
     except requests.exceptions.RequestException as err:
-        logger.error(f"Request failed: {err}")
+        current_app.logger.warning(f"launch cache read failed: {err}")
+        return None
+    if not response.ok:
+        return None
+    try:
+        body = response.json()
+    except ValueError as err:
+        current_app.logger.warning(f"launch cache returned invalid JSON: {err}")
+        return None
+    if not isinstance(body, dict):
+        return None
+    if body.get('resourceType') == 'Bundle' and not body.get('entry'):
+        return None
+    return response
+
+
+def fresh(response):
+    """True if the cache server's response was persisted within `LAUNCH_CACHE_FRESHNESS` seconds
+
+    Judged by the time recorded on persist, see `record_persisted`; for
+    searchsets, that of the oldest entry.
+    """
+    try:
+        body = response.json()
+    except ValueError as err:
+        current_app.logger.warning(f"launch cache returned invalid JSON: {err}")
+        return False
+    resources = [e.get('resource') or {} for e in body.get('entry', [])] \
+        if body.get('resourceType') == 'Bundle' else [body]
+    if not resources:
+        return False
+
+    base = current_app.config['LAUNCH_CACHE_URL']
+    pipe = cache_store().pipeline(transaction=False)
+    for resource in resources:
+        pipe.get(persisted_at_key(resource, base))
+    try:
+        persisted = pipe.execute()
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+        return False
+    if None in persisted:
+        return False
+    age = time.time() - min(float(value) for value in persisted)
+    return age <= current_app.config['LAUNCH_CACHE_FRESHNESS']
+
+
+def cache_first(request_path):
+    """True if given request path is configured to be served from the cache server first"""
+    return (
+        current_app.config['LAUNCH_CACHE_READ_MODE'] == 'cache-first' and
+        request_path.strip('/').split('/')[0] in current_app.config['LAUNCH_CACHE_FIRST_TYPES'])
+
+
+def read_through(request_path, query_string, fetch):
+    """Fire a GET at the launch server, or serve it from the cache server
+
+    In "cache-first" mode, fresh cached results for `LAUNCH_CACHE_FIRST_TYPES`
+    are served without asking the launch server.  In "fallback" (and
+    "cache-first") mode, launch server requests are held to a read timeout
+    of `LAUNCH_CACHE_LATENCY_BUDGET` seconds; on timeout, connection failure,
+    a server error or no available slot, cached results are served instead.
+
+    :param request_path: FHIR request path, less query string
+    :param query_string: query string of the request
+    :param fetch: callable firing the launch server request, given the read
+        timeout in seconds (None for the default)
+    :returns: (response, name of the source serving it)
+    """
+    mode = current_app.config['LAUNCH_CACHE_READ_MODE']
+    if mode not in ('fallback', 'cache-first') or not current_app.config['LAUNCH_CACHE_URL']:
+        return fetch(None), LAUNCH_SOURCE
+
+    if cache_first(request_path):
+        cached = cache_get(request_path, query_string)
+        if cached is not None and fresh(cached):
+            return cached, LAUNCH_CACHE_SOURCE
+
+    response = None
+    try:
+        response = fetch(current_app.config['LAUNCH_CACHE_LATENCY_BUDGET'])
+    except (requests.exceptions.RequestException, BulkheadFull) as err:
+        current_app.logger.warning(f"launch server request failed, trying launch cache: {err}")
+        error = err
+    else:
+        if response.status_code < 500:
+            return response, LAUNCH_SOURCE
+
+    cached = cache_get(request_path, query_string)
+    if cached is not None:
+        return cached, LAUNCH_CACHE_SOURCE
+    if response is None:
+        raise error
+    return response, LAUNCH_SOURCE
+
+
+class DisabledPersister(object):
+    """No-op persister, used when no `LAUNCH_CACHE_URL` is configured"""
+    def __init__(self, app):
+        pass
+
+    def persist(self, response):
+        pass
+
+
+class CeleryPersister(object):
+    """Persist responses to `LAUNCH_CACHE_URL` by way of celery task"""
+    def __init__(self, app):
+        # build celery and evaluate the (lazy) task now, rather than on a user's request
+        create_celery(app)
+        persist_response.name
+
+    def persist(self, response):
+        persist_response.delay(response)
+
+
+class LaunchCache(object):
+    """Flask extension managing persistence of launch server responses
+
+    The persister class is named by `LAUNCH_CACHE_PERSISTER`, instantiated
+    once per app on `init_app`.
+    """
+    def init_app(self, app):
+        if not app.config.get('LAUNCH_CACHE_URL'):
+            persister = DisabledPersister(app)
+        else:
+            persister = load_class(app.config['LAUNCH_CACHE_PERSISTER'])(app)
+        app.extensions['launch_cache'] = persister
+
+    def persist(self, response):
+        """Persist given launch server response (a FHIR resource or Bundle)"""
+        current_app.extensions['launch_cache'].persist(response)
+
+    def read_through(self, request_path, query_string, fetch):
+        """Fire launch server GET, served from the cache server as configured; see `read_through`"""
+        return read_through(request_path, query_string, fetch)
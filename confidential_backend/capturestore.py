@@ -0,0 +1,192 @@
+"""Append only NDJSON store for data captured via `/save_data`
+
+Rather than a pretty printed file per capture, written on the request
+thread, captures are queued and appended as compact NDJSON records by a
+background writer to segment files within `DEBUG_OUTPUT_DIR`.  Segments
+rotate at `CAPTURE_SEGMENT_MAX_BYTES` and are optionally gzip compressed.
+
+Each record appends a line to a shared index file, naming the capture
+`filename`, `context`, segment and (uncompressed) offset, so captures are
+read back without scanning the segments.  Segment names include the
+process id, as every worker process runs its own writer; appends to the
+index hold an exclusive `flock`, so lines from different processes never
+interleave.  Index entries are held in memory, reading only lines appended
+since the last lookup.
+"""
+from collections import defaultdict
+from datetime import datetime, timezone
+import fcntl
+import gzip
+import json
+import os
+import queue
+import threading
+
+from flask import current_app
+
+INDEX_FILENAME = 'capture-index.ndjson'
+
+
+class CaptureStore(object):
+    """Queue captures for the background writer; look up captures by filename or context"""
+    def __init__(self, directory, max_bytes, compress, queue_size, logger):
+        self.directory = directory
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._index_lock = threading.Lock()
+        self._index_entries = []
+        self._index_offset = 0
+        self._by_filename = defaultdict(list)
+        self._by_context = defaultdict(list)
+        self._segment = None
+        self._segment_name = None
+        self._segment_bytes = 0
+        self._segment_count = 0
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def append(self, record):
+        """Queue record for writing
+
+        :returns: False if the queue is full, True otherwise
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            return False
+        return True
+
+    def flush(self):
+        """Block until all queued records are written"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            # write whatever else is waiting, in the same pass
+            while len(records) < 100:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(records)
+            except Exception as ex:
+                self.logger.exception(ex)
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def _open_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_count += 1
+        suffix = '.ndjson.gz' if self.compress else '.ndjson'
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        self._segment_name = f"capture-{stamp}-{os.getpid()}-{self._segment_count}{suffix}"
+        path = os.path.join(self.directory, self._segment_name)
+        self._segment = gzip.open(path, 'ab') if self.compress else open(path, 'ab')
+        self._segment_bytes = 0
+
+    def _write(self, records):
+        index_lines = []
+        for record in records:
+            line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+            if self._segment is None or self._segment_bytes + len(line) > self.max_bytes:
+                self._open_segment()
+            index_lines.append(json.dumps({
+                'filename': record.get('filename'),
+                'context': record.get('context'),
+                'segment': self._segment_name,
+                'offset': self._segment_bytes,
+            }) + '\n')
+            self._segment.write(line)
+            self._segment_bytes += len(line)
+        self._segment.flush()
+
+        data = memoryview(''.join(index_lines).encode('utf-8'))
+        fd = os.open(
+            os.path.join(self.directory, INDEX_FILENAME),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # held across the batch, so appends from other worker processes don't interleave
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            # closing releases the lock
+            os.close(fd)
+
+    def _read_index(self):
+        """Add entries appended to the index file, by any process, since last read"""
+        path = os.path.join(self.directory, INDEX_FILENAME)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as index:
+            if os.fstat(index.fileno()).st_size < self._index_offset:
+                # index replaced; start over
+                self._index_entries = []
+                self._index_offset = 0
+                self._by_filename.clear()
+                self._by_context.clear()
+            index.seek(self._index_offset)
+            for line in index:
+                if not line.endswith(b'\n'):
+                    # still being appended by another process
+                    break
+                self._index_offset += len(line)
+                entry = json.loads(line)
+                self._index_entries.append(entry)
+                self._by_filename[entry['filename']].append(entry)
+                self._by_context[entry['context']].append(entry)
+
+    def index(self):
+        """Returns index entries, in order written"""
+        with self._index_lock:
+            self._read_index()
+            return list(self._index_entries)
+
+    def lookup(self, filename=None, context=None):
+        """Returns index entries matching the given filename and / or context"""
+        with self._index_lock:
+            self._read_index()
+            if filename is not None:
+                entries = self._by_filename.get(filename, [])
+            elif context is not None:
+                entries = self._by_context.get(context, [])
+            else:
+                entries = self._index_entries
+            return [
+                entry for entry in entries
+                if context is None or entry['context'] == context]
+
+    def read(self, entry):
+        """Returns the captured record named by the given index entry"""
+        path = os.path.join(self.directory, entry['segment'])
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as segment:
+            segment.seek(entry['offset'])
+            return json.loads(segment.readline())
+
+
+_store_lock = threading.Lock()
+
+
+def capture_store():
+    """Returns the app's capture store, started on first use"""
+    with _store_lock:
+        if 'capture_store' not in current_app.extensions:
+            current_app.extensions['capture_store'] = CaptureStore(
+                directory=current_app.config['DEBUG_OUTPUT_DIR'],
+                max_bytes=current_app.config['CAPTURE_SEGMENT_MAX_BYTES'],
+                compress=current_app.config['CAPTURE_COMPRESS'],
+                queue_size=current_app.config['CAPTURE_QUEUE_SIZE'],
+                logger=current_app.logger)
+        return current_app.extensions['capture_store']
+
+
+def capture_record(body, filename):
+    """Returns the record stored for a `/save_data` body"""
+    return dict(body, filename=filename, captured_at=datetime.now(timezone.utc).isoformat())
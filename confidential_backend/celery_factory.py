@@ -1,30 +1,63 @@
-from celery import Celery
-from confidential_backend.app import create_app
+"""Lazily bootstrapped celery instance
+
+Building the celery instance is cheap; it neither connects to the broker
+nor creates a flask app.  Configuration is read from
+`confidential_backend.config` on first use, and a flask app is only
+created when a task executes outside an existing app context, as in
+celery worker processes.
+"""
+from celery import Celery, Task
+from flask import has_app_context
 
 __celery = None
+__flask_app = None
+
+
+def register_flask_app(flask_app):
+    """Register the process' flask app, used for task app context"""
+    global __flask_app
+    __flask_app = flask_app
+
+
+def get_flask_app():
+    """Returns the process' flask app, created on first call if not registered"""
+    global __flask_app
+    if __flask_app is None:
+        from confidential_backend.app import create_app
+        __flask_app = create_app()
+    return __flask_app
+
+
+class ContextTask(Task):
+    """Execute tasks within a flask app context"""
+    def __call__(self, *args, **kwargs):
+        if has_app_context():
+            return self.run(*args, **kwargs)
+        with get_flask_app().app_context():
+            return self.run(*args, **kwargs)
+
 
 def create_celery(flask_app=None):
     global __celery
+    if flask_app is not None:
+        register_flask_app(flask_app)
     if __celery is not None:
         return __celery
 
-    flask_app = flask_app or create_app()
     celery = Celery(
-        flask_app.import_name,
-        broker=flask_app.config["CELERY_BROKER_URL"],
-        results_backend=flask_app.config["CELERY_BROKER_URL"],
-        imports = ('confidential_backend.cachelaunchresponse',)
+        'confidential_backend',
+        task_cls=ContextTask,
+        imports=('confidential_backend.cachelaunchresponse',),
     )
-    celery.conf.update(flask_app.config)
-
-    class ContextTask(celery.Task):
-        def __call__(self, *args, **kwargs):
-            with flask_app.app_context():
-                return self.run(*args, **kwargs)
-
-    celery.Task = ContextTask
+    # lazy; read on first access of celery.conf
+    celery.config_from_object('confidential_backend.config', namespace='CELERY')
     __celery = celery
     return celery
 
 
-celery = create_celery()
+def __getattr__(name):
+    # support `celery -A confidential_backend.celery_factory` without
+    # building the instance on import
+    if name == 'celery':
+        return create_celery()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
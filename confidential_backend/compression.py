@@ -0,0 +1,95 @@
+"""Compress responses as negotiated by the client's `Accept-Encoding`
+
+gzip is always available; brotli (`br`) and zstandard (`zstd`) are offered
+when the respective optional packages are installed.  Streamed responses,
+such as merged Bundles, are compressed chunk by chunk.
+"""
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/fhir+json')
+
+
+def available_encodings():
+    """Supported encodings, in order of preference"""
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+def compressor(encoding):
+    """Returns (compress, flush) callables for the named encoding"""
+    if encoding == 'zstd':
+        compressobj = zstandard.ZstdCompressor(level=3).compressobj()
+        return compressobj.compress, compressobj.flush
+    if encoding == 'br':
+        compressobj = brotli.Compressor(quality=5)
+        return compressobj.process, compressobj.finish
+    compressobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressobj.compress, compressobj.flush
+
+
+def compressible(response):
+    """Determine if response is a candidate for compression"""
+    return (
+        request.method != 'HEAD' and
+        response.status_code == 200 and
+        'Content-Encoding' not in response.headers and
+        not response.direct_passthrough and
+        (response.mimetype in COMPRESSIBLE_MIMETYPES or
+            response.mimetype.endswith('+json') or
+            response.mimetype.startswith('text/')))
+
+
+def stream_compressed(chunks, encoding):
+    """Generate compressed output from the given iterable of chunks"""
+    compress, flush = compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk)
+        if data:
+            yield data
+    yield flush()
+
+
+def compress_response(response):
+    """`after_request` handler compressing responses per `Accept-Encoding`
+
+    Responses smaller than `COMPRESS_MIN_SIZE` bytes are sent as is, where
+    compression costs more than it saves.
+    """
+    if not current_app.config['COMPRESS_ENABLED'] or not compressible(response):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = stream_compressed(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        compress, flush = compressor(encoding)
+        response.set_data(compress(data) + flush())
+    response.headers['Content-Encoding'] = encoding
+    return response
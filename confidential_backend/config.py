@@ -4,18 +4,56 @@ Use env var to override
 """
 import json
 import os
-import redis
 
 AUTH_TOKEN_LOG_FILTER = os.getenv("AUTH_TOKEN_LOG_FILTER").split(",") if "AUTH_TOKEN_LOG_FILTER" in os.environ else None
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379/3")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
 DEBUG_FHIR_REQUESTS = os.getenv("DEBUG_FHIR_REQUESTS", "false").lower() == "true"
 DEBUG_OUTPUT_DIR = os.getenv("DEBUG_OUTPUT_DIR", '/tmp')
+# /save_data writes a file per capture ("files"), or appends to NDJSON segments ("ndjson")
+SAVE_DATA_MODE = os.getenv("SAVE_DATA_MODE", "files").lower()
+CAPTURE_SEGMENT_MAX_BYTES = int(os.getenv("CAPTURE_SEGMENT_MAX_BYTES", 64 * 1024 * 1024))
+CAPTURE_COMPRESS = os.getenv("CAPTURE_COMPRESS", "false").lower() == "true"
+CAPTURE_QUEUE_SIZE = int(os.getenv("CAPTURE_QUEUE_SIZE", 10000))
+# sample a fraction of requests with cProfile (and optionally tracemalloc), results to DEBUG_OUTPUT_DIR
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.01))
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "false").lower() == "true"
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", 1))
+# bearer token required by /admin endpoints; unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 FHIR_RESOURCES_LOGFILE = os.getenv("FHIR_RESOURCES_LOGFILE")
+# record /fhir-router requests, timing and responses to FHIR_RESOURCES_LOGFILE for replay; see replay
+FHIR_CAPTURE_ENABLED = os.getenv("FHIR_CAPTURE_ENABLED", "false").lower() == "true"
+# fraction of sessions captured
+FHIR_CAPTURE_SAMPLE_RATE = float(os.getenv("FHIR_CAPTURE_SAMPLE_RATE", 1))
+FHIR_CAPTURE_SCRUB = os.getenv("FHIR_CAPTURE_SCRUB", "true").lower() == "true"
 APP_FHIR_URL = os.getenv("APP_FHIR_URL")
 APP_FHIR_MRN_SYSTEM = os.getenv("APP_FHIR_MRN_SYSTEM")
 LAUNCH_FHIR_SCOPES = os.getenv("LAUNCH_FHIR_SCOPES", "launch/patient patient/*.cruds system/*.cruds user/*.cruds")
 LAUNCH_FHIR_MRN_SYSTEMS = os.getenv("LAUNCH_FHIR_MRN_SYSTEMS","").split(",")
 LAUNCH_CACHE_URL = os.getenv("LAUNCH_CACHE_URL")
+# class persisting launch responses to LAUNCH_CACHE_URL; disabled when the URL is unset
+LAUNCH_CACHE_PERSISTER = os.getenv(
+    "LAUNCH_CACHE_PERSISTER", "confidential_backend.cachelaunchresponse.CeleryPersister")
+# per worker process bounds on requests to LAUNCH_CACHE_URL; rate in requests/second, 0 for unlimited
+LAUNCH_CACHE_CONCURRENCY = int(os.getenv("LAUNCH_CACHE_CONCURRENCY", 8))
+LAUNCH_CACHE_RATE_LIMIT = float(os.getenv("LAUNCH_CACHE_RATE_LIMIT", 0))
+# failed persists retry with exponential backoff (seconds) and jitter, then land on the dead letter queue
+LAUNCH_CACHE_MAX_RETRIES = int(os.getenv("LAUNCH_CACHE_MAX_RETRIES", 8))
+LAUNCH_CACHE_RETRY_BACKOFF = int(os.getenv("LAUNCH_CACHE_RETRY_BACKOFF", 2))
+LAUNCH_CACHE_RETRY_BACKOFF_MAX = int(os.getenv("LAUNCH_CACHE_RETRY_BACKOFF_MAX", 10 * 60))
+LAUNCH_CACHE_DEAD_LETTER_KEY = os.getenv("LAUNCH_CACHE_DEAD_LETTER_KEY", "launch_cache:dead_letter")
+# seconds to remember persisted content, skipping identical repeat persists
+LAUNCH_CACHE_IDEMPOTENCY_TTL = int(os.getenv("LAUNCH_CACHE_IDEMPOTENCY_TTL", 60 * 60))
+# serve launch server GETs from LAUNCH_CACHE_URL:
+#  "off": never
+#  "fallback": when the launch server errors or exceeds LAUNCH_CACHE_LATENCY_BUDGET (seconds)
+#  "cache-first": as fallback, and first for LAUNCH_CACHE_FIRST_TYPES persisted within LAUNCH_CACHE_FRESHNESS seconds
+LAUNCH_CACHE_READ_MODE = os.getenv("LAUNCH_CACHE_READ_MODE", "off").lower()
+LAUNCH_CACHE_LATENCY_BUDGET = float(os.getenv("LAUNCH_CACHE_LATENCY_BUDGET", 5))
+LAUNCH_CACHE_FIRST_TYPES = [t for t in os.getenv("LAUNCH_CACHE_FIRST_TYPES", "").split(",") if t]
+LAUNCH_CACHE_FRESHNESS = int(os.getenv("LAUNCH_CACHE_FRESHNESS", 5 * 60))
 SERVER_NAME = os.getenv("SERVER_NAME")
 SECRET_KEY = os.getenv("SECRET_KEY")
 # URL scheme to use outside of request context
@@ -31,8 +69,40 @@ SECONDARY_SOURCE_STRATEGIES = json.loads(os.getenv("SECONDARY_SOURCE_STRATEGIES"
     },
 ])))
 
+# JSON file of strategies, used in place of SECONDARY_SOURCE_STRATEGIES and reloaded on change
+SECONDARY_SOURCE_STRATEGIES_FILE = os.getenv("SECONDARY_SOURCE_STRATEGIES_FILE")
+STRATEGY_RELOAD_INTERVAL = int(os.getenv("STRATEGY_RELOAD_INTERVAL", 30))
+
+# how secondary sources supplement the launch server:
+#  "first": first source with non-empty results wins
+#  "merge": searches query all sources in parallel, merging results
+SECONDARY_SOURCE_MODE = os.getenv("SECONDARY_SOURCE_MODE", "first").lower()
+
+# POSTed batch Bundles: entries executed at once, and maximum entries per batch
+FHIR_BATCH_CONCURRENCY = int(os.getenv("FHIR_BATCH_CONCURRENCY", 4))
+FHIR_BATCH_MAX_ENTRIES = int(os.getenv("FHIR_BATCH_MAX_ENTRIES", 50))
+
+# limit concurrent requests per upstream source, so one slow server can't occupy every worker
+BULKHEAD_ENABLED = os.getenv("BULKHEAD_ENABLED", "false").lower() == "true"
+# JSON object of limits by source: secondary strategy name, or "launch" for the launch server
+BULKHEAD_LIMITS = json.loads(os.getenv("BULKHEAD_LIMITS", "{}"))
+BULKHEAD_DEFAULT_LIMIT = int(os.getenv("BULKHEAD_DEFAULT_LIMIT", 10))
+# concurrent requests per session per source; 0 for no per session limit
+BULKHEAD_SESSION_LIMIT = int(os.getenv("BULKHEAD_SESSION_LIMIT", 4))
+# count slots across all workers via redis, rather than per process
+BULKHEAD_REDIS = os.getenv("BULKHEAD_REDIS", "false").lower() == "true"
+# seconds after which a redis slot is presumed abandoned
+BULKHEAD_SLOT_TTL = int(os.getenv("BULKHEAD_SLOT_TTL", 60))
+BULKHEAD_RETRY_AFTER = int(os.getenv("BULKHEAD_RETRY_AFTER", 1))
+# when a secondary source is full: "reject" with 503, or "skip" to the next source
+BULKHEAD_ON_FULL = os.getenv("BULKHEAD_ON_FULL", "reject").lower()
+
 SESSION_TYPE = os.getenv("SESSION_TYPE", 'redis')
-SESSION_REDIS = redis.from_url(os.getenv("SESSION_REDIS", "redis://127.0.0.1:6379"))
+# session fields stored apart for direct access, in addition to any `*_patient_id`
+SESSION_HOT_FIELDS = os.getenv(
+    "SESSION_HOT_FIELDS", "iss,launch_token_patient,subject,user").split(",")
+# redis client (SESSION_REDIS) built from url in `app.configure_extensions`
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS", "redis://127.0.0.1:6379")
 SESSION_COOKIE_DOMAIN = os.getenv("SESSION_COOKIE_DOMAIN")
 SESSION_COOKIE_SAMESITE = os.getenv("SESSION_COOKIE_SAMESITE", 'Lax')
 SESSION_COOKIE_SECURE = os.getenv("SESSION_COOKIE_SECURE", 'false').lower() == 'true'
@@ -40,15 +110,74 @@ SESSION_COOKIE_SECURE = os.getenv("SESSION_COOKIE_SECURE", 'false').lower() == '
 REQUEST_CACHE_URL = os.environ.get('REQUEST_CACHE_URL', 'redis://localhost:6379/0')
 REQUEST_CACHE_EXPIRE = 24 * 60 * 60  # 24 hours
 
+# compress /fhir-router responses per Accept-Encoding; smaller bodies (bytes) sent as is
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() == "true"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+
+# shared HTTP client (see httpclient); timeouts in seconds
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 30))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 20))
+# seconds to retain resolved upstream host addresses; 0 resolves on every connection
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", 60))
+
+# revalidate repeat upstream GETs with stored ETag / Last-Modified, retained for CONDITIONAL_CACHE_TTL seconds
+CONDITIONAL_REQUESTS_ENABLED = os.getenv("CONDITIONAL_REQUESTS_ENABLED", "false").lower() == "true"
+CONDITIONAL_CACHE_TTL = int(os.getenv("CONDITIONAL_CACHE_TTL", 15 * 60))
+
+# serve the last good response to upstream GETs (with Age and Warning headers), in seconds; 0 disables:
+#  STALE_WHILE_REVALIDATE: straight away, refreshing it in the background, if stored within
+#  STALE_IF_ERROR: in place of an upstream error or timeout, if stored within
+STALE_WHILE_REVALIDATE = int(os.getenv("STALE_WHILE_REVALIDATE", 0))
+STALE_IF_ERROR = int(os.getenv("STALE_IF_ERROR", 0))
+
+# coalesce identical concurrent upstream GETs; optionally across workers via redis lock
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+SINGLE_FLIGHT_REDIS = os.getenv("SINGLE_FLIGHT_REDIS", "false").lower() == "true"
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", 10))
+
+# follow searchset `next` links server side, serving later pages from a per session cache
+PAGE_PREFETCH_ENABLED = os.getenv("PAGE_PREFETCH_ENABLED", "false").lower() == "true"
+PAGE_PREFETCH_CONCURRENCY = int(os.getenv("PAGE_PREFETCH_CONCURRENCY", 4))
+PAGE_PREFETCH_MAX_PAGES = int(os.getenv("PAGE_PREFETCH_MAX_PAGES", 10))
+# background prefetches running at once, per process
+PAGE_PREFETCH_MAX_THREADS = int(os.getenv("PAGE_PREFETCH_MAX_THREADS", 8))
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", 5 * 60))
+
+# pages followed per source when merging searches; Bundles with pages remaining are incomplete
+MERGED_SEARCH_MAX_PAGES = int(os.getenv("MERGED_SEARCH_MAX_PAGES", 10))
+
+# comma delimited relative paths to prewarm on authorization, i.e.
+# "Patient/{patient},Condition?patient={patient},Observation?patient={patient}"
+PREFETCH_PROFILE = [p for p in os.getenv("PREFETCH_PROFILE", "").split(",") if p]
+PREFETCH_ACCEPT = os.getenv("PREFETCH_ACCEPT", "application/json")
+PREFETCH_CACHE_TTL = int(os.getenv("PREFETCH_CACHE_TTL", 60))
+
+# seconds to retain SoF discovery results per launch server; 0 disables
+DISCOVERY_CACHE_TTL = int(os.getenv("DISCOVERY_CACHE_TTL", 5 * 60))
+
+# warm up each worker (connections, caches) in the background; see /ready
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "false").lower() == "true"
+# comma delimited launch server base urls to preconnect and discover on warm up
+WARMUP_ISSUERS = [i for i in os.getenv("WARMUP_ISSUERS", "").split(",") if i]
+
 SOF_CLIENT_ID = os.getenv("SOF_CLIENT_ID")
 SOF_CLIENT_SECRET = os.getenv("SOF_CLIENT_SECRET")
 SOF_CLIENT_SCOPES = os.getenv("SOF_CLIENT_SCOPES", "patient/*.read launch/patient")
 
+# refresh the session's access token when a request arrives within TOKEN_REFRESH_MARGIN seconds of expiry
+TOKEN_REFRESH_ENABLED = os.getenv("TOKEN_REFRESH_ENABLED", "true").lower() == "true"
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", 120))
+# seconds a worker may hold the per session refresh lock
+TOKEN_REFRESH_LOCK_TIMEOUT = float(os.getenv("TOKEN_REFRESH_LOCK_TIMEOUT", 10))
+
 SOF_ACCESS_TOKEN_URL = os.getenv("SOF_ACCESS_TOKEN_URL")
 SOF_AUTHORIZE_URL = os.getenv("SOF_AUTHORIZE_URL")
 SOF_JWKS_URL = os.getenv("SOF_JWKS_URL")
 
 LOGSERVER_TOKEN = os.getenv('LOGSERVER_TOKEN')
+# maximum events accepted in a single /auditlog batch
+AUDITLOG_MAX_BATCH = int(os.getenv("AUDITLOG_MAX_BATCH", 500))
 LOGSERVER_URL = os.getenv('LOGSERVER_URL')
 
 # NB log level hardcoded at INFO for logserver
@@ -10,16 +10,19 @@ def load_class(path: str):
     return getattr(module, class_name)
 
 
-def load_strategies(app):
-    strategies = []
+def build_strategy(cfg):
+    """Instantiate strategy from a single `SECONDARY_SOURCE_STRATEGIES` entry
 
-    for cfg in app.config["SECONDARY_SOURCE_STRATEGIES"]:
-        name = cfg["name"]
-        cls = load_class(cfg["class"])
-        kwargs = cfg.copy()
-        kwargs.pop("class")
-        kwargs.pop("name")
+    Keys beyond `name` and `class` are passed as keyword arguments, less
+    registry keys such as `issuers` (see `source_strategies.registry`).
+    """
+    cls = load_class(cfg["class"])
+    kwargs = cfg.copy()
+    kwargs.pop("class")
+    name = kwargs.pop("name")
+    kwargs.pop("issuers", None)
+    return cls(name, **kwargs)
 
-        strategies.append(cls(name, **kwargs))
 
-    return strategies
+def load_strategies(app):
+    return [build_strategy(cfg) for cfg in app.config["SECONDARY_SOURCE_STRATEGIES"]]
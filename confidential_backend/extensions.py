@@ -4,9 +4,13 @@ from flask_session import Session
 import redis
 from requests_cache import CachedSession
 
+from confidential_backend.cachelaunchresponse import LaunchCache
+from confidential_backend.source_strategies.registry import StrategyRegistry
+
+launch_cache = LaunchCache()
 oauth = OAuth()
 sess = Session()
-secondary_sources = []
+strategy_registry = StrategyRegistry()
 
 
 class CS_Singleton(object):
@@ -1,7 +1,29 @@
-"""Specialized logger for capturing all FHIR resources from upstream servers"""
-from flask import current_app
+"""Specialized logger for capturing all FHIR resources from upstream servers
+
+With `FHIR_CAPTURE_ENABLED`, each `/fhir-router` request is also recorded
+as a "capture": method, relative path, query string, status, timing, the
+source serving it (see `X-Served-By`) and the response body.  Captures are
+sampled per session (`FHIR_CAPTURE_SAMPLE_RATE`), keeping each sampled
+session's stream complete, and scrubbed of PHI (`FHIR_CAPTURE_SCRUB`):
+PHI elements are masked, path ids and search values replaced by pseudonyms.
+Captured streams are replayed by `confidential_backend.replay`.
+"""
+from flask import current_app, g, request
+import hashlib
+import hmac
 import logging
 from pythonjsonlogger.jsonlogger import JsonFormatter
+import time
+from urllib.parse import parse_qsl, urlencode
+
+CAPTURE_MESSAGE = "capture"
+# resource elements masked in scrubbed captures
+PHI_ELEMENTS = (
+    'name', 'telecom', 'address', 'birthDate', 'photo', 'contact', 'text', 'identifier')
+# search parameters controlling result form, retained in scrubbed captures; others are masked
+RESULT_PARAMETERS = (
+    '_count', '_elements', '_format', '_include', '_pretty', '_revinclude', '_sort',
+    '_summary', '_total')
 
 
 def configure_resource_logger(logger):
@@ -28,3 +50,110 @@ def getLogger():
         logger = configure_resource_logger(logger)
 
     return logger
+
+
+def session_digest(session_id):
+    """Stable pseudonym for a session, grouping its captures without naming it"""
+    return hashlib.sha256(str(session_id).encode('utf-8')).hexdigest()[:16]
+
+
+def capture_sampled(session_id):
+    """True if the given session's requests are captured
+
+    Sampled by session digest rather than per request, so sampled sessions
+    are captured in full
+    """
+    rate = current_app.config['FHIR_CAPTURE_SAMPLE_RATE']
+    return int(session_digest(session_id), 16) % 10000 < rate * 10000
+
+
+def mask(value):
+    """Replace string values with placeholders of equal length, retaining structure"""
+    if isinstance(value, str):
+        return 'x' * len(value)
+    if isinstance(value, list):
+        return [mask(v) for v in value]
+    if isinstance(value, dict):
+        return {k: mask(v) for k, v in value.items()}
+    return value
+
+
+def scrub(value):
+    """Mask PHI elements throughout given FHIR content, see `PHI_ELEMENTS`
+
+    Ids and references are retained, as replay depends on them
+    """
+    if isinstance(value, list):
+        return [scrub(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {
+        k: mask(v) if k in PHI_ELEMENTS else scrub(v)
+        for k, v in value.items()}
+
+
+def pseudonym(value):
+    """Keyed digest standing in for an identifying value; distinct values remain distinct"""
+    key = (current_app.config['SECRET_KEY'] or '').encode('utf-8')
+    return hmac.new(key, value.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+
+def scrub_path(relative_path):
+    """Replace ids in a FHIR request path, such as `Patient/<id>/_history/<vid>`, with pseudonyms
+
+    Resource types and `_` or `$` prefixed segments (`_history`, operations) are retained
+    """
+    segments = relative_path.split('/')
+    return '/'.join(
+        pseudonym(segment) if i % 2 and segment and segment[0] not in '_$' else segment
+        for i, segment in enumerate(segments))
+
+
+def scrub_query(query_string):
+    """Replace search parameter values with pseudonyms, less `RESULT_PARAMETERS`"""
+    return urlencode([
+        (name, value if name in RESULT_PARAMETERS else pseudonym(value))
+        for name, value in parse_qsl(query_string, keep_blank_values=True)])
+
+
+def start_capture():
+    """Note start of `/fhir-router` request, if captured"""
+    if not current_app.config['FHIR_CAPTURE_ENABLED']:
+        return
+    session_id = (request.view_args or {}).get('session_id')
+    if capture_sampled(session_id):
+        g.capture_started = time.monotonic()
+
+
+def capture_response(response):
+    """Record captured request and its response to the FHIR resources log"""
+    started = g.pop('capture_started', None)
+    if started is None:
+        return response
+
+    view_args = request.view_args or {}
+    path = view_args.get('relative_path', '')
+    query = request.query_string.decode()
+    body = None
+    # reading a streamed body (such as a merged search) would buffer it in full
+    if response.status_code != 304 and not response.is_streamed:
+        body = response.get_json(silent=True)
+    request_body = request.get_json(silent=True) if request.method in ('POST', 'PUT') else None
+    if current_app.config['FHIR_CAPTURE_SCRUB']:
+        body, request_body = scrub(body), scrub(request_body)
+        # pseudonyms, as replay matches requests by path and query
+        path, query = scrub_path(path), scrub_query(query)
+
+    getLogger().info({
+        "message": CAPTURE_MESSAGE,
+        "session": session_digest(view_args.get('session_id')),
+        "captured_at": time.time(),
+        "method": request.method,
+        "path": path,
+        "query": query,
+        "status": response.status_code,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        "source": response.headers.get('X-Served-By', 'unknown'),
+        "request_body": request_body,
+        "fhir": body})
+    return response
@@ -0,0 +1,196 @@
+"""Shared HTTP client for requests to upstream servers
+
+A single `requests.Session` per process pools connections (and TLS
+sessions) to the handful of upstream hosts, rather than every request
+paying for DNS resolution and handshakes.  All outbound requests - FHIR
+servers, SoF discovery, the launch cache and the logserver - use it.
+
+The session applies uniform default timeouts, resolves host names through
+a TTL cache and records per host latency, see `host_metrics`.  Settings
+are read from app config by `configure`, called once per process from
+`create_app`, as the session is also used outside of any app context.
+
+NB the session is shared by all users; cookies set by upstream servers
+are never stored.
+"""
+from http.cookiejar import DefaultCookiePolicy
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+
+__session = None
+settings = {
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'pool_maxsize': 20,
+    'dns_cache_ttl': 60,
+}
+
+
+def configure(app):
+    """Apply `HTTP_*` and `DNS_CACHE_TTL` settings from app config"""
+    global __session
+    settings.update({
+        'connect_timeout': app.config['HTTP_CONNECT_TIMEOUT'],
+        'read_timeout': app.config['HTTP_READ_TIMEOUT'],
+        'pool_maxsize': app.config['HTTP_POOL_MAXSIZE'],
+        'dns_cache_ttl': app.config['DNS_CACHE_TTL'],
+    })
+    # rebuilt on next use with current settings
+    __session = None
+
+
+class DNSCache(object):
+    """Resolved addresses by (host, port), retained for `dns_cache_ttl` seconds"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def resolve(self, host, port):
+        ttl = settings['dns_cache_ttl']
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((host, port))
+        if ttl and entry and entry[0] > now:
+            return entry[1]
+
+        addresses = [
+            sockaddr[:2] for _, _, _, _, sockaddr in
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+        with self._lock:
+            self._entries[(host, port)] = (now + ttl, addresses)
+        return addresses
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+dns_cache = DNSCache()
+
+
+class CachedResolutionMixin(object):
+    """Connection resolving its host name via `dns_cache`
+
+    Cached addresses are tried in turn; on failure of all, the entry is
+    dropped so the next connection resolves afresh.  TLS server name
+    indication and verification continue to use the host name.
+    """
+    def _new_conn(self):
+        host = self._dns_host
+        if not settings['dns_cache_ttl']:
+            return super()._new_conn()
+        try:
+            addresses = dns_cache.resolve(host, self.port)
+        except socket.gaierror:
+            addresses = []
+        if not addresses:
+            return super()._new_conn()
+
+        error = None
+        try:
+            for ip_address, _ in addresses:
+                # urllib3 connects to `_dns_host`; `host` names the server otherwise
+                self._dns_host = ip_address
+                try:
+                    return super()._new_conn()
+                except ConnectTimeoutError as ex:
+                    # includes NewConnectionError
+                    error = ex
+        finally:
+            self._dns_host = host
+        dns_cache.invalidate(host, self.port)
+        raise error
+
+
+class CachedResolutionHTTPConnection(CachedResolutionMixin, HTTPConnection):
+    pass
+
+
+class CachedResolutionHTTPSConnection(CachedResolutionMixin, HTTPSConnection):
+    pass
+
+
+class CachedResolutionHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedResolutionHTTPConnection
+
+
+class CachedResolutionHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedResolutionHTTPSConnection
+
+
+class HostMetrics(object):
+    """Per host request counts and latency, as observed by the shared session"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, host, seconds, error=False):
+        with self._lock:
+            metrics = self._hosts.setdefault(
+                host, {'requests': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            metrics['requests'] += 1
+            metrics['errors'] += int(error)
+            metrics['total_seconds'] += seconds
+            metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                host: dict(metrics, mean_seconds=metrics['total_seconds'] / metrics['requests'])
+                for host, metrics in self._hosts.items()}
+
+
+host_metrics = HostMetrics()
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """Adapter applying default timeouts, cached DNS resolution and recording per host latency"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # resolution is confined to this adapter's pools, leaving other urllib3 users be
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedResolutionHTTPConnectionPool,
+            'https': CachedResolutionHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (settings['connect_timeout'], settings['read_timeout'])
+        host = urlparse(request.url).netloc
+        start = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            host_metrics.record(host, time.monotonic() - start, error=True)
+            raise
+        host_metrics.record(
+            host, time.monotonic() - start, error=response.status_code >= 500)
+        return response
+
+
+def share_pool(session):
+    """Mount the shared session's adapters on given session, such as one built by a library"""
+    for prefix, adapter in http_session().adapters.items():
+        session.mount(prefix, adapter)
+
+
+def http_session():
+    """Returns the process' pooled `requests.Session`"""
+    global __session
+    if __session is None:
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = InstrumentedAdapter(
+            pool_connections=settings['pool_maxsize'], pool_maxsize=settings['pool_maxsize'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        __session = session
+    return __session
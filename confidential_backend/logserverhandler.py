@@ -1,12 +1,16 @@
+from contextlib import contextmanager
 import json
 import logging
+import threading
 from pythonjsonlogger.jsonlogger import JsonFormatter
-import requests
 from requests.exceptions import RequestException
 
+from confidential_backend.httpclient import http_session
+
 
 class LogServerHandler(logging.Handler):
     """Specialized logging handler capable of nesting json and passing auth"""
+    _batch = threading.local()
 
     def __init__(self, url, jwt):
         super().__init__()
@@ -15,15 +19,42 @@ class LogServerHandler(logging.Handler):
         self.setFormatter(JsonFormatter(
             "%(asctime)s %(name)s %(levelname)s %(message)s"))
 
+    def event(self, record):
+        return {"event": json.loads(self.format(record))}
+
+    @classmethod
+    @contextmanager
+    def batching(cls):
+        """Collect records emitted within the block, one request per handler
+
+        The logserver (PostgREST) inserts each event of a posted array.
+        """
+        if getattr(cls._batch, 'pending', None) is not None:
+            # already batching; the outer block posts
+            yield
+            return
+        pending = cls._batch.pending = {}
+        try:
+            yield
+        finally:
+            cls._batch.pending = None
+            for handler, events in pending.items():
+                handler.post(events)
+
     def emit(self, record):
-        log_entry = self.format(record)
-        log_entry = {"event": json.loads(log_entry)}
+        pending = getattr(self._batch, 'pending', None)
+        if pending is not None:
+            pending.setdefault(self, []).append(self.event(record))
+            return
+        self.post(self.event(record))
+
+    def post(self, events):
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.jwt}"
         }
         try:
-            response = requests.post(url=self.url, headers=headers, json=log_entry)
+            response = http_session().post(url=self.url, headers=headers, json=events)
             response.raise_for_status()
         except RequestException as ex:
             # bootstrap problems - attempt to log to root logger
@@ -0,0 +1,254 @@
+"""Server side prefetch of searchset Bundle pages
+
+Frontends page through large searchsets by following each Bundle's `next`
+link, a full client -> proxy -> EHR round trip per page.  When enabled
+(`PAGE_PREFETCH_ENABLED`), the proxy follows `next` links itself in the
+background, with bounded concurrency, storing each page in a short lived
+per session page cache.  Bundle links are rewritten to point back through
+the proxy, so the client's subsequent page requests are served from cache.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import hashlib
+import threading
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from flask import current_app
+
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import (
+    cache_store,
+    deserialize_response,
+    normalize_path,
+    request_key,
+    serialize_response,
+    store_error,
+)
+from confidential_backend.singleflight import coalesce
+
+PAGE_PREFIX = 'page:'
+# query parameters locating a page within a search, rather than the search
+PAGING_PARAMS = ('_getpagesoffset', '_offset', '_page', 'page', '_cursor')
+
+# (session id, search) of prefetches running in this process
+_prefetching = set()
+_prefetching_lock = threading.Lock()
+
+
+def page_key(session_id, relative_path, query_string=''):
+    """Key for cached page, unique to session and (normalized) request"""
+    digest = hashlib.sha256(
+        normalize_path(relative_path, query_string).encode('utf-8')).hexdigest()
+    return f'{PAGE_PREFIX}{session_id}:{digest}'
+
+
+def next_link(bundle):
+    """Returns the url of the given Bundle's `next` link, if defined"""
+    for link in bundle.get('link', []):
+        if link.get('relation') == 'next':
+            return link.get('url')
+
+
+def split_relative(url, base_url):
+    """Split url beyond `base_url` into (path, query_string)
+
+    :returns: (path, query_string) or None if url isn't on `base_url`
+    """
+    base_url = base_url.rstrip('/')
+    if not url or not url.startswith(base_url):
+        return None
+    remainder = url[len(base_url):].lstrip('/')
+    path, _, query_string = remainder.partition('?')
+    return path, query_string
+
+
+def page_urls(bundle, max_pages):
+    """Predict the urls for subsequent pages, when the server pages by offset
+
+    Servers such as HAPI issue `next` links carrying `_getpagesoffset` and
+    `_count`; given a Bundle `total`, all remaining page urls are known up
+    front and may be fetched concurrently.
+
+    :returns: list of page urls, or None if unpredictable
+    """
+    url = next_link(bundle)
+    total = bundle.get('total')
+    if not url or total is None:
+        return None
+
+    parsed = urlparse(url)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    values = dict(params)
+    try:
+        offset = int(values['_getpagesoffset'])
+        count = int(values['_count'])
+    except (KeyError, ValueError):
+        return None
+    if count <= 0:
+        return None
+
+    urls = []
+    for page_offset in range(offset, total, count):
+        if len(urls) >= max_pages:
+            break
+        query = [
+            (k, str(page_offset) if k == '_getpagesoffset' else v)
+            for k, v in params]
+        urls.append(parsed._replace(query=urlencode(query)).geturl())
+    return urls
+
+
+def rewrite_links(bundle, upstream_base_url, proxy_base_url):
+    """Point Bundle links on the upstream server back through the proxy
+
+    :param bundle: FHIR Bundle, modified in place
+    :param upstream_base_url: FHIR base url of the upstream server (`iss`)
+    :param proxy_base_url: `/fhir-router` url for the active session
+    """
+    proxy_base_url = proxy_base_url.rstrip('/')
+    for link in bundle.get('link', []):
+        relative = split_relative(link.get('url'), upstream_base_url)
+        if relative is None:
+            continue
+        path, query_string = relative
+        link['url'] = f"{proxy_base_url}/{path}"
+        if query_string:
+            link['url'] = '?'.join((link['url'], query_string))
+    return bundle
+
+
+def follow_pages(bundle, base_url, headers, max_pages):
+    """Fetch pages following the given Bundle, in turn
+
+    Only `next` links on `base_url` are followed, so headers such as
+    `Authorization` aren't sent elsewhere.
+
+    :returns: (bundles, next_url) tuple; the Bundles fetched and the url of
+        the first page not fetched, None if every page was fetched
+    """
+    bundles = []
+    url = next_link(bundle)
+    while url:
+        if len(bundles) >= max_pages or split_relative(url, base_url) is None:
+            return bundles, url
+        response = http_session().get(url, headers=headers)
+        if not response.ok:
+            current_app.logger.warning(f"page fetch failed {response.status_code}: {url}")
+            return bundles, url
+        bundles.append(response.json())
+        url = next_link(bundles[-1])
+    return bundles, None
+
+
+def search_key(session_id, url):
+    """Key identifying the search `url` pages through, for the given session"""
+    parsed = urlparse(url)
+    params = [
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if k not in PAGING_PARAMS]
+    return session_id, normalize_path(parsed._replace(query='').geturl(), urlencode(params))
+
+
+def cached_page(session_id, relative_path, query_string):
+    """Returns previously prefetched page as `requests.Response`, or None"""
+    try:
+        data = cache_store().get(page_key(session_id, relative_path, query_string))
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+        return None
+    if data:
+        return deserialize_response(data)
+
+
+def fetch_page(url, iss, headers, patient_id, session_id, ttl):
+    """Fetch single page from upstream and store in the session's page cache"""
+    path, query_string = split_relative(url, iss)
+    key = request_key(
+        base_url=iss,
+        relative_path=path,
+        query_string=query_string,
+        patient_id=patient_id,
+        authorization=headers.get('Authorization'),
+        accept=headers.get('Accept'))
+    response = coalesce(key, lambda: http_session().get(url, headers=headers))
+    if not response.ok:
+        current_app.logger.debug(f"page prefetch failed {response.status_code}: {url}")
+        return None
+
+    cache_store().set(
+        page_key(session_id, path, query_string),
+        serialize_response(response),
+        ex=ttl)
+    return response
+
+
+def prefetch_pages(bundle, iss, headers, patient_id, session_id):
+    """Fetch and cache pages following the given Bundle
+
+    Offset paged servers are fetched concurrently, bounded by
+    `PAGE_PREFETCH_CONCURRENCY`; otherwise `next` links are followed in turn.
+    At most `PAGE_PREFETCH_MAX_PAGES` are fetched.
+    """
+    max_pages = current_app.config['PAGE_PREFETCH_MAX_PAGES']
+    ttl = current_app.config['PAGE_CACHE_TTL']
+
+    urls = page_urls(bundle, max_pages)
+    if urls is not None:
+        app = current_app._get_current_object()
+
+        def fetch(url):
+            with app.app_context():
+                return fetch_page(url, iss, headers, patient_id, session_id, ttl)
+
+        with ThreadPoolExecutor(
+                max_workers=current_app.config['PAGE_PREFETCH_CONCURRENCY']) as executor:
+            list(executor.map(fetch, urls))
+        return
+
+    url = next_link(bundle)
+    for _ in range(max_pages):
+        if split_relative(url, iss) is None:
+            break
+        response = fetch_page(url, iss, headers, patient_id, session_id, ttl)
+        if response is None:
+            break
+        url = next_link(response.json())
+
+
+def start_prefetch(bundle, iss, headers, patient_id, session_id):
+    """Prefetch pages following `bundle` in a background thread
+
+    A search is prefetched once per session at a time, and at most
+    `PAGE_PREFETCH_MAX_THREADS` prefetches run at once; requests beyond
+    either are simply not prefetched.
+    """
+    url = next_link(bundle)
+    if not url:
+        return
+
+    key = search_key(session_id, url)
+    with _prefetching_lock:
+        if key in _prefetching:
+            return
+        if len(_prefetching) >= current_app.config['PAGE_PREFETCH_MAX_THREADS']:
+            current_app.logger.debug(f"page prefetch skipped, threads exhausted: {url}")
+            return
+        _prefetching.add(key)
+
+    # only the paging details are needed; caller is free to modify bundle
+    bundle = {'total': bundle.get('total'), 'link': deepcopy(bundle.get('link', []))}
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            try:
+                prefetch_pages(bundle, iss, headers, patient_id, session_id)
+            except Exception as ex:
+                app.logger.exception(ex)
+            finally:
+                with _prefetching_lock:
+                    _prefetching.discard(key)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,137 @@
+"""Prewarm caches with patient data immediately after authorization
+
+The frontend's first requests following launch (Patient, Conditions,
+Observations, etc.) are predictable.  Given a configured `PREFETCH_PROFILE`,
+a background job started once the token exchange completes fetches those
+resources from the launch and secondary servers, filling the proxy
+response cache, mapping the patient on secondary servers and persisting
+launch server resources to `LAUNCH_CACHE_URL`.
+
+Prewarmed responses are dropped once the session writes (PUT, POST,
+DELETE) through the proxy, see `discard_prewarmed`.
+"""
+import threading
+
+from flask import current_app, g
+
+from confidential_backend.extensions import launch_cache, strategy_registry
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import (
+    RESPONSE_PREFIX,
+    cache_response,
+    cache_store,
+    request_key,
+    store_error,
+)
+
+# hash of the response cache keys prewarmed for a session
+KEYS_PREFIX = 'prewarm:keys:'
+
+
+def profile_paths(patient_id):
+    """Returns relative paths from `PREFETCH_PROFILE` for the given patient"""
+    return [
+        path.format(patient=patient_id)
+        for path in current_app.config['PREFETCH_PROFILE']]
+
+
+def record_prewarmed(session_id, key, ttl):
+    """Note `key` as prewarmed for the session, see `discard_prewarmed`"""
+    try:
+        store = cache_store()
+        store.hset(f'{KEYS_PREFIX}{session_id}', key, 1)
+        store.expire(f'{KEYS_PREFIX}{session_id}', ttl)
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+
+
+def discard_prewarmed(session_id):
+    """Drop responses prewarmed for the session, once stale by its writes"""
+    try:
+        store = cache_store()
+        keys = [
+            key.decode() if isinstance(key, bytes) else key
+            for key in store.hgetall(f'{KEYS_PREFIX}{session_id}')]
+        if keys:
+            store.delete(
+                f'{KEYS_PREFIX}{session_id}', *(f'{RESPONSE_PREFIX}{key}' for key in keys))
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+
+
+def prewarm(session_id, iss, patient_id, access_token):
+    """Fetch configured profile from launch and secondary servers, filling caches
+
+    :param session_id: session of the authorized user
+    :param iss: launch FHIR server base url
+    :param patient_id: launch patient id
+    :param access_token: launch access token, as presented by the frontend
+    """
+    # used for session lookup and storage of secondary patient ids
+    g.session_id = session_id
+    ttl = current_app.config['PREFETCH_CACHE_TTL']
+    headers = {
+        'Accept': current_app.config['PREFETCH_ACCEPT'],
+        'Authorization': f'Bearer {access_token}',
+    }
+
+    secondary_sources = strategy_registry.for_issuer(iss)
+    paths = profile_paths(patient_id)
+    # Patient first, as the secondary patient mapping depends on it
+    paths.sort(key=lambda path: not path.startswith('Patient'))
+
+    for path in paths:
+        response = http_session().get('/'.join((iss, path)), headers=headers)
+        if not response.ok:
+            current_app.logger.debug(
+                f"prewarm of {path} failed: {response.status_code}")
+            continue
+
+        request_path, _, query_string = path.partition('?')
+        key = request_key(
+            base_url=iss,
+            relative_path=request_path,
+            query_string=query_string,
+            patient_id=patient_id,
+            authorization=headers['Authorization'],
+            accept=headers['Accept'])
+        cache_response(key, response, ttl)
+        record_prewarmed(session_id, key, ttl)
+        launch_cache.persist(response.json())
+
+        if request_path.startswith('Patient'):
+            for source in secondary_sources:
+                try:
+                    source.lookup_identified_patient(response.json())
+                except RuntimeError as ex:
+                    current_app.logger.error(f"prewarm patient lookup failed: {ex}")
+            continue
+
+        for source in secondary_sources:
+            if not source.translated_patient_id():
+                continue
+            secondary_fhir_url = source.adjust_patient_query(path, patient_id)
+            secondary_response = http_session().get(secondary_fhir_url, headers=headers)
+            if secondary_response.ok:
+                key = source.cache_key(secondary_fhir_url, headers)
+                cache_response(key, secondary_response, ttl)
+                record_prewarmed(session_id, key, ttl)
+
+
+def start_prewarm(session_id, iss, patient_id, access_token):
+    """Run `prewarm` in a background thread, if a profile is configured"""
+    if not (current_app.config['PREFETCH_PROFILE'] and session_id and patient_id):
+        return
+
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            try:
+                prewarm(session_id, iss, patient_id, access_token)
+            except Exception as ex:
+                app.logger.exception(ex)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
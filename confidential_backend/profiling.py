@@ -0,0 +1,110 @@
+"""Opt-in sampling profiler for live workers
+
+With `PROFILE_ENABLED`, a `PROFILE_SAMPLE_RATE` fraction of requests runs
+under cProfile, the stats written to `DEBUG_OUTPUT_DIR` as
+`profile-<endpoint>-<stamp>-<pid>.prof` (for `pstats` or snakeviz).  One
+request per process is profiled at a time; others go unsampled meanwhile.
+
+With `PROFILE_TRACEMALLOC` also set, sampled requests record the top
+allocation sites (by size, net of those before the request) alongside,
+as `tracemalloc-<endpoint>-<stamp>-<pid>.txt`.  NB tracing allocations
+slows every request, not only those sampled.
+
+When disabled, no request hooks are installed.  Results are listed and
+served by the `/admin/profiles` endpoints, see `api.views`.
+"""
+from datetime import datetime, timezone
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import tracemalloc
+
+from flask import current_app, g, request
+
+PROFILE_PATTERN = re.compile(r'^(profile|tracemalloc)-[\w.-]+\.(prof|txt)$')
+# allocation sites recorded per sampled request
+TRACEMALLOC_TOP = 25
+
+_profiling = threading.Lock()
+
+
+def init_profiling(app):
+    """Install request hooks sampling requests for profiling, if enabled"""
+    if not app.config['PROFILE_ENABLED']:
+        return
+    if app.config['PROFILE_TRACEMALLOC'] and not tracemalloc.is_tracing():
+        tracemalloc.start(app.config['PROFILE_TRACEMALLOC_FRAMES'])
+    app.before_request(start_sample)
+    app.teardown_request(finish_sample)
+
+
+def start_sample():
+    if random.random() >= current_app.config['PROFILE_SAMPLE_RATE']:
+        return
+    # cProfile supports a single active profiler
+    if not _profiling.acquire(blocking=False):
+        return
+    if tracemalloc.is_tracing():
+        g.tracemalloc_snapshot = tracemalloc.take_snapshot()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def finish_sample(exc=None):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        name = sample_name()
+        directory = current_app.config['DEBUG_OUTPUT_DIR']
+        profiler.dump_stats(os.path.join(directory, f"profile-{name}.prof"))
+
+        before = g.pop('tracemalloc_snapshot', None)
+        if before is not None:
+            stats = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+            with open(os.path.join(directory, f"tracemalloc-{name}.txt"), 'w') as report:
+                report.write(f"{request.method} {request.path}\n")
+                report.writelines(f"{stat}\n" for stat in stats[:TRACEMALLOC_TOP])
+    except Exception as ex:
+        current_app.logger.warning(f"failed to write profile: {ex}")
+    finally:
+        _profiling.release()
+
+
+def sample_name():
+    """Returns unique name for the current request's profile results"""
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    return f"{request.endpoint or 'unknown'}-{stamp}-{os.getpid()}"
+
+
+def profile_files():
+    """Returns names of profiles and allocation reports in `DEBUG_OUTPUT_DIR`, newest first"""
+    directory = current_app.config['DEBUG_OUTPUT_DIR']
+    names = [name for name in os.listdir(directory) if PROFILE_PATTERN.match(name)]
+    return sorted(
+        names, key=lambda name: os.path.getmtime(os.path.join(directory, name)), reverse=True)
+
+
+def profile_report(name, sort='cumulative', limit=50):
+    """Returns text report for the named profile or allocation report
+
+    :param name: file name, as listed by `profile_files`
+    :param sort: `pstats` sort key, for profiles
+    :param limit: functions included, for profiles
+    :raises FileNotFoundError: if the name doesn't match a listed file
+    """
+    if not PROFILE_PATTERN.match(name):
+        raise FileNotFoundError(name)
+    path = os.path.join(current_app.config['DEBUG_OUTPUT_DIR'], name)
+    if name.endswith('.txt'):
+        with open(path) as report:
+            return report.read()
+
+    output = io.StringIO()
+    pstats.Stats(path, stream=output).sort_stats(sort).print_stats(limit)
+    return output.getvalue()
@@ -0,0 +1,538 @@
+"""Shared keys and storage for responses proxied from upstream FHIR servers
+
+Upstream responses are keyed by everything that may influence the body
+returned, namely the FHIR server, the (normalized) request path and query,
+the patient in context and the credentials presented.
+"""
+from copy import deepcopy
+from datetime import datetime, timezone
+from email.utils import format_datetime
+import hashlib
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from flask import current_app
+import msgpack
+import requests
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+RESPONSE_PREFIX = 'response:'
+VALIDATED_PREFIX = 'validated:'
+STALE_PREFIX = 'stale:'
+REFRESH_LOCK_PREFIX = 'stale:refresh:'
+
+# Warning headers marking responses served from the stale store, see `serve_stale`
+WARNING_STALE = '110 - "Response is Stale"'
+WARNING_REVALIDATION_FAILED = '111 - "Revalidation Failed"'
+
+# response headers identifying a representation, and the request headers to revalidate it
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+
+def normalize_path(relative_path, query_string=''):
+    """Return path with query parameters in a stable (sorted) order
+
+    :param relative_path: FHIR request path, potentially including query string
+    :param query_string: additional query string, such as from the inbound request
+    """
+    parsed = urlparse(relative_path)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    if query_string:
+        params.extend(parse_qsl(query_string, keep_blank_values=True))
+    path = parsed.path.strip('/')
+    if not params:
+        return path
+    return '?'.join((path, urlencode(sorted(params))))
+
+
+def request_key(base_url, relative_path, query_string, patient_id, authorization, accept=None):
+    """Generate key uniquely identifying an upstream FHIR request
+
+    :param base_url: FHIR server base url, i.e. the launch `iss`
+    :param relative_path: FHIR request path beyond the base url
+    :param query_string: query string not included in `relative_path`
+    :param patient_id: patient in context
+    :param authorization: Authorization header value to be sent upstream
+    :param accept: Accept header value to be sent upstream
+
+    :returns: hex digest, safe for use in cache keys; raw credentials are never
+        included in the key itself
+    """
+    parts = (
+        base_url.rstrip('/'),
+        normalize_path(relative_path, query_string),
+        patient_id or '',
+        authorization or '',
+        accept or '',
+    )
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def serialize_response(response):
+    """Serialize the portions of a `requests.Response` needed to replay it"""
+    return msgpack.dumps({
+        'status_code': response.status_code,
+        'reason': response.reason,
+        'url': response.url,
+        'headers': dict(response.headers),
+        'content': response.content,
+    })
+
+
+def deserialize_response(data):
+    """Rebuild a `requests.Response` from `serialize_response` output"""
+    values = msgpack.loads(data)
+    response = Response()
+    response.status_code = values['status_code']
+    response.reason = values['reason']
+    response.url = values['url']
+    response.headers = CaseInsensitiveDict(values['headers'])
+    response._content = values['content']
+    response.encoding = 'utf-8'
+    return response
+
+
+def cache_response(key, response, ttl):
+    """Store upstream response for `ttl` seconds, see `cached_response`"""
+    try:
+        cache_store().set(f'{RESPONSE_PREFIX}{key}', serialize_response(response), ex=ttl)
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+
+
+def cached_response(key):
+    """Returns cached upstream response as `requests.Response`, or None"""
+    try:
+        data = cache_store().get(f'{RESPONSE_PREFIX}{key}')
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+        return None
+    if data:
+        return deserialize_response(data)
+
+
+def response_validators(response):
+    """Returns validators (`ETag`, `Last-Modified`) for given response
+
+    Servers not sending the headers are covered, for single resources, by
+    the FHIR convention of `ETag: W/"<meta.versionId>"` and `meta.lastUpdated`.
+
+    :returns: dict of validator header name to value, empty if none available
+    """
+    validators = {
+        header: response.headers[header]
+        for header in VALIDATOR_HEADERS if response.headers.get(header)}
+    if len(validators) == len(VALIDATOR_HEADERS):
+        return validators
+
+    try:
+        resource = response.json()
+    except ValueError:
+        return validators
+    if not isinstance(resource, dict) or resource.get('resourceType') in (None, 'Bundle'):
+        return validators
+
+    meta = resource.get('meta') or {}
+    if 'ETag' not in validators and meta.get('versionId'):
+        validators['ETag'] = f'W/"{meta["versionId"]}"'
+    if 'Last-Modified' not in validators and meta.get('lastUpdated'):
+        try:
+            last_updated = datetime.fromisoformat(meta['lastUpdated'])
+        except ValueError:
+            return validators
+        if last_updated.tzinfo is not None:
+            validators['Last-Modified'] = format_datetime(
+                last_updated.astimezone(timezone.utc), usegmt=True)
+    return validators
+
+
+def conditional_request(key, headers, send):
+    """Fire GET, revalidating any prior response stored under the given key
+
+    Upstream validators from a prior response are sent as `If-None-Match`
+    and `If-Modified-Since`; on `304 Not Modified` the stored response is
+    returned, sparing transfer of the unchanged payload.
+
+    :param key: key identifying the request, see `request_key`
+    :param headers: request headers, lacking client supplied validators
+    :param send: callable firing the request given headers, returning a
+        `requests.Response`
+    :returns: upstream response, or the stored response if not modified
+    """
+    if not current_app.config['CONDITIONAL_REQUESTS_ENABLED']:
+        return send(headers)
+
+    store = cache_store()
+    try:
+        stored = store.get(f'{VALIDATED_PREFIX}{key}')
+    except store_error() as ex:
+        # fail open; the store is an optimization, not a dependency
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+        return send(headers)
+    cached = deserialize_response(stored) if stored else None
+
+    request_headers = dict(headers)
+    if cached is not None:
+        validators = response_validators(cached)
+        for validator, conditional in zip(VALIDATOR_HEADERS, CONDITIONAL_HEADERS):
+            if validator in validators:
+                request_headers[conditional] = validators[validator]
+
+    response = send(request_headers)
+    ttl = current_app.config['CONDITIONAL_CACHE_TTL']
+    try:
+        if response.status_code == 304 and cached is not None:
+            store.expire(f'{VALIDATED_PREFIX}{key}', ttl)
+            return cached
+        if response.status_code == 200 and response_validators(response):
+            store.set(f'{VALIDATED_PREFIX}{key}', serialize_response(response), ex=ttl)
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+    return response
+
+
+class MemoryStore(object):
+    """Minimal in process stand in for the subset of redis used by the proxy
+
+    Used in place of redis when TESTING, see `Store_Singleton`
+    """
+    def __init__(self):
+        # reentrant, so `_MemoryPipeline.execute` may hold it across commands
+        self._lock = threading.RLock()
+        self._data = {}
+
+    def _live(self, name):
+        value, expires_at = self._data.get(name, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(name, None)
+            return None
+        return value
+
+    def get(self, name):
+        with self._lock:
+            return self._live(name)
+
+    def set(self, name, value, ex=None, px=None, nx=False):
+        with self._lock:
+            if nx and self._live(name) is not None:
+                return None
+            expires_at = None
+            if ex is not None:
+                expires_at = time.monotonic() + ex
+            elif px is not None:
+                expires_at = time.monotonic() + px / 1000
+            self._data[name] = (value, expires_at)
+            return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._data.pop(name, None) is not None)
+
+    def exists(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._live(name) is not None)
+
+    def expire(self, name, time_seconds):
+        with self._lock:
+            value = self._live(name)
+            if value is None:
+                return False
+            self._data[name] = (value, time.monotonic() + time_seconds)
+            return True
+
+    def pttl(self, name):
+        with self._lock:
+            if self._live(name) is None:
+                return -2
+            expires_at = self._data[name][1]
+            if expires_at is None:
+                return -1
+            return int((expires_at - time.monotonic()) * 1000)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        with self._lock:
+            hash_value = self._live(name)
+            if hash_value is None:
+                hash_value = {}
+                self._data[name] = (hash_value, None)
+            hash_value.update(items)
+            return len(items)
+
+    def hmget(self, name, keys, *args):
+        keys = ([keys] if isinstance(keys, str) else list(keys)) + list(args)
+        with self._lock:
+            hash_value = self._live(name) or {}
+            return [hash_value.get(key) for key in keys]
+
+    def hexists(self, name, key):
+        with self._lock:
+            return key in (self._live(name) or {})
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._live(name) or {})
+
+    def rpush(self, name, *values):
+        with self._lock:
+            list_value = self._live(name)
+            if list_value is None:
+                list_value = []
+                self._data[name] = (list_value, None)
+            list_value.extend(values)
+            return len(list_value)
+
+    def lpop(self, name):
+        with self._lock:
+            list_value = self._live(name)
+            if not list_value:
+                return None
+            return list_value.pop(0)
+
+    def llen(self, name):
+        with self._lock:
+            return len(self._live(name) or [])
+
+    def zadd(self, name, mapping):
+        with self._lock:
+            zset_value = self._live(name)
+            if zset_value is None:
+                zset_value = {}
+                self._data[name] = (zset_value, None)
+            added = len(set(mapping) - set(zset_value))
+            zset_value.update(mapping)
+            return added
+
+    def zrem(self, name, *values):
+        with self._lock:
+            zset_value = self._live(name) or {}
+            return sum(1 for value in values if zset_value.pop(value, None) is not None)
+
+    def zcard(self, name):
+        with self._lock:
+            return len(self._live(name) or {})
+
+    def zremrangebyscore(self, name, min, max):
+        with self._lock:
+            zset_value = self._live(name) or {}
+            expired = [value for value, score in zset_value.items() if min <= score <= max]
+            for value in expired:
+                del zset_value[value]
+            return len(expired)
+
+    def pipeline(self, transaction=True):
+        return _MemoryPipeline(self)
+
+    def transaction(self, func, *watches):
+        """Call `func` with a pipeline watching given keys, retrying on conflict"""
+        from redis.exceptions import WatchError  # deferred, as in `Store_Singleton.store`
+        pipe = self.pipeline()
+        while True:
+            try:
+                pipe.watch(*watches)
+                result = func(pipe)
+                pipe.execute()
+                return result
+            except WatchError:
+                continue
+            finally:
+                pipe.reset()
+
+
+class _MemoryPipeline(object):
+    """Queue commands, executing them in order on `execute`
+
+    As with redis, commands run immediately between `watch` and `multi`;
+    `execute` fails with `WatchError` should a watched key change meanwhile.
+    """
+    def __init__(self, store):
+        self._store = store
+        self.reset()
+
+    def __getattr__(self, name):
+        method = getattr(self._store, name)
+        if self._immediate:
+            return method
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def watch(self, *names):
+        with self._store._lock:
+            self._watched.update({name: deepcopy(self._store._live(name)) for name in names})
+        self._immediate = True
+
+    def multi(self):
+        self._immediate = False
+
+    def reset(self):
+        self._commands = []
+        self._watched = {}
+        self._immediate = False
+
+    def execute(self):
+        with self._store._lock:
+            if any(self._store._live(name) != value for name, value in self._watched.items()):
+                self.reset()
+                from redis.exceptions import WatchError
+                raise WatchError("watched key changed")
+            results = [method(*args, **kwargs) for method, args, kwargs in self._commands]
+        self.reset()
+        return results
+
+
+class Store_Singleton(object):
+    """Lazily bootstrapped store shared by proxy caching features"""
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Store_Singleton, cls).__new__(cls)
+            cls._instance._store = None
+        return cls._instance
+
+    @property
+    def store(self):
+        if self._store is None:
+            if current_app.config['TESTING']:
+                self._store = MemoryStore()
+            else:
+                import redis  # deferred; spares importers (such as celery tasks) the cost
+                self._store = redis.StrictRedis.from_url(
+                    current_app.config.get("REQUEST_CACHE_URL"))
+        return self._store
+
+
+def cache_store():
+    """Returns the redis (or in memory, when testing) store for proxy caches"""
+    return Store_Singleton().store
+
+
+def store_error():
+    """Returns the base exception raised by a failing (redis) store, see `cache_store`"""
+    from redis.exceptions import RedisError  # deferred, as in `Store_Singleton.store`
+    return RedisError
+
+
+def store_last_good(key, response):
+    """Retain given (200) response as the last good response for key, see `serve_stale`"""
+    ttl = max(
+        current_app.config['STALE_WHILE_REVALIDATE'], current_app.config['STALE_IF_ERROR'])
+    try:
+        cache_store().set(f'{STALE_PREFIX}{key}', msgpack.dumps({
+            'stored_at': time.time(),
+            'response': serialize_response(response),
+        }), ex=ttl)
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+
+
+def last_good(key, max_age, warning):
+    """Returns last good response for key if stored within `max_age` seconds, or None
+
+    The response is marked with `Age` and the given `Warning` header
+    """
+    try:
+        data = cache_store().get(f'{STALE_PREFIX}{key}')
+    except store_error() as ex:
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+        return None
+    if not data:
+        return None
+    values = msgpack.loads(data)
+    age = time.time() - values['stored_at']
+    if age > max_age:
+        return None
+    response = deserialize_response(values['response'])
+    response.headers['Age'] = str(int(age))
+    response.headers['Warning'] = warning
+    return response
+
+
+def refresh_in_background(key, fetch):
+    """Fire `fetch` in a background thread, storing a good response; one refresh per key at once"""
+    store = cache_store()
+    timeout_ms = int(current_app.config['SINGLE_FLIGHT_TIMEOUT'] * 1000)
+    try:
+        if not store.set(f'{REFRESH_LOCK_PREFIX}{key}', 1, px=timeout_ms, nx=True):
+            return
+    except store_error() as ex:
+        # without the lock, refreshes can't be limited to one per key
+        current_app.logger.warning(f"request cache unavailable: {ex}")
+        return
+    app = current_app._get_current_object()
+
+    def refresh():
+        with app.app_context():
+            try:
+                response = fetch()
+                if response.status_code == 200:
+                    store_last_good(key, response)
+            except Exception as ex:
+                current_app.logger.warning(f"background refresh failed: {ex}")
+            finally:
+                try:
+                    store.delete(f'{REFRESH_LOCK_PREFIX}{key}')
+                except store_error():
+                    pass  # lock expires with SINGLE_FLIGHT_TIMEOUT
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def serve_stale(key, fetch):
+    """Fire upstream GET, serving the last good response when stale content is permitted
+
+    Within `STALE_WHILE_REVALIDATE` seconds of storing, the last good
+    response is served straight away while a background request refreshes
+    it.  Should the upstream request fail (a server error, timeout or
+    connection failure), a last good response stored within `STALE_IF_ERROR`
+    seconds is served in place of the failure.  Either way, the response is
+    marked with `Age` and `Warning` headers; see `staleness_headers`.
+
+    :param key: key identifying the request, see `request_key`
+    :param fetch: callable firing the upstream request, returning a
+        `requests.Response`
+    """
+    stale_while_revalidate = current_app.config['STALE_WHILE_REVALIDATE']
+    stale_if_error = current_app.config['STALE_IF_ERROR']
+    if not stale_while_revalidate and not stale_if_error:
+        return fetch()
+
+    if stale_while_revalidate:
+        stale = last_good(key, stale_while_revalidate, WARNING_STALE)
+        if stale is not None:
+            refresh_in_background(key, fetch)
+            return stale
+
+    try:
+        response = fetch()
+    except requests.exceptions.RequestException as ex:
+        stale = last_good(key, stale_if_error, WARNING_REVALIDATION_FAILED)
+        if stale is None:
+            raise
+        current_app.logger.warning(f"upstream request failed, serving stale response: {ex}")
+        return stale
+
+    if response.status_code >= 500:
+        stale = last_good(key, stale_if_error, WARNING_REVALIDATION_FAILED)
+        if stale is not None:
+            current_app.logger.warning(
+                f"upstream returned {response.status_code}, serving stale response")
+            return stale
+    elif response.status_code == 200:
+        store_last_good(key, response)
+    return response
+
+
+def staleness_headers(response):
+    """Returns `Age` and `Warning` headers for responses served by `serve_stale`"""
+    if 'Warning' not in response.headers:
+        return {}
+    return {header: response.headers[header] for header in ('Age', 'Warning')}
@@ -0,0 +1,249 @@
+"""Replay captured `/fhir-router` traffic against a proxy and stub FHIR server
+
+Captures, as recorded to `FHIR_RESOURCES_LOGFILE` with
+`FHIR_CAPTURE_ENABLED` (see `fhirresourcelogger`), are replayed with
+their original spacing divided by a speed-up factor.  A local stub FHIR
+server answers the proxy's upstream requests with the captured responses,
+after the captured latency (likewise divided), so performance changes to
+the proxy can be measured on production shaped traffic.
+
+Each captured session is replayed through a session of its own, named
+`replay-<session digest>`, seeded into the proxy's session store with the
+stub as `iss`.  Run from the proxy's environment, so `SESSION_REDIS`
+matches, and disable secondary sources on the proxy under test:
+
+    python -m confidential_backend.replay fhir-resources.log \\
+        --proxy http://localhost:8000 --speedup 4
+
+NB captured latency is that of the complete proxy request, an upper bound
+on the upstream latency the stub imitates.
+"""
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import click
+import msgpack
+import requests
+
+from confidential_backend.fhirresourcelogger import CAPTURE_MESSAGE
+
+STUB_PREFIX = '/fhir'
+
+
+def canonical_query(query_string):
+    """Query string with parameters in sorted order, for matching requests"""
+    return urlencode(sorted(parse_qsl(query_string, keep_blank_values=True)))
+
+
+def load_captures(path, session=None):
+    """Load captures from given FHIR resources log, in order captured
+
+    :param path: FHIR_RESOURCES_LOGFILE to read
+    :param session: session digest, to load only that session's captures
+    """
+    captures = []
+    with open(path) as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('message') != CAPTURE_MESSAGE:
+                continue
+            if session and record['session'] != session:
+                continue
+            captures.append(record)
+    return sorted(captures, key=lambda capture: capture['captured_at'])
+
+
+class StubFhirServer(object):
+    """Serve captured responses, keyed by method, path and query string
+
+    Repeat requests for the same key cycle through its captures in order.
+    """
+    def __init__(self, captures, speedup, host='127.0.0.1', port=0):
+        self.speedup = speedup
+        self._lock = threading.Lock()
+        self._responses = defaultdict(deque)
+        for capture in captures:
+            self._responses[self.key(
+                capture['method'], capture['path'], capture['query'])].append(capture)
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                status, body = stub.respond(self.command, self.path)
+                payload = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/fhir+json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @staticmethod
+    def key(method, path, query):
+        return method, path.strip('/'), canonical_query(query)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{STUB_PREFIX}"
+
+    def respond(self, method, request_path):
+        """Returns (status, body) of the next capture matching the request"""
+        url = urlsplit(request_path)
+        path = url.path[len(STUB_PREFIX):] if url.path.startswith(STUB_PREFIX) else url.path
+        with self._lock:
+            captures = self._responses.get(self.key(method, path, url.query))
+            if not captures:
+                return 404, {'resourceType': 'OperationOutcome', 'issue': [{
+                    'severity': 'error', 'code': 'not-found',
+                    'diagnostics': f"no capture for {method} {request_path}"}]}
+            capture = captures[0]
+            captures.rotate(-1)
+        time.sleep(capture['elapsed_ms'] / 1000 / self.speedup)
+        return capture['status'], capture['fhir']
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def replay_session_id(session):
+    return f"replay-{session}"
+
+
+def seed_sessions(sessions, iss):
+    """Store a proxy session for each captured session, with the stub as `iss`"""
+    from confidential_backend.app import create_app
+    from confidential_backend.wrapped_session import write_session_layout
+
+    app = create_app(cli=True)
+    with app.app_context():
+        client = app.config['SESSION_REDIS']
+        prefix = app.config.get('SESSION_KEY_PREFIX', 'session:')
+        for session in sessions:
+            # patient only identifies the session's requests; paths name their own
+            session_data = {
+                'iss': iss, 'launch_token_patient': 'replay',
+                'token_response': {'patient': 'replay', 'access_token': 'replay'}}
+            write_session_layout(
+                client=client,
+                store_id=f"{prefix}{replay_session_id(session)}",
+                session_data=session_data,
+                encoded_session_data=msgpack.dumps(
+                    {k: v for k, v in session_data.items() if k != 'token_response'}),
+                ex=60 * 60)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def replay(captures, proxy_url, speedup, concurrency):
+    """Replay captures through the proxy, preserving their spacing divided by `speedup`
+
+    :returns: summary dict of request counts and latency (milliseconds)
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def send(capture):
+        url = f"{proxy_url.rstrip('/')}/fhir-router/{replay_session_id(capture['session'])}/{capture['path']}"
+        if capture['query']:
+            url = '?'.join((url, capture['query']))
+        start = time.monotonic()
+        try:
+            response = session.request(
+                capture['method'], url, json=capture.get('request_body'),
+                headers={'Authorization': 'Bearer replay', 'Accept': 'application/fhir+json'})
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        return status, capture['status'], (time.monotonic() - start) * 1000
+
+    results = []
+    if captures:
+        first = captures[0]['captured_at']
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = []
+            for capture in captures:
+                delay = (capture['captured_at'] - first) / speedup - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(send, capture))
+            results = [future.result() for future in futures]
+        wall_ms = (time.monotonic() - started) * 1000
+        captured_ms = (captures[-1]['captured_at'] - first) * 1000
+    else:
+        wall_ms = captured_ms = 0
+
+    latencies = [latency for _, _, latency in results]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for status, _, _ in results if status is None or status >= 500),
+        'status_mismatches': sum(1 for status, captured, _ in results if status != captured),
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'wall_ms': wall_ms,
+        'captured_ms': captured_ms,
+    }
+
+
+@click.command()
+@click.argument('logfile', type=click.Path(exists=True, dir_okay=False))
+@click.option('--proxy', default='http://localhost:8000', help="base url of the proxy under test")
+@click.option('--speedup', type=float, default=1.0, help="divide captured spacing and latency by")
+@click.option('--concurrency', type=int, default=16, help="maximum requests in flight")
+@click.option('--session', default=None, help="replay only the captured session with this digest")
+@click.option('--stub-host', default='127.0.0.1', help="interface for the stub FHIR server")
+@click.option('--stub-port', type=int, default=8089, help="port for the stub FHIR server")
+@click.option('--seed/--no-seed', default=True, help="seed proxy sessions naming the stub as iss")
+def main(logfile, proxy, speedup, concurrency, session, stub_host, stub_port, seed):
+    """Replay captured /fhir-router traffic from LOGFILE"""
+    captures = load_captures(logfile, session=session)
+    if not captures:
+        raise click.ClickException(f"no captures found in {logfile}")
+
+    stub = StubFhirServer(captures, speedup, host=stub_host, port=stub_port).start()
+    click.echo(f"stub FHIR server at {stub.base_url}")
+    try:
+        if seed:
+            seed_sessions({capture['session'] for capture in captures}, stub.base_url)
+        summary = replay(captures, proxy, speedup, concurrency)
+    finally:
+        stub.stop()
+    click.echo(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
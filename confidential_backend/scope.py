@@ -1,8 +1,19 @@
 """Module to manage scope definitions and checks"""
+from functools import lru_cache
 from fhir.smart.scopes import scopes
 from flask import current_app
 
 
+@lru_cache(maxsize=16)
+def configured_scopes(scope_string: str) -> scopes:
+    """Parse (once) a configured scope string, such as `LAUNCH_FHIR_SCOPES`
+
+    Wildcard scopes expand to every resource type, costly to repeat per
+    request.  NB the returned scopes are shared; don't modify.
+    """
+    return scopes(scope_string)
+
+
 def http_method_to_access(method: str) -> str:
     method = method.upper()
     if method == "DELETE":
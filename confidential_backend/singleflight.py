@@ -0,0 +1,158 @@
+"""Request coalescing (single-flight) for identical concurrent upstream requests
+
+The SMART frontend frequently fires the same search several times at once
+from independent components.  Rather than issue one upstream request per
+inbound request, the first caller (the leader) fires the request and any
+identical requests arriving while it is in flight wait for, and share, the
+leader's response.
+
+Coalescing happens per process by default.  When `SINGLE_FLIGHT_REDIS` is
+configured, a short lived redis lock extends the same behavior across
+workers, with followers picking up the leader's serialized response.
+"""
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from confidential_backend.proxycache import (
+    cache_store,
+    deserialize_response,
+    serialize_response,
+)
+
+LOCK_PREFIX = 'singleflight:lock:'
+RESULT_PREFIX = 'singleflight:result:'
+
+
+class _Call(object):
+    """Bookkeeping for a single in flight request"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """In process coalescing of concurrent calls sharing a key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Execute `fn` unless a call for `key` is already in flight
+
+        :param key: identifies equivalent calls
+        :param fn: callable to execute, taking no arguments
+
+        :returns: result of `fn`, from this or the concurrent leader's call.
+            Exceptions raised by the leader are raised in all waiting callers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+def redis_do(store, key, fn, timeout, poll_interval=0.05):
+    """Coalesce calls for `key` across processes sharing `store`
+
+    The caller obtaining the lock fires `fn` and publishes the serialized
+    response for any followers.  The lock holds a token unique to the
+    leader's flight, naming the published result, so followers only ever
+    pick up the response of the flight they joined.  Followers poll for the
+    published response, falling back to firing `fn` themselves should the
+    leader fail to publish within `timeout` seconds.
+
+    Store errors fall back to firing `fn` without coalescing.
+    """
+    from redis.exceptions import RedisError  # deferred, see `proxycache.store_error`
+
+    timeout_ms = int(timeout * 1000)
+    lock_key = f'{LOCK_PREFIX}{key}'
+    token = uuid.uuid4().hex
+
+    try:
+        leader = store.set(lock_key, token, px=timeout_ms, nx=True)
+    except RedisError as ex:
+        current_app.logger.warning(f"single flight store unavailable: {ex}")
+        return fn()
+
+    if leader:
+        try:
+            response = fn()
+            try:
+                store.set(
+                    f'{RESULT_PREFIX}{key}:{token}', serialize_response(response),
+                    px=timeout_ms)
+            except RedisError as ex:
+                # followers fire their own requests once the lock is released
+                current_app.logger.warning(f"single flight store unavailable: {ex}")
+        finally:
+            try:
+                store.delete(lock_key)
+            except RedisError:
+                pass  # lock expires with the timeout
+        return response
+
+    deadline = time.monotonic() + timeout
+    try:
+        token = store.get(lock_key)
+        if isinstance(token, bytes):
+            token = token.decode()
+        while token and time.monotonic() < deadline:
+            # read the lock before the result; once the lock no longer holds
+            # this flight's token, the leader has published or never will
+            held = store.get(lock_key)
+            data = store.get(f'{RESULT_PREFIX}{key}:{token}')
+            if data:
+                return deserialize_response(data)
+            if held not in (token, token.encode()):
+                break
+            time.sleep(poll_interval)
+    except RedisError as ex:
+        current_app.logger.warning(f"single flight store unavailable: {ex}")
+    return fn()
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(key, fn):
+    """Execute `fn` (an upstream GET) at most once per concurrent `key`
+
+    :param key: request key, see `proxycache.request_key`
+    :param fn: callable returning a `requests.Response`
+
+    Honors `SINGLE_FLIGHT_ENABLED` and `SINGLE_FLIGHT_REDIS` configuration.
+    """
+    if not current_app.config['SINGLE_FLIGHT_ENABLED']:
+        return fn()
+
+    if not current_app.config['SINGLE_FLIGHT_REDIS']:
+        return single_flight.do(key, fn)
+
+    timeout = current_app.config['SINGLE_FLIGHT_TIMEOUT']
+    store = cache_store()
+    return single_flight.do(key, lambda: redis_do(store, key, fn, timeout))
@@ -0,0 +1,102 @@
+"""Registry of secondary source strategies, indexed by launch server (`iss`)
+
+Entries in `SECONDARY_SOURCE_STRATEGIES` may name the launch servers they
+serve with an `issuers` list; entries without apply to every launch
+server.  Requests then only consider the strategies relevant to their
+tenant.
+
+Strategy instances are shared by all requests and hold no per request
+state (see `source_strategy`).  When `SECONDARY_SOURCE_STRATEGIES_FILE` names
+a JSON file, it is used in place of `SECONDARY_SOURCE_STRATEGIES` and
+reloaded on change, checked at most every `STRATEGY_RELOAD_INTERVAL` seconds.
+"""
+import json
+import os
+import threading
+import time
+
+from flask import current_app
+
+from confidential_backend.dynamic_factory import build_strategy
+
+
+def normalize_issuer(iss):
+    return (iss or '').rstrip('/')
+
+
+class StrategyIndex(object):
+    """Immutable index of strategies by issuer, built from strategy configs"""
+    def __init__(self, strategy_configs):
+        entries = [(cfg.get('issuers'), build_strategy(cfg)) for cfg in strategy_configs]
+        self.strategies = tuple(strategy for _, strategy in entries)
+        self.shared = tuple(strategy for issuers, strategy in entries if not issuers)
+
+        known = {normalize_issuer(iss) for issuers, _ in entries for iss in issuers or ()}
+        # retain configured order within each issuer's strategies
+        self.by_issuer = {
+            iss: tuple(
+                strategy for issuers, strategy in entries
+                if not issuers or iss in map(normalize_issuer, issuers))
+            for iss in known}
+
+    def for_issuer(self, iss):
+        return self.by_issuer.get(normalize_issuer(iss), self.shared)
+
+
+class RegistryState(object):
+    """Per app registry state; swaps in a new `StrategyIndex` on reload"""
+    def __init__(self, app):
+        self.path = app.config.get('SECONDARY_SOURCE_STRATEGIES_FILE')
+        self.interval = app.config['STRATEGY_RELOAD_INTERVAL']
+        self._lock = threading.Lock()
+        self._next_check = time.monotonic() + self.interval
+        self._mtime = None
+        if self.path:
+            self._mtime = os.stat(self.path).st_mtime
+            self.index = StrategyIndex(self.read_file())
+        else:
+            self.index = StrategyIndex(app.config['SECONDARY_SOURCE_STRATEGIES'])
+
+    def read_file(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def maybe_reload(self):
+        """Rebuild index if the strategies file changed; errors retain the prior index"""
+        if not self.path or time.monotonic() < self._next_check:
+            return
+        # a single thread checks; others continue with the current index
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.interval
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            self.index = StrategyIndex(self.read_file())
+            self._mtime = mtime
+            current_app.logger.info(f"reloaded secondary source strategies from {self.path}")
+        except Exception as ex:
+            current_app.logger.error(
+                f"failed to reload secondary source strategies from {self.path}: {ex}")
+        finally:
+            self._lock.release()
+
+
+class StrategyRegistry(object):
+    """Flask extension providing secondary source strategies per launch server"""
+    def init_app(self, app):
+        app.extensions['strategy_registry'] = RegistryState(app)
+
+    def _state(self):
+        state = current_app.extensions['strategy_registry']
+        state.maybe_reload()
+        return state
+
+    def for_issuer(self, iss):
+        """Returns strategies (in configured order) applicable to given launch server"""
+        return self._state().index.for_issuer(iss)
+
+    def all(self):
+        """Returns every configured strategy"""
+        return self._state().index.strategies
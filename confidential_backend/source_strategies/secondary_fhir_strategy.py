@@ -1,13 +1,22 @@
 """Source Strategy implementation for a FHIR server in a secondary (non launch) role."""
 from fhir.smart.scopes import scopes
 import re
-import requests
 from urllib.parse import urlencode, urlparse, urlunparse, parse_qsl
 
-from flask import current_app, has_request_context
-
+from flask import current_app, g, has_request_context
+
+from confidential_backend.bundlescan import empty_body
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import (
+    CONDITIONAL_HEADERS,
+    cached_response,
+    conditional_request,
+    request_key,
+    serve_stale,
+)
 from confidential_backend.wrapped_session import get_session_value, set_session_value
 from confidential_backend.scope import request_allowed
+from confidential_backend.singleflight import coalesce
 from confidential_backend.source_strategies.source_strategy import SourceStrategy
 
 class SecondaryFhirStrategy(SourceStrategy):
@@ -84,13 +93,7 @@ class SecondaryFhirStrategy(SourceStrategy):
             # other FHIR servers return a 410 as they don't recognize
             # the next page reference
             return True
-        results = response.json()
-        if results.get('resourceType') == 'Bundle':
-            return results.get('total', -1) == 0
-        # handle servers that don't set total
-        if results.get('resourceType') == 'Bundle' and not results.get('entry'):
-            return True
-        return False
+        return empty_body(response.content)
 
     def lookup_identified_patient(self, launch_patient):
         """Using config identifiers, look for a patient match on other FHIR server
@@ -127,7 +130,7 @@ class SecondaryFhirStrategy(SourceStrategy):
 
         request_url = f"{self._server_url}/Patient"
         params = {"identifier": f"{self._mrn_system}|{mrn}"}
-        response = requests.get(request_url, params=params)
+        response = http_session().get(request_url, params=params)
         response.raise_for_status()
         # search returns a bundle - contents of exactly 1 indicates a match
         bundle = response.json()
@@ -145,7 +148,7 @@ class SecondaryFhirStrategy(SourceStrategy):
         assert match['resourceType'] == 'Patient'
         current_app.logger.debug(
             f"mapped launch patient {launch_patient['id']} to {match['id']} on {self.name}")
-        if has_request_context():
+        if has_request_context() or 'session_id' in g:
             set_session_value(self._session_patient_key, match['id'])
         return match
 
@@ -176,10 +179,44 @@ class SecondaryFhirStrategy(SourceStrategy):
         full_path = original_request.url[original_request.url.find(request_path):]
         secondary_fhir_url = self.adjust_patient_query(full_path, launch_patient_id)
         current_app.logger.debug(f"attempt secondary FHIR request {secondary_fhir_url}")
-        secondary_response = requests.request(
-            url=secondary_fhir_url,
-            method=original_request.method,
-            headers=headers,
-            json=original_request.json if original_request.method in ('POST', 'PUT') else None
-        )
-        return secondary_response
+
+        # read now, as `send` may run in a background refresh beyond the request
+        method = original_request.method
+        body = original_request.json if method in ('POST', 'PUT') else None
+
+        def send(request_headers):
+            return http_session().request(
+                url=secondary_fhir_url,
+                method=method,
+                headers=request_headers,
+                json=body
+            )
+
+        # client supplied validators pass straight through, see `route_fhir`
+        if original_request.method != 'GET' or any(
+                header in headers for header in CONDITIONAL_HEADERS):
+            return send(headers)
+
+        # serve prewarmed response if available, otherwise coalesce identical
+        # concurrent GETs, revalidating any prior response
+        key = self.cache_key(secondary_fhir_url, headers)
+        if current_app.config['PREFETCH_PROFILE']:
+            cached = cached_response(key)
+            if cached is not None:
+                return cached
+        return serve_stale(key, lambda: coalesce(
+            key, lambda: conditional_request(key, headers, send)))
+
+    def cache_key(self, secondary_fhir_url, headers):
+        """Returns key identifying request to this server, see `proxycache.request_key`
+
+        :param secondary_fhir_url: request url, as adjusted by `adjust_patient_query`
+        :param headers: the request headers to include
+        """
+        return request_key(
+            base_url=self._server_url,
+            relative_path=secondary_fhir_url[len(self._server_url):],
+            query_string='',
+            patient_id=self.translated_patient_id(),
+            authorization=headers.get('Authorization'),
+            accept=headers.get('Accept'))
@@ -0,0 +1,144 @@
+"""Lazy refresh of the session's EHR access token
+
+`route_fhir` checks the session's token response on each request; within
+`TOKEN_REFRESH_MARGIN` seconds of expiry, the refresh token is exchanged
+for a new access token, sparing users a relaunch when the original
+expires mid session.
+
+Refresh is single-flight per session: concurrent requests in a process
+share the leader's refresh, and a short lived redis lock keeps other
+workers from also hitting the token endpoint.  Requests losing the lock
+carry on with the current, not yet expired, token.
+
+Frontends continue to present the access token obtained at launch, see
+`auth_info`; tokens this session has superseded are swapped for the
+current one by `upstream_authorization`.
+"""
+import hashlib
+
+from authlib.oauth2.rfc6749 import OAuth2Token
+from flask import current_app
+
+from confidential_backend.auth.helpers import PooledOAuth2Session
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import cache_store, store_error
+from confidential_backend.singleflight import single_flight
+from confidential_backend.wrapped_session import get_session_value, set_session_values
+
+LOCK_PREFIX = 'tokenrefresh:lock:'
+SUPERSEDED_FIELD = 'superseded_access_tokens'
+# superseded tokens retained per session
+SUPERSEDED_MAX = 5
+
+
+def token_digest(access_token):
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+def needs_refresh(token_response):
+    """True if given token response expires within `TOKEN_REFRESH_MARGIN` and can be refreshed"""
+    if not token_response or not token_response.get('refresh_token'):
+        return False
+    return bool(OAuth2Token(dict(token_response)).is_expired(
+        leeway=current_app.config['TOKEN_REFRESH_MARGIN']))
+
+
+def token_endpoint():
+    """Returns the token endpoint of the session's authorization server"""
+    params = get_session_value('sof_client_params') or {}
+    if params.get('access_token_url'):
+        return params['access_token_url']
+    if params.get('server_metadata_url'):
+        metadata = http_session().get(
+            params['server_metadata_url'], headers={'Accept': 'application/json'})
+        metadata.raise_for_status()
+        return metadata.json()['token_endpoint']
+    raise ValueError("no token endpoint available for session")
+
+
+def refresh(token_response):
+    """Exchange the refresh token for a new access token
+
+    :returns: the refreshed token response; fields absent from the token
+        endpoint's response, such as `patient`, are retained
+    """
+    client = PooledOAuth2Session(
+        client_id=current_app.config['SOF_CLIENT_ID'],
+        client_secret=current_app.config['SOF_CLIENT_SECRET'],
+        default_timeout=(
+            current_app.config['HTTP_CONNECT_TIMEOUT'],
+            current_app.config['HTTP_READ_TIMEOUT']))
+    refreshed = client.refresh_token(
+        token_endpoint(), refresh_token=token_response['refresh_token'])
+    return {**token_response, **refreshed}
+
+
+def _refresh_session_token(session_id):
+    store = cache_store()
+    lock_key = f'{LOCK_PREFIX}{session_id}'
+    timeout_ms = int(current_app.config['TOKEN_REFRESH_LOCK_TIMEOUT'] * 1000)
+    if not store.set(lock_key, 1, px=timeout_ms, nx=True):
+        # another worker is refreshing; the current token remains valid meanwhile
+        return get_session_value('token_response')
+
+    try:
+        # re-read, another worker may have just refreshed
+        token_response = get_session_value('token_response')
+        if not needs_refresh(token_response):
+            return token_response
+        try:
+            refreshed = refresh(token_response)
+        except Exception as ex:
+            current_app.logger.warning(f"access token refresh failed: {ex}")
+            return token_response
+
+        superseded = get_session_value(SUPERSEDED_FIELD) or []
+        superseded = (superseded + [token_digest(token_response['access_token'])])[-SUPERSEDED_MAX:]
+        # together, so superseded tokens are always honoured
+        try:
+            set_session_values({SUPERSEDED_FIELD: superseded, 'token_response': refreshed})
+        except store_error() as ex:
+            # the refresh may have revoked the current token; use the new one regardless
+            current_app.logger.warning(f"refreshed access token not stored: {ex}")
+            return refreshed
+        current_app.logger.debug(f"refreshed access token for session {session_id}")
+        return refreshed
+    finally:
+        try:
+            store.delete(lock_key)
+        except store_error():
+            pass  # lock expires with TOKEN_REFRESH_LOCK_TIMEOUT
+
+
+def fresh_token_response(session_id, token_response):
+    """Returns the session's token response, refreshed first if about to expire
+
+    :param session_id: session owning the token
+    :param token_response: the session's current token response
+    """
+    if not current_app.config['TOKEN_REFRESH_ENABLED'] or not needs_refresh(token_response):
+        return token_response
+    try:
+        return single_flight.do(
+            f'{LOCK_PREFIX}{session_id}', lambda: _refresh_session_token(session_id))
+    except store_error() as ex:
+        # the current token remains valid until expiry; refresh on a later request
+        current_app.logger.warning(f"access token refresh skipped, store unavailable: {ex}")
+        return token_response
+
+
+def upstream_authorization(authorization, token_response):
+    """Returns Authorization header for upstream requests
+
+    Bearer tokens superseded by a refresh in this session are replaced with
+    the current access token; any other value is returned unchanged.
+    """
+    if not authorization or not token_response or not token_response.get('access_token'):
+        return authorization
+    scheme, _, presented = authorization.partition(' ')
+    current = token_response['access_token']
+    if scheme.lower() != 'bearer' or presented == current:
+        return authorization
+    if token_digest(presented) in (get_session_value(SUPERSEDED_FIELD) or []):
+        return f"Bearer {current}"
+    return authorization
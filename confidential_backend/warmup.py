@@ -0,0 +1,81 @@
+"""Warm up a freshly started worker before it serves traffic
+
+Without `--preload`, each gunicorn worker bootstraps lazily; the first
+requests it serves pay for redis connections, TLS handshakes with the
+upstream FHIR servers, SoF discovery and scope parsing.  When
+`WARMUP_ENABLED`, `warm_up` runs in a background thread as the worker
+starts, and `/ready` reports 503 until complete so load balancers can
+hold traffic back.
+"""
+import threading
+
+from confidential_backend.auth.views import discover_sof_client_params
+from confidential_backend.extensions import strategy_registry
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import cache_store
+from confidential_backend.scope import configured_scopes
+
+ready = threading.Event()
+
+
+def preconnect(app, url):
+    """Open a pooled connection to the host of given url"""
+    try:
+        http_session().head(url, timeout=5)
+    except Exception as ex:
+        app.logger.warning(f"warm up failed to connect to {url}: {ex}")
+
+
+def warm_up(app):
+    """Open connections and prime per process caches, then mark worker ready
+
+    :param app: the flask app, as warm up runs outside of any request
+    """
+    with app.app_context():
+        configured_scopes(app.config['LAUNCH_FHIR_SCOPES'])
+
+        for name, store in (
+                ('session', app.config.get('SESSION_REDIS')),
+                ('request cache', cache_store())):
+            try:
+                if store is not None and hasattr(store, 'ping'):
+                    store.ping()
+            except Exception as ex:
+                app.logger.warning(f"warm up failed to reach {name} redis: {ex}")
+
+        for source in strategy_registry.all():
+            if source.server_url():
+                preconnect(app, source.server_url())
+
+        for iss in app.config['WARMUP_ISSUERS']:
+            preconnect(app, iss)
+            try:
+                params = discover_sof_client_params(fhir_base_url=iss)
+            except Exception as ex:
+                app.logger.warning(f"warm up discovery failed for {iss}: {ex}")
+                continue
+            # JWKS themselves are fetched and cached by authlib on first use
+            for key in ('server_metadata_url', 'jwks_uri'):
+                if params.get(key):
+                    preconnect(app, params[key])
+
+    ready.set()
+    app.logger.debug("worker warm up complete")
+
+
+def start_warm_up(app):
+    """Warm up in a background thread when `WARMUP_ENABLED`, otherwise mark ready"""
+    if not app.config['WARMUP_ENABLED']:
+        ready.set()
+        return
+
+    def run():
+        try:
+            warm_up(app)
+        except Exception as ex:
+            app.logger.exception(ex)
+            ready.set()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -1,5 +1,104 @@
 import msgpack
-from flask import g, current_app, request, session
+from flask import g, current_app, has_request_context, request, session
+from flask_session.redis import RedisSessionInterface
+
+# Session storage layout in redis, given store_id `<SESSION_KEY_PREFIX><session_id>`:
+#   <store_id>          complete session data, less TOKEN_FIELD
+#   <store_id>:fields   hash of hot fields (see `is_hot_field`), each value msgpack encoded
+#   <store_id>:token    the (large) token response, msgpack encoded
+# Hot fields set outside the owning request (see `set_redis_session_values`)
+# are written to the hash alone, where present it takes precedence.
+TOKEN_FIELD = 'token_response'
+LAYOUT_MARKER = '__layout__'
+
+
+def fields_key(store_id):
+    return f'{store_id}:fields'
+
+
+def token_key(store_id):
+    return f'{store_id}:token'
+
+
+def is_hot_field(key):
+    """Hot fields are frequently read by requests lacking a session cookie"""
+    return key in current_app.config['SESSION_HOT_FIELDS'] or key.endswith('_patient_id')
+
+
+def write_session_layout(client, store_id, session_data, encoded_session_data, **expiry):
+    """Write session data, its hot fields and token material to their respective keys
+
+    :param client: redis client
+    :param store_id: prefixed session id
+    :param session_data: dict of complete session data
+    :param encoded_session_data: serialized session data, less TOKEN_FIELD
+    :param expiry: expiry for all keys, as `ex` (seconds) or `px` (milliseconds)
+    """
+    pipe = client.pipeline(transaction=False)
+    queue_session_layout(pipe, store_id, session_data, encoded_session_data, **expiry)
+    pipe.execute()
+
+
+def queue_session_layout(pipe, store_id, session_data, encoded_session_data, **expiry):
+    """Queue the commands of `write_session_layout` on given pipeline"""
+    hot_fields = {
+        k: msgpack.dumps(v) for k, v in session_data.items() if is_hot_field(k)}
+    hot_fields[LAYOUT_MARKER] = 1
+
+    pipe.set(store_id, encoded_session_data, **expiry)
+    if session_data.get(TOKEN_FIELD) is None:
+        pipe.delete(token_key(store_id))
+    else:
+        pipe.set(token_key(store_id), msgpack.dumps(session_data[TOKEN_FIELD]), **expiry)
+    pipe.delete(fields_key(store_id))
+    pipe.hset(fields_key(store_id), mapping=hot_fields)
+    if expiry.get('ex'):
+        pipe.expire(fields_key(store_id), expiry['ex'])
+    elif expiry.get('px'):
+        pipe.expire(fields_key(store_id), expiry['px'] // 1000 + 1)
+
+
+def overlay_hot_fields(session_data, encoded_fields):
+    """Apply hot field values (see `fields_key`) over given session data"""
+    for k, v in (encoded_fields or {}).items():
+        k = k.decode('utf-8') if isinstance(k, bytes) else k
+        if k != LAYOUT_MARKER:
+            session_data[k] = msgpack.loads(v)
+    return session_data
+
+
+class SplitRedisSessionInterface(RedisSessionInterface):
+    """Redis session storage with hot fields and token material kept apart
+
+    Requests identified only by session_id (see `get_session_value`) can
+    then fetch the few values needed without loading and decoding the
+    complete session.
+    """
+
+    def _retrieve_session_data(self, store_id):
+        serialized_session_data, serialized_fields, serialized_token = self.client.pipeline(
+            transaction=False).get(store_id).hgetall(fields_key(store_id)).get(
+                token_key(store_id)).execute()
+        if not serialized_session_data:
+            return None
+        session_data = overlay_hot_fields(
+            self.serializer.decode(serialized_session_data), serialized_fields)
+        if serialized_token:
+            session_data[TOKEN_FIELD] = msgpack.loads(serialized_token)
+        return session_data
+
+    def _delete_session(self, store_id):
+        self.client.delete(store_id, fields_key(store_id), token_key(store_id))
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        session_data = dict(session)
+        write_session_layout(
+            client=self.client,
+            store_id=store_id,
+            session_data=session_data,
+            encoded_session_data=self.serializer.encoder.encode(
+                {k: v for k, v in session_data.items() if k != TOKEN_FIELD}),
+            ex=int(session_lifetime.total_seconds()))
 
 
 def get_session_value(key, default=None):
@@ -12,20 +111,59 @@ def get_session_value(key, default=None):
     Until resolved, this function tries local and configured session
     and returns a value if found.
     """
-    if key in session:
+    if has_request_context() and key in session:
         return session.get(key, default)
 
     # session_id stored on entry point in `fhir_router`
     if 'session_id' in g:
-        return get_redis_session_data(g.session_id).get(key, default)
+        return get_redis_session_value(g.session_id, key, default)
 
 
 def set_session_value(key, value):
-    if request.cookies.get("session"):
-        session[key] = value
+    """Set session value for given key, see `set_session_values`"""
+    set_session_values({key: value})
+
+
+def set_session_values(values):
+    """Set session values, given as a dict, together
+
+    Writes to the flask-session when a browser cookie is available,
+    otherwise directly to the stored session named by `g.session_id`
+    """
+    if has_request_context() and request.cookies.get("session"):
+        session.update(values)
+        return
+
+    if 'session_id' in g:
+        set_redis_session_values(g.session_id, values)
         return
 
-    raise NotImplementedError("Can't set session variables w/o session cookie")
+    raise NotImplementedError("Can't set session variables w/o session cookie or session_id")
+
+
+def get_redis_session_value(session_id, key, default=None):
+    """Load single value from session data associated with given session_id
+
+    Hot fields and token material are read from their own keys; other
+    values (or sessions stored prior to the split layout) require loading
+    the complete session data.
+    """
+    if session_id is None:
+        return default
+
+    redis_handle = current_app.config['SESSION_REDIS']
+    store_id = current_app.config.get('SESSION_KEY_PREFIX', 'session:') + session_id
+
+    if is_hot_field(key):
+        value, layout = redis_handle.hmget(fields_key(store_id), key, LAYOUT_MARKER)
+        if layout is not None:
+            return default if value is None else msgpack.loads(value)
+    elif key == TOKEN_FIELD:
+        value = redis_handle.get(token_key(store_id))
+        if value is not None:
+            return msgpack.loads(value)
+
+    return get_redis_session_data(session_id).get(key, default)
 
 
 def get_redis_session_data(session_id):
@@ -36,8 +174,18 @@ def get_redis_session_data(session_id):
     # TODO: further investigate using SessionHandler
     redis_handle = current_app.config['SESSION_REDIS']
     session_prefix = current_app.config.get('SESSION_KEY_PREFIX', 'session:')
+    store_id = f'{session_prefix}{session_id}'
+
+    encoded_session_data, encoded_fields, encoded_token = redis_handle.pipeline(
+        transaction=False).get(store_id).hgetall(fields_key(store_id)).get(
+            token_key(store_id)).execute()
+    return decode_session_data(session_id, encoded_session_data, encoded_fields, encoded_token)
 
-    encoded_session_data = redis_handle.get(f'{session_prefix}{session_id}')
+
+def decode_session_data(session_id, encoded_session_data, encoded_fields, encoded_token):
+    """Session data from the values of its respective keys, see `write_session_layout`"""
+    if encoded_session_data is None:
+        return {}
 
     # why doesn't this use the flask default JSON serializer?
     # (probably because the session is designed to hold non JSON serializable objects, like datetime)
@@ -47,6 +195,65 @@ def get_redis_session_data(session_id):
         current_app.logger.error(f'Unable to load session data for {session_id}')
         current_app.logger.error(f'failed to decode {encoded_session_data}')
         session_data = {}
+    overlay_hot_fields(session_data, encoded_fields)
+    if encoded_token:
+        session_data[TOKEN_FIELD] = msgpack.loads(encoded_token)
     return session_data
 
 
+def set_redis_session_value(session_id, key, value):
+    """Update a single value in the session data associated with given session_id
+
+    See `set_redis_session_values`
+    """
+    set_redis_session_values(session_id, {key: value})
+
+
+def set_redis_session_values(session_id, values):
+    """Update values, given as a dict, in the session data associated with given session_id
+
+    Intended for use outside the request owning the session, such as from
+    background jobs; the remaining session data and its expiry are retained.
+    Values are written together, within a transaction retried should the
+    session change meanwhile, so concurrent writers don't undo one another.
+    Hot fields and token material are written to their own keys alone;
+    other values rewrite the session.
+    """
+    redis_handle = current_app.config['SESSION_REDIS']
+    session_prefix = current_app.config.get('SESSION_KEY_PREFIX', 'session:')
+    store_id = f'{session_prefix}{session_id}'
+    rewrite = any(not is_hot_field(k) and k != TOKEN_FIELD for k in values)
+
+    def update(pipe):
+        # watched; commands run immediately until `multi`
+        ttl = pipe.pttl(store_id)
+        expiry = {'px': ttl} if ttl and ttl > 0 else {}
+        if not rewrite and ttl != -2 and pipe.hexists(fields_key(store_id), LAYOUT_MARKER):
+            pipe.multi()
+            hot_fields = {k: msgpack.dumps(v) for k, v in values.items() if is_hot_field(k)}
+            if hot_fields:
+                pipe.hset(fields_key(store_id), mapping=hot_fields)
+            if TOKEN_FIELD in values:
+                if values[TOKEN_FIELD] is None:
+                    pipe.delete(token_key(store_id))
+                else:
+                    pipe.set(token_key(store_id), msgpack.dumps(values[TOKEN_FIELD]), **expiry)
+            return
+
+        session_data = decode_session_data(
+            session_id,
+            pipe.get(store_id),
+            pipe.hgetall(fields_key(store_id)),
+            pipe.get(token_key(store_id)))
+        session_data.update(values)
+        pipe.multi()
+        queue_session_layout(
+            pipe,
+            store_id=store_id,
+            session_data=session_data,
+            encoded_session_data=msgpack.dumps(
+                {k: v for k, v in session_data.items() if k != TOKEN_FIELD}),
+            **expiry)
+
+    redis_handle.transaction(
+        update, store_id, fields_key(store_id), token_key(store_id))
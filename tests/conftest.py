@@ -11,3 +11,21 @@ def app():
 def client(app):
     with app.test_client() as c:
         yield c
+
+
+@fixture
+def router_session():
+    """Session values seen by /fhir-router under `routed`; update to vary"""
+    return {"iss": "http://ehr.example.com/fhir", "token_response": {"patient": "1"}}
+
+
+@fixture
+def routed(app, mocker, router_session):
+    """App routing /fhir-router requests for `router_session`, without secondary sources"""
+    mocker.patch(
+        "confidential_backend.api.fhir.get_session_value",
+        lambda key, default=None: router_session.get(key, default))
+    mocker.patch("confidential_backend.api.fhir.launch_cache.persist")
+    mocker.patch(
+        "confidential_backend.api.fhir.strategy_registry.for_issuer", return_value=())
+    return app
@@ -1,3 +1,11 @@
+"""Tests for audit log entries"""
+import logging
+
+from pytest import fixture, raises
+
+from confidential_backend.audit import EVENT_LOG_NAME, AuditContextFilter, audit_entry
+
+
 def test_auditlog_missing_data(client):
     response = client.post('/auditlog')
     # no data, expect 400
@@ -30,3 +38,69 @@ def test_auditlog_post(client):
     }
     response = client.post('/auditlog', json=data)
     assert response.status_code == 200
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@fixture
+def sink():
+    handler = CollectingHandler()
+    handler.addFilter(AuditContextFilter())
+    logger = logging.getLogger(EVENT_LOG_NAME)
+    logger.addHandler(handler)
+    yield handler
+    logger.removeHandler(handler)
+
+
+def test_no_session_lookup_without_sink(app, mocker):
+    get_session_value = mocker.patch("confidential_backend.audit.get_session_value")
+    with app.app_context():
+        audit_entry("no sink", extra={"tags": ["test"]})
+    get_session_value.assert_not_called()
+
+
+def test_no_record_without_sink(app, mocker):
+    root_handler = CollectingHandler()
+    logging.getLogger().addHandler(root_handler)
+    make_record = mocker.spy(logging.Logger, "makeRecord")
+    try:
+        with app.app_context():
+            audit_entry("no sink", level="warning")
+    finally:
+        logging.getLogger().removeHandler(root_handler)
+    assert root_handler.records == []
+    make_record.assert_not_called()
+
+
+def test_sink_enriched(app, sink, mocker):
+    mocker.patch(
+        "confidential_backend.audit.get_session_value",
+        lambda key: {"user": "u@example.com"}.get(key))
+    with app.app_context():
+        audit_entry("with sink", extra={"tags": ["test"]})
+    record = sink.records[-1]
+    assert record.user == "u@example.com"
+    assert record.tags == ["test"]
+
+
+def test_error_scrubbed(app, sink, mocker):
+    error = mocker.patch.object(app.logger, "error")
+    extra = {"patient": "1", "tags": ["test"]}
+    with app.app_context():
+        audit_entry("failure", level="error", extra=extra)
+    assert error.call_args.kwargs["extra"]["patient"] == "REDACTED - see audit logs"
+    # audit log retains the original
+    assert sink.records[-1].patient == "1"
+    assert extra["patient"] == "1"
+
+
+def test_bogus_level(app):
+    with raises(ValueError):
+        audit_entry("bogus", level="chatty")
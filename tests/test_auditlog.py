@@ -0,0 +1,97 @@
+"""Tests for the /auditlog endpoint"""
+import json
+import logging
+
+from confidential_backend.audit import EVENT_LOG_NAME, audit_entries
+from confidential_backend.logserverhandler import LogServerHandler
+
+
+def test_single(client, mocker):
+    audit_entry = mocker.patch("confidential_backend.api.views.audit_entry")
+    response = client.post("/auditlog", json={"message": "clicked", "level": "info", "tag": "x"})
+    assert response.status_code == 200
+    audit_entry.assert_called_once_with("clicked", "info", {"tag": "x"})
+
+
+def test_single_invalid(client):
+    response = client.post("/auditlog", json={"level": "info"})
+    assert response.status_code == 400
+
+
+def test_batch(client, mocker):
+    audit_entries = mocker.patch("confidential_backend.api.views.audit_entries")
+    response = client.post("/auditlog", json=[
+        {"message": "one"},
+        {"message": "two", "level": "bogus"},
+        {"message": "three", "level": "warning", "tag": "x"},
+        "not an event",
+    ])
+    assert response.status_code == 200
+    assert response.json["accepted"] == 2
+    assert [e["index"] for e in response.json["errors"]] == [1, 3]
+    audit_entries.assert_called_once_with([
+        ("one", "info", {}), ("three", "warning", {"tag": "x"})])
+
+
+def test_ndjson(client, mocker):
+    audit_entries = mocker.patch("confidential_backend.api.views.audit_entries")
+    body = "\n".join(json.dumps({"message": f"event {i}"}) for i in range(3)) + "\n"
+    response = client.post(
+        "/auditlog", data=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.json["accepted"] == 3
+    assert len(audit_entries.call_args.args[0]) == 3
+
+
+def test_batch_too_large(app, client):
+    app.config["AUDITLOG_MAX_BATCH"] = 2
+    response = client.post("/auditlog", json=[{"message": "x"}] * 3)
+    assert response.status_code == 413
+
+
+def test_batch_single_post(app, requests_mock):
+    requests_mock.post("http://logserver/events")
+    handler = LogServerHandler(url="http://logserver", jwt="t")
+    logger = logging.getLogger(EVENT_LOG_NAME)
+    logger.addHandler(handler)
+    try:
+        with app.app_context():
+            audit_entries([("one", "info", {}), ("two", "info", {"tag": "x"})])
+    finally:
+        logger.removeHandler(handler)
+    assert requests_mock.call_count == 1
+    events = requests_mock.last_request.json()
+    assert [e["event"]["message"] for e in events] == ["one", "two"]
+
+
+def test_batch_reserved_keys(client, mocker):
+    audit_entries = mocker.patch("confidential_backend.api.views.audit_entries")
+    response = client.post("/auditlog", json=[
+        {"message": "one", "name": "x"},
+        {"message": "two", "tag": "x"},
+    ])
+    assert response.status_code == 200
+    assert response.json["errors"][0]["index"] == 0
+    assert "name" in response.json["errors"][0]["message"]
+    audit_entries.assert_called_once_with([("two", "info", {"tag": "x"})])
+
+
+def test_single_reserved_key(client):
+    response = client.post("/auditlog", json={"message": "clicked", "module": "x"})
+    assert response.status_code == 400
+
+
+def test_batch_logger_filters(app, requests_mock):
+    requests_mock.post("http://logserver/events")
+    handler = LogServerHandler(url="http://logserver", jwt="t")
+    logger = logging.getLogger(EVENT_LOG_NAME)
+    logger.addHandler(handler)
+    drop_two = lambda record: record.getMessage() != "two"
+    logger.addFilter(drop_two)
+    try:
+        with app.app_context():
+            audit_entries([("one", "info", {}), ("two", "info", {})])
+    finally:
+        logger.removeFilter(drop_two)
+        logger.removeHandler(handler)
+    assert [e["event"]["message"] for e in requests_mock.last_request.json()] == ["one"]
@@ -1,5 +1,7 @@
 from pytest import fixture
 from confidential_backend.auth.helpers import extract_payload, format_as_jwt
+from confidential_backend.proxycache import MemoryStore
+from confidential_backend.wrapped_session import get_redis_session_data
 
 @fixture
 def encoded_payload():
@@ -45,3 +47,33 @@ def test_bad_extract():
     jwt = format_as_jwt('ill formed string')
     assert len(jwt.split('.')) == 3
     assert extract_payload(jwt) == {}
+
+
+@fixture
+def session_store(app):
+    store = MemoryStore()
+    app.config['SESSION_REDIS'] = store
+    app.session_interface.client = store
+    return store
+
+
+def test_launch(app, session_store, encoded_payload, requests_mock):
+    iss = 'http://launch.example.com/fhir'
+    app.config.update(SOF_CLIENT_ID='client', SOF_CLIENT_SECRET='secret')
+    requests_mock.get(f'{iss}/.well-known/smart-configuration', json={
+        'authorization_endpoint': 'http://launch.example.com/auth/authorize',
+        'token_endpoint': 'http://launch.example.com/auth/token'})
+
+    response = app.test_client().get(
+        '/auth/launch', query_string={'iss': iss, 'launch': encoded_payload})
+    assert response.status_code == 302
+    assert response.location.startswith('http://launch.example.com/auth/authorize?')
+    assert 'aud=http' in response.location
+
+    with app.app_context():
+        session_id = response.headers['Set-Cookie'].split('=', 1)[1].split(';')[0]
+        stored = get_redis_session_data(session_id)
+    assert stored['iss'] == iss
+    assert stored['subject'] == 'Patient/41702'
+    assert stored['sof_client_params']['server_metadata_url'] == (
+        f'{iss}/.well-known/smart-configuration')
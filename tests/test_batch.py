@@ -0,0 +1,59 @@
+"""Tests for FHIR batch Bundles POSTed to the router"""
+
+iss = "http://ehr.example.com/fhir"
+
+
+def batch(*urls, method="GET"):
+    return {"resourceType": "Bundle", "type": "batch", "entry": [
+        {"request": {"method": method, "url": url}} for url in urls]}
+
+
+def test_batch_entries_routed(routed, requests_mock):
+    requests_mock.get(f"{iss}/Patient/1", json={"resourceType": "Patient", "id": "1"})
+    requests_mock.get(
+        f"{iss}/Observation?patient=1",
+        json={"resourceType": "Bundle", "type": "searchset", "entry": [
+            {"resource": {"resourceType": "Observation", "id": "o1"}}]})
+    requests_mock.get(f"{iss}/Condition?patient=1", status_code=500)
+
+    response = routed.test_client().post(
+        "/fhir-router/sid-batch/",
+        json=batch("Patient/1", "Observation?patient=1", "Condition?patient=1"),
+        headers={"Authorization": "Bearer t"})
+
+    assert response.status_code == 200
+    bundle = response.get_json()
+    assert bundle["type"] == "batch-response"
+    patient, observations, conditions = bundle["entry"]
+    assert patient["response"]["status"] == "200 OK"
+    assert patient["resource"]["id"] == "1"
+    assert observations["resource"]["entry"][0]["resource"]["id"] == "o1"
+    assert conditions["response"]["status"].startswith("500")
+    assert "resource" not in conditions
+    assert requests_mock.request_history[0].headers["Authorization"] == "Bearer t"
+
+
+def test_batch_scope_enforced(routed, requests_mock):
+    routed.config["LAUNCH_FHIR_SCOPES"] = "patient/Patient.rs"
+    requests_mock.get(f"{iss}/Patient/1", json={"resourceType": "Patient", "id": "1"})
+
+    response = routed.test_client().post(
+        "/fhir-router/sid-batch/", json=batch("Patient/1", "Observation?patient=1"))
+
+    patient, observations = response.get_json()["entry"]
+    assert patient["response"]["status"] == "200 OK"
+    assert "resource" not in observations
+    assert requests_mock.call_count == 1
+
+
+def test_transaction_rejected(routed):
+    bundle = dict(batch("Patient/1"), type="transaction")
+    response = routed.test_client().post("/fhir-router/sid-batch/", json=bundle)
+    assert response.status_code == 400
+
+
+def test_batch_size_limited(routed):
+    routed.config["FHIR_BATCH_MAX_ENTRIES"] = 1
+    response = routed.test_client().post(
+        "/fhir-router/sid-batch/", json=batch("Patient/1", "Patient/2"))
+    assert response.status_code == 413
@@ -0,0 +1,48 @@
+"""Lazy bootstrap tests
+
+Each runs in a fresh interpreter, as gunicorn and celery workers do.
+"""
+import json
+import os
+import subprocess
+import sys
+
+
+def run(statements, result, **env):
+    """Execute statements in a fresh interpreter, returning the JSON of `result`"""
+    code = '\n'.join((statements, "import json, sys", f"print(json.dumps({result}))"))
+    completed = subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, check=True, text=True,
+        env={**os.environ, **env})
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+def test_task_import_is_lazy():
+    """Importing tasks (as route_fhir does) mustn't build an app or redis client"""
+    modules = run("import confidential_backend.cachelaunchresponse", "sorted(sys.modules)")
+    assert 'confidential_backend.app' not in modules
+    assert 'redis' not in modules
+
+
+def test_config_import_is_lazy():
+    modules = run("import confidential_backend.config", "sorted(sys.modules)")
+    assert 'redis' not in modules
+
+
+def test_create_app_builds_single_app():
+    """Tasks share the created app; no second app, nor redis connection, at startup"""
+    result = run(
+        "import flask\n"
+        "built = []\n"
+        "init = flask.Flask.__init__\n"
+        "def counted(self, *args, **kwargs):\n"
+        "    built.append(self)\n"
+        "    init(self, *args, **kwargs)\n"
+        "flask.Flask.__init__ = counted\n"
+        "from confidential_backend.app import create_app\n"
+        "from confidential_backend.celery_factory import get_flask_app\n"
+        "app = create_app(testing=True)\n"
+        "connections = app.config['SESSION_REDIS'].connection_pool._created_connections",
+        "{'apps': len(built), 'shared': get_flask_app() is app, 'connections': connections}",
+        LAUNCH_CACHE_URL="http://cache.example.com/fhir")
+    assert result == {'apps': 1, 'shared': True, 'connections': 0}
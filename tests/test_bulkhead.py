@@ -0,0 +1,66 @@
+"""Tests for per source bulkhead admission control"""
+from pytest import fixture, raises
+
+from confidential_backend.bulkhead import BulkheadFull, admit
+
+
+@fixture
+def bulkheads(app):
+    app.config.update(
+        BULKHEAD_ENABLED=True,
+        BULKHEAD_LIMITS={"slow": 1},
+        BULKHEAD_DEFAULT_LIMIT=3,
+        BULKHEAD_SESSION_LIMIT=2)
+    return app
+
+
+def test_disabled_admits_all(app):
+    with app.app_context():
+        with admit("slow"), admit("slow"):
+            pass
+
+
+def test_source_limit(bulkheads):
+    with bulkheads.app_context():
+        with admit("slow"):
+            with raises(BulkheadFull) as full:
+                with admit("slow"):
+                    pass
+            assert full.value.source == "slow"
+        # slot released on exit
+        with admit("slow"):
+            pass
+
+
+def test_session_limit(bulkheads):
+    with bulkheads.app_context():
+        with admit("fast", "sid-a"), admit("fast", "sid-a"):
+            with raises(BulkheadFull):
+                with admit("fast", "sid-a"):
+                    pass
+            # other sessions retain their share
+            with admit("fast", "sid-b"):
+                pass
+
+
+def test_redis_slots(bulkheads):
+    bulkheads.config['BULKHEAD_REDIS'] = True
+    with bulkheads.app_context():
+        with admit("slow", "sid-redis"):
+            with raises(BulkheadFull):
+                with admit("slow", "sid-other"):
+                    pass
+        with admit("slow", "sid-redis"):
+            pass
+
+
+def test_full_launch_rejected(routed, bulkheads, mocker):
+    upstream = mocker.patch("confidential_backend.api.fhir.upstream_request")
+    bulkheads.config['BULKHEAD_LIMITS'] = {"launch": 0}
+    bulkheads.config['BULKHEAD_RETRY_AFTER'] = 2
+
+    response = bulkheads.test_client().get(
+        "/fhir-router/sid/Patient/1", headers={"Authorization": "Bearer t"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+    upstream.assert_not_called()
@@ -0,0 +1,57 @@
+"""Tests for empty response classification"""
+import json
+
+from pytest import mark
+
+from confidential_backend.bundlescan import empty_body, scan_head
+
+
+def body(document):
+    return json.dumps(document).encode('utf-8')
+
+
+entries = [{"resource": {"resourceType": "Observation", "id": "1"}}]
+
+
+@mark.parametrize("document, expected", [
+    ({"resourceType": "Bundle", "type": "searchset", "total": 0}, True),
+    ({"resourceType": "Bundle", "type": "searchset", "total": 1, "entry": entries}, False),
+    # servers not setting total
+    ({"resourceType": "Bundle", "type": "searchset"}, True),
+    ({"resourceType": "Bundle", "type": "searchset", "entry": []}, True),
+    ({"resourceType": "Bundle", "type": "searchset", "entry": entries}, False),
+    # members in non canonical order
+    ({"entry": [], "total": 0, "resourceType": "Bundle"}, True),
+    ({"entry": [], "resourceType": "Bundle"}, True),
+    ({"type": "searchset", "total": 0, "resourceType": "Bundle"}, True),
+    ({"resourceType": "Patient", "id": "1"}, False),
+    ({"resourceType": "OperationOutcome", "issue": []}, False),
+])
+def test_empty_body(document, expected):
+    assert empty_body(body(document)) is expected
+    # decided by the head scan alone
+    assert scan_head(body(document).decode()) is expected
+
+
+def test_large_bundle_decided_from_head():
+    document = {
+        "resourceType": "Bundle", "type": "searchset",
+        "entry": entries * 10000}
+    content = body(document)
+    assert scan_head(content[:100].decode()) is False
+    assert empty_body(content) is False
+
+
+def test_undecided_head_falls_back():
+    document = {
+        "resourceType": "Bundle",
+        "meta": {"tag": [{"code": "x" * 100}] * 100},
+        "total": 0}
+    content = body(document)
+    assert scan_head(content[:256].decode()) is None
+    assert empty_body(content, head_size=256) is True
+
+
+def test_whitespace():
+    content = b'{ "resourceType" : "Bundle" ,\n "entry" : [\n ]\n}'
+    assert scan_head(content.decode()) is True
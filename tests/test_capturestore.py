@@ -0,0 +1,63 @@
+"""Tests for the /save_data NDJSON capture store"""
+import json
+import os
+
+from pytest import fixture, mark
+
+from confidential_backend.capturestore import INDEX_FILENAME, capture_store
+
+
+@fixture
+def capture_app(app, tmp_path):
+    app.config.update({
+        'ENV': 'development',
+        'DEBUG_OUTPUT_DIR': str(tmp_path),
+        'SAVE_DATA_MODE': 'ndjson',
+        'CAPTURE_SEGMENT_MAX_BYTES': 200,
+    })
+    return app
+
+
+@mark.parametrize("compress", [False, True])
+def test_capture_and_read_back(capture_app, tmp_path, compress):
+    capture_app.config['CAPTURE_COMPRESS'] = compress
+    client = capture_app.test_client()
+    for i in range(5):
+        response = client.post('/save_data', json={
+            'filename': f'calc-{i}', 'context': 'CQL MME calc', 'data': {'value': i}})
+        assert response.status_code == 200
+
+    with capture_app.app_context():
+        store = capture_store()
+        store.flush()
+        assert len(store.lookup(context='CQL MME calc')) == 5
+
+    # small segment size forces rotation
+    segments = [f for f in os.listdir(tmp_path) if f.startswith('capture-') and f != INDEX_FILENAME]
+    assert len(segments) > 1
+    assert all(f.endswith('.gz') == compress for f in segments)
+
+    response = client.get('/save_data/calc-3')
+    assert response.status_code == 200
+    assert response.json['data'] == {'value': 3}
+    assert response.json['context'] == 'CQL MME calc'
+
+
+def test_unknown_capture(capture_app):
+    response = capture_app.test_client().get('/save_data/missing')
+    assert response.status_code == 404
+
+
+def test_index_appended_by_other_workers(capture_app, tmp_path):
+    with capture_app.app_context():
+        store = capture_store()
+        store.append({'filename': 'mine', 'context': 'shared', 'data': {}})
+        store.flush()
+        assert [e['filename'] for e in store.lookup(context='shared')] == ['mine']
+
+        # another worker process' append, the second line still in progress
+        other = {'filename': 'theirs', 'context': 'shared', 'segment': 's', 'offset': 0}
+        with open(tmp_path / INDEX_FILENAME, 'a') as index:
+            index.write(json.dumps(other) + '\n' + json.dumps(other)[:10])
+        assert [e['filename'] for e in store.lookup(context='shared')] == ['mine', 'theirs']
+        assert store.lookup(filename='theirs') == [other]
@@ -0,0 +1,55 @@
+"""Tests for response compression on /fhir-router"""
+import gzip
+import json
+
+from pytest import fixture
+
+iss = "http://ehr.example.com/fhir"
+bundle = {
+    "resourceType": "Bundle",
+    "type": "searchset",
+    "total": 100,
+    "entry": [
+        {"resource": {"resourceType": "Observation", "id": str(i), "status": "final"}}
+        for i in range(100)],
+}
+
+
+@fixture
+def router(routed, requests_mock):
+    requests_mock.get(f"{iss}/Observation", json=bundle)
+    requests_mock.get(f"{iss}/Patient/1", json={"resourceType": "Patient", "id": "1"})
+    return routed.test_client()
+
+
+def test_gzip(router):
+    response = router.get(
+        "/fhir-router/sid/Observation?patient=1",
+        headers={"Authorization": "Bearer t", "Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert json.loads(gzip.decompress(response.data)) == bundle
+    assert int(response.headers["Content-Length"]) < len(json.dumps(bundle)) / 5
+
+
+def test_identity(router):
+    response = router.get(
+        "/fhir-router/sid/Observation?patient=1", headers={"Authorization": "Bearer t"})
+    assert "Content-Encoding" not in response.headers
+    assert response.get_json() == bundle
+
+
+def test_small_response_uncompressed(router):
+    response = router.get(
+        "/fhir-router/sid/Patient/1",
+        headers={"Authorization": "Bearer t", "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_streamed(app, router):
+    app.config["SECONDARY_SOURCE_MODE"] = "merge"
+    response = router.get(
+        "/fhir-router/sid/Observation?patient=1",
+        headers={"Authorization": "Bearer t", "Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(response.data))["entry"]) == 100
@@ -0,0 +1,87 @@
+"""Tests for conditional (revalidated) upstream requests"""
+from pytest import fixture
+import redis
+
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import conditional_request, response_validators
+
+iss = "http://ehr.example.com/fhir"
+patient = {
+    "resourceType": "Patient",
+    "id": "1",
+    "meta": {"versionId": "3", "lastUpdated": "2024-01-02T03:04:05+00:00"},
+}
+
+
+@fixture
+def app(app):
+    app.config["CONDITIONAL_REQUESTS_ENABLED"] = True
+    return app
+
+
+def send(url):
+    return lambda headers: http_session().get(url, headers=headers)
+
+
+def test_validators_from_meta(requests_mock):
+    requests_mock.get(f"{iss}/Patient/1", json=patient)
+    validators = response_validators(http_session().get(f"{iss}/Patient/1"))
+    assert validators == {
+        "ETag": 'W/"3"', "Last-Modified": "Tue, 02 Jan 2024 03:04:05 GMT"}
+
+
+def test_not_modified_served_from_store(app, requests_mock):
+    url = f"{iss}/Patient/1"
+    requests_mock.get(url, [
+        {"json": patient, "headers": {"ETag": 'W/"3"'}},
+        {"status_code": 304},
+    ])
+    with app.app_context():
+        first = conditional_request("cond-1", {}, send(url))
+        second = conditional_request("cond-1", {}, send(url))
+    assert requests_mock.last_request.headers["If-None-Match"] == 'W/"3"'
+    assert second.status_code == 200
+    assert second.json() == first.json()
+
+
+def test_disabled_by_default(mocker):
+    from confidential_backend.app import create_app
+    app = create_app(testing=True)
+    store = mocker.patch("confidential_backend.proxycache.cache_store")
+    with app.app_context():
+        conditional_request("cond-off", {}, lambda headers: "sent")
+    store.assert_not_called()
+
+
+def test_store_failure_fails_open(app, requests_mock, mocker):
+    url = f"{iss}/Patient/1"
+    requests_mock.get(url, json=patient)
+    store = mocker.patch("confidential_backend.proxycache.cache_store").return_value
+    store.get.side_effect = redis.exceptions.ConnectionError("down")
+    with app.app_context():
+        response = conditional_request("cond-down", {}, send(url))
+        assert response.json() == patient
+
+        store.get.side_effect = None
+        store.get.return_value = None
+        store.set.side_effect = redis.exceptions.TimeoutError("slow")
+        assert conditional_request("cond-down", {}, send(url)).json() == patient
+
+
+def test_client_validators_pass_through(routed, requests_mock):
+    requests_mock.get(f"{iss}/Patient/1", status_code=304, headers={"ETag": 'W/"3"'})
+    client = routed.test_client()
+    response = client.get(
+        "/fhir-router/sid/Patient/1",
+        headers={"Authorization": "Bearer t", "If-None-Match": 'W/"3"'})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == 'W/"3"'
+    assert requests_mock.last_request.headers["If-None-Match"] == 'W/"3"'
+
+
+def test_validators_returned_to_client(routed, requests_mock):
+    requests_mock.get(f"{iss}/Patient/1", json=patient)
+    client = routed.test_client()
+    response = client.get("/fhir-router/sid/Patient/1", headers={"Authorization": "Bearer t"})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == 'W/"3"'
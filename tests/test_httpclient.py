@@ -0,0 +1,77 @@
+"""Tests for the shared HTTP client"""
+import http.server
+import threading
+
+from pytest import fixture
+
+from confidential_backend import httpclient
+from confidential_backend.httpclient import dns_cache, host_metrics, http_session
+
+
+@fixture
+def server():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"localhost:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_dns_cached(app, server, mocker):
+    getaddrinfo = mocker.spy(httpclient.socket, 'getaddrinfo')
+    dns_cache.invalidate('localhost', int(server.split(':')[1]))
+
+    for _ in range(3):
+        # server closes each connection, forcing a new one per request
+        assert http_session().get(f"http://{server}/").json() == {}
+
+    lookups = [c for c in getaddrinfo.call_args_list if c.args[0] == 'localhost']
+    assert len(lookups) == 1
+
+
+def test_dns_cache_failover(app, server, mocker):
+    port = int(server.split(':')[1])
+    # server listens on 127.0.0.1 alone; the first cached address refuses
+    mocker.patch.object(dns_cache, 'resolve', return_value=[
+        ('127.0.0.2', port), ('127.0.0.1', port)])
+    assert http_session().get(f"http://{server}/").json() == {}
+
+
+def test_host_metrics(app, server):
+    http_session().get(f"http://{server}/")
+    metrics = host_metrics.snapshot()[server]
+    assert metrics['requests'] >= 1
+    assert metrics['errors'] == 0
+
+
+def test_host_metrics_endpoint(app, client, server):
+    http_session().get(f"http://{server}/")
+    assert client.get('/metrics/upstream').status_code == 401
+
+    app.config['ADMIN_TOKEN'] = 'admin-secret'
+    response = client.get(
+        '/metrics/upstream', headers={'Authorization': 'Bearer admin-secret'})
+    assert response.status_code == 200
+    assert server in response.get_json()
+
+
+def test_default_timeout(app, mocker):
+    send = mocker.patch.object(httpclient.HTTPAdapter, 'send')
+    send.return_value.status_code = 200
+    adapter = http_session().get_adapter("http://upstream.example.com/")
+    adapter.send(http_session().prepare_request(
+        httpclient.requests.Request('GET', "http://upstream.example.com/")))
+    assert send.call_args.kwargs['timeout'] == (
+        app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT'])
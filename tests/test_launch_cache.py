@@ -0,0 +1,209 @@
+"""Tests for persistence of launch server responses to LAUNCH_CACHE_URL"""
+import time
+
+import requests
+
+from confidential_backend.app import create_app
+from confidential_backend.cachelaunchresponse import (
+    CeleryPersister,
+    DestinationLimit,
+    DisabledPersister,
+    persist_bundle,
+    persist_or_defer,
+    fresh,
+    persisted_at_key,
+    persist_resource,
+    record_persisted,
+    replay_dead_letters,
+)
+from confidential_backend.extensions import launch_cache
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import cache_store
+
+
+def test_disabled_without_cache_url(app, mocker):
+    assert app.config['LAUNCH_CACHE_URL'] is None
+    assert isinstance(app.extensions['launch_cache'], DisabledPersister)
+
+    delay = mocker.patch("confidential_backend.cachelaunchresponse.persist_response.delay")
+    with app.app_context():
+        launch_cache.persist({"resourceType": "Patient", "id": "1"})
+    delay.assert_not_called()
+
+
+def test_enabled_with_cache_url(mocker):
+    mocker.patch("confidential_backend.config.LAUNCH_CACHE_URL", "http://cache/fhir")
+    app = create_app(testing=True)
+    assert isinstance(app.extensions['launch_cache'], CeleryPersister)
+
+    delay = mocker.patch("confidential_backend.cachelaunchresponse.persist_response.delay")
+    with app.app_context():
+        launch_cache.persist({"resourceType": "Patient", "id": "1"})
+    delay.assert_called_once_with({"resourceType": "Patient", "id": "1"})
+
+
+def test_persist_bundle(app, requests_mock):
+    base = "http://cache/fhir"
+    app.config['LAUNCH_CACHE_URL'] = base
+    bundle = {"resourceType": "Bundle", "type": "searchset", "entry": [
+        {"resource": {"resourceType": "Observation", "id": str(i)}} for i in range(20)]}
+    for i in range(20):
+        requests_mock.put(f"{base}/Observation/{i}", json={})
+    requests_mock.post(f"{base}/Bundle", json={})
+
+    with app.app_context():
+        persist_bundle(bundle)
+    assert requests_mock.call_count == 21
+    assert requests_mock.last_request.json()['type'] == 'collection'
+    assert 'If-None-Exist' in requests_mock.last_request.headers
+
+
+def test_destination_limit_rate():
+    limit = DestinationLimit(concurrency=2, rate_limit=50)
+    start = time.monotonic()
+    for _ in range(60):
+        with limit:
+            pass
+    # burst of 50, remaining 10 at 50/second
+    assert time.monotonic() - start >= 0.18
+
+
+def test_persist_idempotent(app, requests_mock):
+    base = "http://cache/fhir"
+    requests_mock.put(f"{base}/Patient/1", json={})
+    with app.app_context():
+        persist_resource({"resourceType": "Patient", "id": "1"}, base=base)
+        persist_resource({"resourceType": "Patient", "id": "1"}, base=base)
+    assert requests_mock.call_count == 1
+
+
+def test_persist_recorded(app, requests_mock):
+    base = "http://cache/fhir"
+    app.config['LAUNCH_CACHE_URL'] = base
+    patient = {"resourceType": "Patient", "id": "recorded"}
+    requests_mock.put(f"{base}/Patient/recorded", json={})
+    requests_mock.get(f"{base}/Patient/recorded", json=patient)
+    with app.app_context():
+        persist_resource(patient, base=base)
+        # sent as given, freshness is kept beside the resource
+        assert requests_mock.last_request.json() == patient
+        assert fresh(http_session().get(f"{base}/Patient/recorded"))
+
+        # an idempotent repeat, skipping the PUT, renews freshness
+        cache_store().delete(persisted_at_key(patient, base))
+        assert not fresh(http_session().get(f"{base}/Patient/recorded"))
+        persist_resource(patient, base=base)
+        assert fresh(http_session().get(f"{base}/Patient/recorded"))
+    assert [r.method for r in requests_mock.request_history].count("PUT") == 1
+
+
+def test_transient_failure_retried(app, requests_mock, mocker):
+    base = "http://cache/fhir"
+    requests_mock.put(f"{base}/Patient/2", status_code=503)
+    apply_async = mocker.patch(
+        "confidential_backend.cachelaunchresponse.persist_retry.apply_async")
+    with app.app_context():
+        persist_or_defer({"resourceType": "Patient", "id": "2"}, base)
+    apply_async.assert_called_once()
+
+
+def test_dead_letter_and_replay(app, requests_mock, mocker):
+    base = "http://cache/fhir"
+    requests_mock.put(f"{base}/Patient/3", status_code=400)
+    delay = mocker.patch("confidential_backend.cachelaunchresponse.persist_retry.delay")
+    with app.app_context():
+        persist_or_defer({"resourceType": "Patient", "id": "3"}, base)
+        assert cache_store().llen(app.config['LAUNCH_CACHE_DEAD_LETTER_KEY']) == 1
+
+        assert replay_dead_letters() == 1
+        assert cache_store().llen(app.config['LAUNCH_CACHE_DEAD_LETTER_KEY']) == 0
+    delay.assert_called_once_with({"resourceType": "Patient", "id": "3"}, base)
+
+
+iss = "http://ehr.example.com/fhir"
+cache_base = "http://cache/fhir"
+
+
+def read_through_app(routed, **config):
+    routed.config.update(
+        LAUNCH_CACHE_URL=cache_base, SINGLE_FLIGHT_ENABLED=False, **config)
+    return routed
+
+
+def cached_observations(observation_id="o1"):
+    return {"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": {
+        "resourceType": "Observation", "id": observation_id}}]}
+
+
+def test_fallback_on_launch_error(routed, requests_mock):
+    app = read_through_app(routed, LAUNCH_CACHE_READ_MODE="fallback")
+    requests_mock.get(f"{iss}/Observation?patient=1&code=fallback", status_code=503)
+    requests_mock.get(
+        f"{cache_base}/Observation?patient=1&code=fallback",
+        json=cached_observations())
+
+    response = app.test_client().get("/fhir-router/sid/Observation?patient=1&code=fallback")
+    assert response.status_code == 200
+    assert response.headers["X-Served-By"] == "launch-cache"
+    assert response.get_json()["entry"][0]["resource"]["id"] == "o1"
+    launch_cache.persist.assert_not_called()
+
+
+def test_fallback_on_latency_budget(routed, requests_mock):
+    app = read_through_app(
+        routed, LAUNCH_CACHE_READ_MODE="fallback", LAUNCH_CACHE_LATENCY_BUDGET=0.5)
+    launch = requests_mock.get(
+        f"{iss}/Observation?patient=1&code=slow", exc=requests.exceptions.ReadTimeout)
+    requests_mock.get(
+        f"{cache_base}/Observation?patient=1&code=slow",
+        json=cached_observations())
+
+    response = app.test_client().get("/fhir-router/sid/Observation?patient=1&code=slow")
+    assert response.headers["X-Served-By"] == "launch-cache"
+    assert launch.last_request.timeout == (app.config['HTTP_CONNECT_TIMEOUT'], 0.5)
+
+
+def test_launch_served_when_healthy(routed, requests_mock):
+    app = read_through_app(routed, LAUNCH_CACHE_READ_MODE="fallback")
+    requests_mock.get(f"{iss}/Patient/1", json={"resourceType": "Patient", "id": "1"})
+    cache = requests_mock.get(f"{cache_base}/Patient/1", json={})
+
+    response = app.test_client().get("/fhir-router/sid/Patient/1")
+    assert response.headers["X-Served-By"] == "launch"
+    assert not cache.called
+
+
+def test_cache_first_freshness(routed, requests_mock):
+    app = read_through_app(
+        routed, LAUNCH_CACHE_READ_MODE="cache-first", LAUNCH_CACHE_FIRST_TYPES=["Observation"])
+    with app.app_context():
+        record_persisted({"resourceType": "Observation", "id": "fresh"}, cache_base)
+    requests_mock.get(
+        f"{cache_base}/Observation?patient=1&code=fresh", json=cached_observations("fresh"))
+    requests_mock.get(
+        f"{cache_base}/Observation?patient=1&code=stale",
+        json=cached_observations("stale"))
+    launch = requests_mock.get(
+        f"{iss}/Observation?patient=1&code=stale", json=cached_observations("stale"))
+
+    client = app.test_client()
+    response = client.get("/fhir-router/sid/Observation?patient=1&code=fresh")
+    assert response.headers["X-Served-By"] == "launch-cache"
+
+    response = client.get("/fhir-router/sid/Observation?patient=1&code=stale")
+    assert response.headers["X-Served-By"] == "launch"
+    assert launch.called
+
+
+def test_invalid_cache_response(routed, requests_mock):
+    app = read_through_app(
+        routed, LAUNCH_CACHE_READ_MODE="cache-first", LAUNCH_CACHE_FIRST_TYPES=["Observation"])
+    requests_mock.get(
+        f"{cache_base}/Observation?patient=1&code=html", text="<html>Bad Gateway</html>")
+    requests_mock.get(
+        f"{iss}/Observation?patient=1&code=html",
+        json=cached_observations())
+
+    response = app.test_client().get("/fhir-router/sid/Observation?patient=1&code=html")
+    assert response.status_code == 200
+    assert response.headers["X-Served-By"] == "launch"
@@ -1,11 +1,13 @@
 """Tests for multiple FHIR endpoints."""
 from copy import deepcopy
-from unittest.mock import patch
+import time
+from unittest.mock import MagicMock, patch
+
 from confidential_backend.source_strategies.secondary_fhir_strategy import SecondaryFhirStrategy
 
 
-@patch("confidential_backend.source_strategies.secondary_fhir_strategy.requests.get")
-def test_secondary_patient_lookup(mock_get, app):
+@patch("confidential_backend.source_strategies.secondary_fhir_strategy.http_session")
+def test_secondary_patient_lookup(mock_session, app):
     launch_system = "http://launch/system/mrn"
     app_system = "http://app/system/mrn"
     app_fhir_url = "http://fhir:8080"
@@ -27,6 +29,7 @@ def test_secondary_patient_lookup(mock_get, app):
         ]
     }
 
+    mock_get = mock_session.return_value.get
     mock_response = mock_get.return_value
     mock_response.json.return_value = search_result
     mock_response.status_code = 200
@@ -44,3 +47,150 @@ def test_secondary_patient_lookup(mock_get, app):
     expected_params = {"identifier": f"{app_system}|{mrn}"}
     mock_get.assert_called_once_with(expected_url, params=expected_params)
     assert result == app_patient
+
+
+def test_collate_dedupe():
+    from confidential_backend.api.fhir import collate_results
+    launch = {"resourceType": "Bundle", "entry": [
+        {"fullUrl": "http://launch/Observation/1", "resource": {
+            "resourceType": "Observation", "id": "1",
+            "identifier": [{"system": "urn:obs", "value": "a"}]}},
+        {"fullUrl": "http://launch/Observation/2", "resource": {
+            "resourceType": "Observation", "id": "2"}},
+    ]}
+    secondary = {"resourceType": "Bundle", "entry": [
+        # same identifier as launch entry, different server
+        {"fullUrl": "http://app/Observation/9", "resource": {
+            "resourceType": "Observation", "id": "9",
+            "identifier": [{"system": "urn:obs", "value": "a"}]}},
+        {"fullUrl": "http://app/Observation/10", "resource": {
+            "resourceType": "Observation", "id": "10"}},
+    ]}
+    results = collate_results(launch, secondary, launch)
+    assert results["total"] == 3
+    assert [e["resource"]["id"] for e in results["entry"]] == ["1", "2", "10"]
+
+
+def test_stream_bundle():
+    import json
+    from confidential_backend.api.fhir import collate_results, stream_bundle
+    bundle = collate_results(
+        {"entry": [{"fullUrl": f"http://launch/Condition/{i}"} for i in range(3)]})
+    streamed = json.loads(''.join(stream_bundle(bundle)))
+    assert streamed == bundle
+
+    empty = collate_results()
+    assert json.loads(''.join(stream_bundle(empty))) == empty
+
+
+def secondary_source(name, bundle, delay):
+    def server_request(**kwargs):
+        time.sleep(delay)
+        response = MagicMock(status_code=200)
+        response.json.return_value = bundle
+        return response
+
+    source = MagicMock()
+    source.name = name
+    source.translated_patient_id.return_value = f"{name}-patient"
+    source.allowed_request.return_value = True
+    source.empty_response.return_value = False
+    source.server_request.side_effect = server_request
+    return source
+
+
+def test_merged_search(routed, requests_mock, mocker):
+    iss = "http://ehr.example.com/fhir"
+    routed.config["SECONDARY_SOURCE_MODE"] = "merge"
+    shared = {"system": "urn:obs", "value": "a"}
+
+    def launch_bundle(request, context):
+        time.sleep(0.2)
+        return {"resourceType": "Bundle", "entry": [
+            {"fullUrl": f"{iss}/Observation/1", "resource": {
+                "resourceType": "Observation", "id": "1", "identifier": [shared]}}]}
+    requests_mock.get(f"{iss}/Observation?patient=1", json=launch_bundle)
+    sources = [
+        secondary_source("app", {"resourceType": "Bundle", "entry": [
+            # same identifier as the launch entry
+            {"fullUrl": "http://app/Observation/9", "resource": {
+                "resourceType": "Observation", "id": "9", "identifier": [shared]}},
+            {"fullUrl": "http://app/Observation/10", "resource": {
+                "resourceType": "Observation", "id": "10"}},
+        ]}, delay=0.2),
+        secondary_source("registry", {"resourceType": "Bundle", "entry": [
+            {"fullUrl": "http://registry/Observation/20", "resource": {
+                "resourceType": "Observation", "id": "20"}},
+            # same fullUrl as the app entry
+            {"fullUrl": "http://app/Observation/10", "resource": {
+                "resourceType": "Observation", "id": "10"}},
+        ]}, delay=0.2),
+    ]
+    mocker.patch(
+        "confidential_backend.api.fhir.strategy_registry.for_issuer", return_value=sources)
+
+    start = time.monotonic()
+    response = routed.test_client().get(
+        "/fhir-router/sid-merge/Observation?patient=1", headers={"Authorization": "Bearer t"})
+    elapsed = time.monotonic() - start
+
+    assert response.status_code == 200
+    # three sources, 0.2s each, queried at once
+    assert elapsed < 0.5
+    assert response.headers["X-Served-By"] == "launch, app, registry"
+    bundle = response.get_json()
+    assert bundle["total"] == 3
+    assert [e["resource"]["id"] for e in bundle["entry"]] == ["1", "10", "20"]
+    for source in sources:
+        source.server_request.assert_called_once()
+
+
+def test_collate_incomplete():
+    from confidential_backend.api.fhir import collate_results
+    results = collate_results(
+        {"entry": [{"fullUrl": "http://launch/Condition/1"}]},
+        next_urls=["http://launch/Condition?page=2"])
+    assert "total" not in results
+    assert results["link"] == [{"relation": "next", "url": "http://launch/Condition?page=2"}]
+    outcome = results["entry"][-1]
+    assert outcome["search"]["mode"] == "outcome"
+    assert outcome["resource"]["issue"][0]["code"] == "incomplete"
+
+
+def merged_pages(routed, requests_mock, mocker, pages):
+    iss = "http://ehr.example.com/fhir"
+    routed.config["SECONDARY_SOURCE_MODE"] = "merge"
+    for page in range(pages):
+        bundle = {"resourceType": "Bundle", "entry": [
+            {"fullUrl": f"{iss}/Condition/{page}", "resource": {
+                "resourceType": "Condition", "id": str(page)}}]}
+        if page + 1 < pages:
+            bundle["link"] = [{
+                "relation": "next", "url": f"{iss}/Condition?patient=1&page={page + 1}"}]
+        url = f"{iss}/Condition?patient=1" + (f"&page={page}" if page else "")
+        requests_mock.get(url, json=bundle, complete_qs=True)
+    mocker.patch(
+        "confidential_backend.api.fhir.strategy_registry.for_issuer", return_value=[
+            secondary_source("app", {"resourceType": "Bundle", "entry": [
+                {"fullUrl": "http://app/Condition/9", "resource": {
+                    "resourceType": "Condition", "id": "9"}}]}, delay=0)])
+    return routed.test_client().get(
+        "/fhir-router/sid-merge-pages/Condition?patient=1",
+        headers={"Authorization": "Bearer t"}).get_json()
+
+
+def test_merged_search_follows_pages(routed, requests_mock, mocker):
+    bundle = merged_pages(routed, requests_mock, mocker, pages=3)
+    assert [e["resource"]["id"] for e in bundle["entry"]] == ["0", "1", "2", "9"]
+    assert bundle["total"] == 4
+    assert "link" not in bundle
+
+
+def test_merged_search_incomplete(routed, requests_mock, mocker):
+    routed.config["MERGED_SEARCH_MAX_PAGES"] = 1
+    bundle = merged_pages(routed, requests_mock, mocker, pages=3)
+    assert "total" not in bundle
+    assert bundle["link"] == [
+        {"relation": "next", "url": "http://ehr.example.com/fhir/Condition?patient=1&page=2"}]
+    assert [e["resource"].get("id") for e in bundle["entry"]][:3] == ["0", "1", "9"]
+    assert bundle["entry"][-1]["search"]["mode"] == "outcome"
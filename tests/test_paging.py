@@ -0,0 +1,139 @@
+"""Tests for server side prefetch of searchset pages"""
+import threading
+import time
+
+from pytest import fixture
+import redis
+
+from confidential_backend.paging import (
+    cached_page,
+    page_urls,
+    prefetch_pages,
+    rewrite_links,
+    search_key,
+    start_prefetch,
+)
+
+iss = "http://ehr.example.com/fhir"
+proxy_base = "http://proxy.example.com/fhir-router/abc/"
+
+
+def page_link(offset):
+    return (
+        f"{iss}?_getpages=311f6eb3&_getpagesoffset={offset}"
+        "&_count=20&_bundletype=searchset")
+
+
+@fixture
+def first_page():
+    return {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": 60,
+        "link": [
+            {"relation": "self", "url": f"{iss}/Observation?patient=1"},
+            {"relation": "next", "url": page_link(20)},
+        ],
+        "entry": [],
+    }
+
+
+def test_page_urls(first_page):
+    urls = page_urls(first_page, max_pages=10)
+    assert urls == [page_link(20), page_link(40)]
+
+
+def test_page_urls_max_pages(first_page):
+    assert page_urls(first_page, max_pages=1) == [page_link(20)]
+
+
+def test_page_urls_without_offsets(first_page):
+    first_page['link'][1]['url'] = f"{iss}/Observation?patient=1&_cursor=xyz"
+    assert page_urls(first_page, max_pages=10) is None
+
+
+def test_rewrite_links(first_page):
+    rewrite_links(first_page, iss, proxy_base)
+    assert first_page['link'][0]['url'] == f"{proxy_base}Observation?patient=1"
+    assert first_page['link'][1]['url'] == (
+        f"{proxy_base}?_getpages=311f6eb3&_getpagesoffset=20"
+        "&_count=20&_bundletype=searchset")
+
+
+def test_prefetch_and_serve(app, requests_mock, first_page):
+    for offset in (20, 40):
+        requests_mock.get(page_link(offset), json={
+            "resourceType": "Bundle", "total": 60, "entry": [{"offset": offset}]})
+
+    with app.app_context():
+        prefetch_pages(first_page, iss, {"Authorization": "Bearer t"}, "1", "abc")
+        assert requests_mock.call_count == 2
+
+        page = cached_page(
+            "abc", "", "_getpages=311f6eb3&_getpagesoffset=40&_count=20&_bundletype=searchset")
+        assert page.json()['entry'] == [{"offset": 40}]
+
+        # cache is per session
+        assert cached_page(
+            "other", "", "_getpages=311f6eb3&_getpagesoffset=40"
+            "&_count=20&_bundletype=searchset") is None
+
+
+def test_search_key_ignores_offset():
+    assert search_key("abc", page_link(20)) == search_key("abc", page_link(40))
+    assert search_key("abc", page_link(20)) != search_key("other", page_link(20))
+
+
+def test_prefetch_once_per_search(app, requests_mock, first_page):
+    release = threading.Event()
+
+    def held_page(request, context):
+        release.wait(1)
+        return {"resourceType": "Bundle", "entry": []}
+    requests_mock.get(page_link(20), json=held_page)
+    requests_mock.get(page_link(40), json=held_page)
+
+    with app.app_context():
+        thread = start_prefetch(first_page, iss, {}, "1", "once")
+        assert thread is not None
+        assert start_prefetch(first_page, iss, {}, "1", "once") is None
+
+        app.config["PAGE_PREFETCH_MAX_THREADS"] = 1
+        assert start_prefetch(first_page, iss, {}, "1", "capped") is None
+        release.set()
+        thread.join(1)
+        assert start_prefetch(first_page, iss, {}, "1", "capped") is not None
+
+
+def test_cached_page_store_failure(app, mocker):
+    store = mocker.patch("confidential_backend.paging.cache_store").return_value
+    store.get.side_effect = redis.exceptions.ConnectionError("down")
+    with app.app_context():
+        assert cached_page("abc", "Observation", "patient=1") is None
+
+
+def test_router_serves_prefetched_page(routed, requests_mock, first_page):
+    routed.config["PAGE_PREFETCH_ENABLED"] = True
+    requests_mock.get(f"{iss}/Observation?patient=1", json=first_page)
+    for offset in (20, 40):
+        requests_mock.get(page_link(offset), json={
+            "resourceType": "Bundle", "total": 60, "entry": [{"offset": offset}]})
+    client = routed.test_client()
+
+    first = client.get("/fhir-router/sid-pages/Observation?patient=1").get_json()
+    next_url = first["link"][1]["url"]
+    assert next_url.startswith("http://localhost/fhir-router/sid-pages/?")
+
+    def prefetched(offset):
+        with routed.app_context():
+            return cached_page("sid-pages", "", page_link(offset).partition("?")[2])
+
+    deadline = time.monotonic() + 2
+    while not (prefetched(20) and prefetched(40)) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    calls = requests_mock.call_count
+    assert calls == 3
+
+    second = client.get(next_url[len("http://localhost"):])
+    assert second.get_json()["entry"] == [{"offset": 20}]
+    assert requests_mock.call_count == calls
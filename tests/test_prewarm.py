@@ -0,0 +1,116 @@
+"""Tests for prewarming caches after authorization"""
+from unittest.mock import ANY
+
+from pytest import fixture
+import redis
+
+from confidential_backend.auth.helpers import format_as_jwt
+from confidential_backend.prewarm import prewarm, profile_paths
+from confidential_backend.proxycache import MemoryStore, cached_response, request_key
+
+iss = "http://ehr.example.com/fhir"
+
+
+@fixture
+def profile_app(app):
+    app.config['PREFETCH_PROFILE'] = [
+        "Condition?patient={patient}", "Observation?patient={patient}"]
+    return app
+
+
+def test_profile_paths(profile_app):
+    with profile_app.app_context():
+        assert profile_paths("123") == [
+            "Condition?patient=123", "Observation?patient=123"]
+
+
+def test_prewarm_fills_response_cache(profile_app, requests_mock, mocker):
+    persist = mocker.patch("confidential_backend.prewarm.launch_cache.persist")
+    mocker.patch(
+        "confidential_backend.prewarm.strategy_registry.for_issuer", return_value=())
+    conditions = {"resourceType": "Bundle", "total": 1, "entry": [{"id": "c"}]}
+    requests_mock.get(f"{iss}/Condition?patient=123", json=conditions)
+    requests_mock.get(f"{iss}/Observation?patient=123", status_code=500)
+
+    with profile_app.app_context():
+        prewarm("sid", iss, "123", "token")
+        cached = cached_response(request_key(
+            base_url=iss,
+            relative_path="Condition",
+            query_string="patient=123",
+            patient_id="123",
+            authorization="Bearer token",
+            accept="application/json"))
+        assert cached.json() == conditions
+
+    # failed requests aren't persisted
+    persist.assert_called_once_with(conditions)
+
+
+def test_authorize_schedules_prewarm(profile_app, mocker):
+    store = MemoryStore()
+    profile_app.config['SESSION_REDIS'] = store
+    profile_app.session_interface.client = store
+    oauth = mocker.patch("confidential_backend.auth.views.oauth")
+    oauth.sof.authorize_access_token.return_value = {
+        "access_token": "token", "patient": "123", "id_token": format_as_jwt("e30")}
+    start_prewarm = mocker.patch("confidential_backend.auth.views.start_prewarm")
+
+    client = profile_app.test_client()
+    with client.session_transaction() as session:
+        session['iss'] = iss
+        session['sof_client_params'] = {'name': 'sof'}
+    response = client.get("/auth/authorize", query_string={"code": "c", "state": "s"})
+    assert response.status_code == 302
+    start_prewarm.assert_not_called()
+
+    # scheduled once the response completes
+    response.close()
+    start_prewarm.assert_called_once_with(ANY, iss, "123", "token")
+
+
+def prewarmed_router(routed, requests_mock, mocker):
+    routed.config['PREFETCH_PROFILE'] = ["Condition?patient={patient}"]
+    routed.config['PREFETCH_ACCEPT'] = "application/fhir+json"
+    mocker.patch("confidential_backend.prewarm.launch_cache.persist")
+    mocker.patch(
+        "confidential_backend.prewarm.strategy_registry.for_issuer", return_value=())
+    conditions = {"resourceType": "Bundle", "total": 1, "entry": [{"id": "prewarmed"}]}
+    upstream = requests_mock.get(f"{iss}/Condition?patient=1", json=conditions)
+    with routed.app_context():
+        prewarm("sid-prewarm", iss, "1", "token")
+    assert upstream.call_count == 1
+    return upstream
+
+
+def routed_get(routed):
+    return routed.test_client().get(
+        "/fhir-router/sid-prewarm/Condition?patient=1",
+        headers={"Authorization": "Bearer token", "Accept": "application/fhir+json"})
+
+
+def test_router_serves_prewarmed(routed, requests_mock, mocker):
+    upstream = prewarmed_router(routed, requests_mock, mocker)
+    response = routed_get(routed)
+    assert response.status_code == 200
+    assert response.get_json()["entry"] == [{"id": "prewarmed"}]
+    assert upstream.call_count == 1
+
+
+def test_write_discards_prewarmed(routed, requests_mock, mocker):
+    upstream = prewarmed_router(routed, requests_mock, mocker)
+    requests_mock.post(f"{iss}/Condition", status_code=201, json={
+        "resourceType": "Condition", "id": "new"})
+    routed.test_client().post(
+        "/fhir-router/sid-prewarm/Condition",
+        json={"resourceType": "Condition"}, headers={"Authorization": "Bearer token"})
+
+    routed_get(routed)
+    assert upstream.call_count == 2
+
+
+def test_cached_response_store_failure(app, mocker):
+    store = mocker.patch("confidential_backend.proxycache.cache_store").return_value
+    store.get.side_effect = redis.exceptions.ConnectionError("down")
+    with app.app_context():
+        assert cached_response("prewarm-down") is None
@@ -0,0 +1,69 @@
+"""Tests for the sampling profiler and its admin endpoints"""
+import tracemalloc
+
+from pytest import fixture
+
+from confidential_backend.app import create_app
+
+
+@fixture
+def profiled(mocker, tmp_path):
+    mocker.patch("confidential_backend.config.PROFILE_ENABLED", True)
+    mocker.patch("confidential_backend.config.PROFILE_SAMPLE_RATE", 1.0)
+    mocker.patch("confidential_backend.config.DEBUG_OUTPUT_DIR", str(tmp_path))
+    mocker.patch("confidential_backend.config.ADMIN_TOKEN", "secret")
+    return create_app(testing=True)
+
+
+def test_disabled_installs_no_hooks(app):
+    from confidential_backend.profiling import start_sample
+    assert start_sample not in app.before_request_funcs.get(None, [])
+
+
+def test_sampled_request_profiled(profiled, tmp_path):
+    client = profiled.test_client()
+    assert client.get("/").status_code == 200
+    written = [path.name for path in tmp_path.iterdir()]
+    assert len(written) == 1
+    assert written[0].startswith("profile-base.root-")
+
+    response = client.get("/admin/profiles", headers={"Authorization": "Bearer secret"})
+    assert response.get_json()["profiles"] == written
+
+    response = client.get(
+        f"/admin/profiles/{written[0]}", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert "function calls" in response.get_data(as_text=True)
+
+
+def test_admin_token_required(profiled):
+    client = profiled.test_client()
+    assert client.get("/admin/profiles").status_code == 401
+    assert client.get(
+        "/admin/profiles", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+
+def test_admin_disabled_without_token(app):
+    response = app.test_client().get("/admin/profiles", headers={"Authorization": "Bearer "})
+    assert response.status_code == 401
+
+
+def test_report_name_restricted(profiled):
+    response = profiled.test_client().get(
+        "/admin/profiles/..%2Fetc%2Fpasswd", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 404
+
+
+def test_allocation_report(mocker, tmp_path):
+    mocker.patch("confidential_backend.config.PROFILE_ENABLED", True)
+    mocker.patch("confidential_backend.config.PROFILE_SAMPLE_RATE", 1.0)
+    mocker.patch("confidential_backend.config.PROFILE_TRACEMALLOC", True)
+    mocker.patch("confidential_backend.config.DEBUG_OUTPUT_DIR", str(tmp_path))
+    try:
+        app = create_app(testing=True)
+        app.test_client().get("/")
+    finally:
+        tracemalloc.stop()
+    reports = list(tmp_path.glob("tracemalloc-base.root-*.txt"))
+    assert len(reports) == 1
+    assert reports[0].read_text().startswith("GET /\n")
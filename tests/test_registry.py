@@ -0,0 +1,63 @@
+"""Tests for the secondary source strategy registry"""
+import json
+import os
+
+from confidential_backend.app import create_app
+from confidential_backend.extensions import strategy_registry
+
+strategy_class = (
+    "confidential_backend.source_strategies.secondary_fhir_strategy.SecondaryFhirStrategy")
+
+
+def strategy(name, issuers=None):
+    cfg = {"name": name, "class": strategy_class, "server_url": f"http://{name}/fhir"}
+    if issuers:
+        cfg["issuers"] = issuers
+    return cfg
+
+
+def names(strategies):
+    return [s.name for s in strategies]
+
+
+def test_for_issuer(mocker):
+    mocker.patch("confidential_backend.config.SECONDARY_SOURCE_STRATEGIES", [
+        strategy("shared"),
+        strategy("a_only", issuers=["http://a/fhir/"]),
+        strategy("b_only", issuers=["http://b/fhir"]),
+    ])
+    app = create_app(testing=True)
+    with app.app_context():
+        assert names(strategy_registry.for_issuer("http://a/fhir")) == ["shared", "a_only"]
+        assert names(strategy_registry.for_issuer("http://b/fhir/")) == ["shared", "b_only"]
+        assert names(strategy_registry.for_issuer("http://c/fhir")) == ["shared"]
+        assert len(strategy_registry.all()) == 3
+
+
+def test_app_instances_independent(app):
+    # repeat app creation mustn't accumulate strategies
+    other = create_app(testing=True)
+    with other.app_context():
+        count = len(strategy_registry.all())
+    with app.app_context():
+        assert len(strategy_registry.all()) == count == len(
+            app.config['SECONDARY_SOURCE_STRATEGIES'])
+
+
+def test_hot_reload(mocker, tmp_path):
+    path = tmp_path / "strategies.json"
+    path.write_text(json.dumps([strategy("first")]))
+    mocker.patch("confidential_backend.config.SECONDARY_SOURCE_STRATEGIES_FILE", str(path))
+    mocker.patch("confidential_backend.config.STRATEGY_RELOAD_INTERVAL", 0)
+    app = create_app(testing=True)
+    with app.app_context():
+        assert names(strategy_registry.all()) == ["first"]
+
+        path.write_text(json.dumps([strategy("first"), strategy("second")]))
+        os.utime(path, (0, 0))
+        assert names(strategy_registry.all()) == ["first", "second"]
+
+        # invalid configuration retains the prior strategies
+        path.write_text("not json")
+        os.utime(path, (1, 1))
+        assert names(strategy_registry.all()) == ["first", "second"]
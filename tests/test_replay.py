@@ -0,0 +1,109 @@
+"""Tests for traffic capture and replay"""
+import logging
+import threading
+
+from pytest import fixture
+from werkzeug.serving import make_server
+
+from confidential_backend.fhirresourcelogger import pseudonym, scrub, scrub_path, scrub_query
+from confidential_backend.replay import StubFhirServer, load_captures, replay
+
+patient = {
+    "resourceType": "Patient",
+    "id": "p1",
+    "name": [{"family": "Smith", "given": ["Jo"]}],
+    "birthDate": "1970-01-01",
+    "gender": "female",
+}
+
+
+@fixture
+def capture_log(routed, router_session, tmp_path):
+    logfile = tmp_path / "fhir-resources.log"
+    routed.config.update(FHIR_CAPTURE_ENABLED=True, FHIR_RESOURCES_LOGFILE=str(logfile))
+    router_session["token_response"] = {"patient": "p1"}
+    yield logfile
+    logger = logging.getLogger("FHIR_RESOURCES")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def test_scrub_masks_phi():
+    scrubbed = scrub(patient)
+    assert scrubbed["id"] == "p1"
+    assert scrubbed["gender"] == "female"
+    assert scrubbed["name"] == [{"family": "xxxxx", "given": ["xx"]}]
+    assert scrubbed["birthDate"] == "x" * 10
+
+
+def test_scrub_path_and_query(app):
+    with app.app_context():
+        assert scrub_path("Patient/p1/_history/2") == (
+            f"Patient/{pseudonym('p1')}/_history/{pseudonym('2')}")
+        assert scrub_path("Patient/p1/$everything") == f"Patient/{pseudonym('p1')}/$everything"
+        assert scrub_path("Observation") == "Observation"
+        scrubbed = scrub_query("identifier=urn:mrn|123&_count=10")
+        assert "123" not in scrubbed
+        assert scrubbed == f"identifier={pseudonym('urn:mrn|123')}&_count=10"
+
+
+def test_capture_recorded(app, capture_log, requests_mock):
+    requests_mock.get("http://ehr.example.com/fhir/Patient/p1", json=patient)
+    app.test_client().get("/fhir-router/sid-capture/Patient/p1?_format=json")
+
+    captures = load_captures(capture_log)
+    assert len(captures) == 1
+    capture = captures[0]
+    assert capture["method"] == "GET"
+    with app.app_context():
+        assert capture["path"] == f"Patient/{pseudonym('p1')}"
+    assert capture["query"] == "_format=json"
+    assert capture["status"] == 200
+    assert capture["source"] == "launch"
+    assert capture["session"] != "sid-capture"
+    assert capture["fhir"]["name"][0]["family"] == "xxxxx"
+
+
+def test_capture_streamed_without_body(app, capture_log, requests_mock):
+    app.config["SECONDARY_SOURCE_MODE"] = "merge"
+    requests_mock.get("http://ehr.example.com/fhir/Condition?patient=p1", json={
+        "resourceType": "Bundle", "entry": [{"fullUrl": "http://ehr/Condition/1"}]})
+    response = app.test_client().get("/fhir-router/sid-capture/Condition?patient=p1")
+    assert response.get_json()["total"] == 1
+
+    capture, = load_captures(capture_log)
+    assert capture["status"] == 200
+    assert capture["fhir"] is None
+
+
+def test_capture_sampled_by_session(app, capture_log, requests_mock):
+    app.config["FHIR_CAPTURE_SAMPLE_RATE"] = 0
+    requests_mock.get("http://ehr.example.com/fhir/Patient/p1", json=patient)
+    app.test_client().get("/fhir-router/sid-capture/Patient/p1")
+    assert not capture_log.exists() or load_captures(capture_log) == []
+
+
+def test_replay_through_proxy(routed, router_session):
+    captures = [{
+        "session": "s1", "captured_at": 100.0 + i / 10, "method": "GET",
+        "path": "Patient/p1", "query": "", "status": 200, "elapsed_ms": 20,
+        "source": "launch", "request_body": None, "fhir": patient} for i in range(5)]
+    stub = StubFhirServer(captures, speedup=10).start()
+    router_session.update(iss=stub.base_url, token_response={"patient": "p1"})
+    routed.config["SINGLE_FLIGHT_ENABLED"] = False
+
+    proxy = make_server("127.0.0.1", 0, routed, threaded=True)
+    threading.Thread(target=proxy.serve_forever, daemon=True).start()
+    try:
+        summary = replay(
+            captures, f"http://127.0.0.1:{proxy.server_port}", speedup=10, concurrency=4)
+    finally:
+        proxy.shutdown()
+        stub.stop()
+
+    assert summary["requests"] == 5
+    assert summary["errors"] == 0
+    assert summary["status_mismatches"] == 0
+    # captured over 400ms, replayed ten times faster
+    assert summary["wall_ms"] < 400
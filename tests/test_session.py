@@ -0,0 +1,122 @@
+"""Tests for the split redis session storage layout"""
+from datetime import timedelta
+import threading
+
+from flask import g
+from pytest import fixture
+
+from confidential_backend.proxycache import MemoryStore
+from confidential_backend.wrapped_session import (
+    get_redis_session_data,
+    get_session_value,
+    set_redis_session_value,
+    set_redis_session_values,
+)
+
+token_response = {"access_token": "x" * 2000, "patient": "123"}
+
+
+@fixture
+def store(app):
+    store = MemoryStore()
+    app.config['SESSION_REDIS'] = store
+    app.session_interface.client = store
+    return store
+
+
+@fixture
+def stored_session(app, store):
+    data = {
+        "iss": "http://ehr/fhir",
+        "token_response": token_response,
+        "sof_client_params": {"name": "sof"},
+    }
+    with app.app_context():
+        app.session_interface._upsert_session(timedelta(hours=1), data, "session:abc")
+    return data
+
+
+def test_layout(store, stored_session):
+    assert b"x" * 2000 not in store.get("session:abc")
+    assert store.hmget("session:abc:fields", "iss") == [b'\xafhttp://ehr/fhir']
+    assert store.get("session:abc:token")
+
+
+def test_retrieve_complete_session(app, stored_session):
+    assert app.session_interface._retrieve_session_data("session:abc") == stored_session
+
+
+def test_hot_field_access(app, store, stored_session, mocker):
+    spy = mocker.spy(store, "get")
+    with app.test_request_context():
+        g.session_id = "abc"
+        assert get_session_value("iss") == "http://ehr/fhir"
+        # unset hot field known absent without loading session
+        assert get_session_value("app_patient_id") is None
+        spy.assert_not_called()
+
+        assert get_session_value("token_response") == token_response
+        assert get_session_value("sof_client_params") == {"name": "sof"}
+
+
+def test_set_redis_session_value(app, store, stored_session):
+    with app.app_context():
+        set_redis_session_value("abc", "app_patient_id", "B")
+        assert get_redis_session_data("abc") == {**stored_session, "app_patient_id": "B"}
+        assert store.hmget("session:abc:fields", ["app_patient_id"]) == [b'\xa1B']
+
+
+def test_hot_field_written_alone(app, store, stored_session, mocker):
+    spy = mocker.spy(store, "set")
+    with app.app_context():
+        set_redis_session_value("abc", "iss", "http://other/fhir")
+        spy.assert_not_called()
+        assert app.session_interface._retrieve_session_data("session:abc")["iss"] == (
+            "http://other/fhir")
+        assert get_redis_session_data("abc")["iss"] == "http://other/fhir"
+
+
+def test_values_written_together(app, store, stored_session):
+    refreshed = {**token_response, "access_token": "y"}
+    with app.app_context():
+        set_redis_session_values("abc", {
+            "token_response": refreshed, "superseded_access_tokens": ["d"]})
+        data = get_redis_session_data("abc")
+    assert data["token_response"] == refreshed
+    assert data["superseded_access_tokens"] == ["d"]
+    assert 0 < store.pttl("session:abc:token") <= store.pttl("session:abc")
+
+
+def test_concurrent_writers_retained(app, store, stored_session):
+    def write(i):
+        with app.app_context():
+            for n in range(20):
+                set_redis_session_value("abc", f"field_{i}", n)
+                set_redis_session_value("abc", f"writer_{i}_patient_id", n)
+
+    writers = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    with app.app_context():
+        data = get_redis_session_data("abc")
+    for i in range(4):
+        assert data[f"field_{i}"] == 19
+        assert data[f"writer_{i}_patient_id"] == 19
+
+
+def test_transaction_retried_on_conflict(app, store, stored_session):
+    calls = []
+
+    def update(pipe):
+        calls.append(pipe.get("session:abc"))
+        if len(calls) == 1:
+            # a concurrent write, between read and write
+            store.set("session:abc", b"changed")
+        pipe.multi()
+        pipe.set("counter", len(calls))
+
+    store.transaction(update, "session:abc")
+    assert calls[1] == b"changed"
+    assert store.get("counter") == 2
@@ -0,0 +1,110 @@
+"""Tests for coalescing of identical concurrent upstream requests"""
+import threading
+import time
+
+from pytest import raises
+import redis
+from requests import Response
+
+from confidential_backend.proxycache import MemoryStore, request_key, serialize_response
+from confidential_backend.singleflight import SingleFlight, redis_do
+
+
+def test_request_key_ignores_param_order():
+    a = request_key("http://ehr/fhir/", "Observation?patient=1&code=x", "", "1", "Bearer t")
+    b = request_key("http://ehr/fhir", "Observation", "code=x&patient=1", "1", "Bearer t")
+    assert a == b
+
+
+def test_request_key_distinct_auth():
+    a = request_key("http://ehr/fhir", "Observation", "patient=1", "1", "Bearer t")
+    b = request_key("http://ehr/fhir", "Observation", "patient=1", "1", "Bearer other")
+    assert a != b
+
+
+def test_concurrent_calls_coalesce():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def slow():
+        calls.append(1)
+        release.wait(2)
+        return "result"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("key", slow)))
+        for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ["result"] * 5
+
+
+def test_sequential_calls_not_coalesced():
+    flight = SingleFlight()
+    calls = []
+    for _ in range(3):
+        flight.do("key", lambda: calls.append(1))
+    assert len(calls) == 3
+
+
+def test_leader_error_raised():
+    flight = SingleFlight()
+
+    def boom():
+        raise ValueError("upstream down")
+
+    with raises(ValueError):
+        flight.do("key", boom)
+
+
+def test_redis_follower_shares_leader_response():
+    store = MemoryStore()
+    leader_response = Response()
+    leader_response.status_code = 200
+    leader_response._content = b'{"resourceType": "Bundle", "total": 0}'
+
+    # simulate leader in another worker holding the lock, then publishing
+    store.set('singleflight:lock:k', 'flight', px=1000, nx=True)
+
+    def publish():
+        time.sleep(0.1)
+        store.set(
+            'singleflight:result:k:flight', serialize_response(leader_response), px=1000)
+
+    threading.Thread(target=publish).start()
+
+    def should_not_fire():
+        raise AssertionError("follower fired upstream request")
+
+    response = redis_do(store, 'k', should_not_fire, timeout=1)
+    assert response.status_code == 200
+    assert response.json() == {"resourceType": "Bundle", "total": 0}
+
+
+def test_redis_follower_ignores_earlier_flight(app):
+    store = MemoryStore()
+    earlier = Response()
+    earlier.status_code = 200
+    earlier._content = b'{"flight": "earlier"}'
+    store.set('singleflight:result:k2:earlier', serialize_response(earlier), px=1000)
+    # a later flight's leader holds the lock, then dies without publishing
+    store.set('singleflight:lock:k2', 'later', px=1000, nx=True)
+    threading.Timer(0.1, store.delete, ['singleflight:lock:k2']).start()
+
+    with app.app_context():
+        assert redis_do(store, 'k2', lambda: "fired", timeout=1) == "fired"
+
+
+def test_redis_store_failure_fires(app, mocker):
+    store = mocker.Mock()
+    store.set.side_effect = redis.exceptions.ConnectionError("down")
+    with app.app_context():
+        assert redis_do(store, 'k4', lambda: "fired", timeout=1) == "fired"
@@ -0,0 +1,102 @@
+"""Tests for stale-if-error and stale-while-revalidate serving"""
+import time
+
+import redis
+import requests
+from pytest import raises
+
+from confidential_backend.httpclient import http_session
+from confidential_backend.proxycache import (
+    WARNING_REVALIDATION_FAILED,
+    WARNING_STALE,
+    last_good,
+    serve_stale,
+    store_last_good,
+)
+
+iss = "http://ehr.example.com/fhir"
+outcome = {"resourceType": "OperationOutcome", "issue": []}
+
+
+def bundle(code):
+    return {"resourceType": "Bundle", "type": "searchset", "entry": [
+        {"resource": {"resourceType": "Observation", "id": code}}]}
+
+
+def test_disabled_by_default(routed, requests_mock):
+    requests_mock.get(f"{iss}/Observation?patient=1&code=off", [
+        {"json": bundle("off")}, {"status_code": 503, "json": outcome}])
+    client = routed.test_client()
+    assert client.get("/fhir-router/sid/Observation?patient=1&code=off").status_code == 200
+    with raises(requests.exceptions.HTTPError):
+        client.get("/fhir-router/sid/Observation?patient=1&code=off")
+
+
+def test_stale_if_error(routed, requests_mock):
+    routed.config["STALE_IF_ERROR"] = 60
+    url = f"{iss}/Observation?patient=1&code=sie"
+    requests_mock.get(url, [
+        {"json": bundle("sie")},
+        {"status_code": 503, "json": outcome},
+        {"exc": requests.exceptions.ConnectTimeout},
+    ])
+    client = routed.test_client()
+    first = client.get("/fhir-router/sid/Observation?patient=1&code=sie")
+    assert "Warning" not in first.headers
+
+    for _ in range(2):
+        response = client.get("/fhir-router/sid/Observation?patient=1&code=sie")
+        assert response.status_code == 200
+        assert response.get_json() == first.get_json()
+        assert response.headers["Warning"] == WARNING_REVALIDATION_FAILED
+        assert response.headers["Age"] == "0"
+
+
+def test_error_without_stale_response(routed, requests_mock):
+    routed.config["STALE_IF_ERROR"] = 60
+    requests_mock.get(f"{iss}/Observation?patient=1&code=none", status_code=503, json=outcome)
+    with raises(requests.exceptions.HTTPError):
+        routed.test_client().get("/fhir-router/sid/Observation?patient=1&code=none")
+
+
+def test_stale_while_revalidate(routed, requests_mock):
+    routed.config["STALE_WHILE_REVALIDATE"] = 60
+    url = f"{iss}/Observation?patient=1&code=swr"
+    upstream = requests_mock.get(url, [{"json": bundle("v1")}, {"json": bundle("v2")}])
+    client = routed.test_client()
+    client.get("/fhir-router/sid/Observation?patient=1&code=swr")
+
+    response = client.get("/fhir-router/sid/Observation?patient=1&code=swr")
+    assert response.headers["Warning"] == WARNING_STALE
+    assert response.get_json()["entry"][0]["resource"]["id"] == "v1"
+
+    # background refresh replaces the stored response
+    deadline = time.monotonic() + 2
+    while upstream.call_count < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    response = client.get("/fhir-router/sid/Observation?patient=1&code=swr")
+    assert response.get_json()["entry"][0]["resource"]["id"] == "v2"
+
+
+def test_stale_window(app, requests_mock, mocker):
+    app.config["STALE_IF_ERROR"] = 60
+    requests_mock.get(f"{iss}/Patient/1", json={"resourceType": "Patient", "id": "1"})
+    with app.app_context():
+        store_last_good("stale-window", http_session().get(f"{iss}/Patient/1"))
+        mocker.patch("confidential_backend.proxycache.time.time", return_value=time.time() + 120)
+        assert last_good("stale-window", 60, WARNING_STALE) is None
+        assert last_good("stale-window", 180, WARNING_STALE).headers["Age"] == "120"
+
+
+def test_store_failure_fails_open(app, requests_mock, mocker):
+    app.config["STALE_WHILE_REVALIDATE"] = 60
+    app.config["STALE_IF_ERROR"] = 60
+    url = f"{iss}/Observation?patient=1&code=down"
+    requests_mock.get(url, json=bundle("down"))
+    store = mocker.patch("confidential_backend.proxycache.cache_store").return_value
+    store.get.side_effect = store.set.side_effect = redis.exceptions.ConnectionError("down")
+    with app.app_context():
+        response = serve_stale("stale-down", lambda: http_session().get(url))
+    assert response.json() == bundle("down")
+    assert "Warning" not in response.headers
@@ -0,0 +1,85 @@
+"""Tests for lazy access token refresh"""
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from pytest import fixture
+import redis
+
+from confidential_backend.tokenrefresh import fresh_token_response, needs_refresh
+
+iss = "http://ehr.example.com/fhir"
+token_url = "http://ehr.example.com/auth/token"
+
+
+@fixture
+def session(routed, router_session, mocker):
+    router_session.update({
+        "iss": iss,
+        "sof_client_params": {"name": "sof", "access_token_url": token_url},
+        "token_response": {
+            "access_token": "old",
+            "refresh_token": "r1",
+            "patient": "1",
+            "expires_at": int(time.time()) + 10,
+        },
+    })
+    mocker.patch(
+        "confidential_backend.tokenrefresh.get_session_value",
+        lambda key, default=None: router_session.get(key, default))
+    mocker.patch(
+        "confidential_backend.tokenrefresh.set_session_values", router_session.update)
+    routed.config.update(SOF_CLIENT_ID="client", SOF_CLIENT_SECRET="secret")
+    return router_session
+
+
+def test_needs_refresh(app):
+    with app.app_context():
+        assert not needs_refresh({"access_token": "t", "expires_at": int(time.time()) + 10})
+        assert needs_refresh(
+            {"access_token": "t", "refresh_token": "r", "expires_at": int(time.time()) + 10})
+        assert not needs_refresh(
+            {"access_token": "t", "refresh_token": "r", "expires_at": int(time.time()) + 3600})
+
+
+def test_single_flight_refresh(app, session, requests_mock):
+    def slow_token(request, context):
+        time.sleep(0.1)
+        return {"access_token": "new", "refresh_token": "r2", "expires_in": 3600}
+    token_endpoint = requests_mock.post(token_url, json=slow_token)
+
+    def check():
+        with app.app_context():
+            return fresh_token_response("sid-refresh", session["token_response"])
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: check(), range(4)))
+
+    assert token_endpoint.call_count == 1
+    assert all(result["access_token"] == "new" for result in results)
+    assert session["token_response"]["patient"] == "1"
+    assert session["token_response"]["refresh_token"] == "r2"
+
+
+def test_superseded_token_replaced(app, session, requests_mock):
+    requests_mock.post(
+        token_url, json={"access_token": "new", "refresh_token": "r2", "expires_in": 3600})
+    requests_mock.get(f"{iss}/Patient/1", json={"resourceType": "Patient", "id": "1"})
+
+    client = app.test_client()
+    response = client.get("/fhir-router/sid-route/Patient/1", headers={"Authorization": "Bearer old"})
+    assert response.status_code == 200
+    assert requests_mock.last_request.headers["Authorization"] == "Bearer new"
+
+    # unrelated tokens pass through unchanged
+    client.get("/fhir-router/sid-route/Patient/1", headers={"Authorization": "Bearer other"})
+    assert requests_mock.last_request.headers["Authorization"] == "Bearer other"
+
+
+def test_store_failure_keeps_token(app, session, requests_mock, mocker):
+    token_endpoint = requests_mock.post(token_url, json={"access_token": "new"})
+    store = mocker.patch("confidential_backend.tokenrefresh.cache_store").return_value
+    store.set.side_effect = redis.exceptions.ConnectionError("down")
+    with app.app_context():
+        result = fresh_token_response("sid-refresh-down", session["token_response"])
+    assert result["access_token"] == "old"
+    assert token_endpoint.call_count == 0
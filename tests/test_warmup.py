@@ -0,0 +1,39 @@
+"""Tests for worker warm up and readiness"""
+from confidential_backend import warmup
+from confidential_backend.scope import configured_scopes
+
+
+def test_ready(client):
+    # warm up is disabled by default, leaving the worker ready
+    response = client.get('/ready')
+    assert response.status_code == 200
+
+
+def test_not_ready(client, mocker):
+    mocker.patch.object(warmup, 'ready')
+    warmup.ready.is_set.return_value = False
+    response = client.get('/ready')
+    assert response.status_code == 503
+
+
+def test_warm_up(app, requests_mock, mocker):
+    iss = "http://ehr.example.com/fhir"
+    app.config['WARMUP_ISSUERS'] = [iss]
+    requests_mock.head(iss)
+    requests_mock.get(f"{iss}/.well-known/smart-configuration", json={})
+    requests_mock.head(f"{iss}/.well-known/smart-configuration")
+    mocker.patch.object(warmup, 'ready')
+
+    warmup.warm_up(app)
+    warmup.ready.set.assert_called_once()
+
+    # discovery cached; no further upstream requests
+    call_count = requests_mock.call_count
+    with app.app_context():
+        warmup.discover_sof_client_params(fhir_base_url=iss)
+    assert requests_mock.call_count == call_count
+
+
+def test_configured_scopes_cached():
+    scope_string = "patient/*.rs"
+    assert configured_scopes(scope_string) is configured_scopes(scope_string)